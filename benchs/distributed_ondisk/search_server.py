@@ -70,34 +70,6 @@ if __name__ == '__main__':
 ############################################################
 
 
-class ResultHeap:
-    """ Combine query results from a sliced dataset (for k-nn search) """
-
-    def __init__(self, nq, k):
-        " nq: number of query vectors, k: number of results per query "
-        self.I = np.zeros((nq, k), dtype='int64')
-        self.D = np.zeros((nq, k), dtype='float32')
-        self.nq, self.k = nq, k
-        heaps = faiss.float_maxheap_array_t()
-        heaps.k = k
-        heaps.nh = nq
-        heaps.val = faiss.swig_ptr(self.D)
-        heaps.ids = faiss.swig_ptr(self.I)
-        heaps.heapify()
-        self.heaps = heaps
-
-    def add_batch_result(self, D, I, i0):
-        assert D.shape == (self.nq, self.k)
-        assert I.shape == (self.nq, self.k)
-        I += i0
-        self.heaps.addn_with_ids(
-            self.k, faiss.swig_ptr(D),
-            faiss.swig_ptr(I), self.k)
-
-    def finalize(self):
-        self.heaps.reorder()
-
-
 def distribute_weights(weights, nbin):
     """ assign a set of weights to a smaller set of bins to balance them """
     nw = weights.size
@@ -168,6 +140,8 @@ class SplitPerListIndex:
     def search(self, x, k):
         xqo, list_nos, coarse_dis = self.index.transform_and_assign(x)
         assign = self.balance_lists(list_nos)
+        # the results are merged by the threads as they arrive
+        rh = faiss.ConcurrentResultHeap(x.shape[0], k)
 
         def do_query(i):
             sub_index = self.sub_indexes[i]
@@ -179,13 +153,9 @@ class SplitPerListIndex:
             # print(list_nos_i, Ii)
             if self.verbose:
                 print('client %d: %.3f s' % (i, time.time() - t0))
-            return Di, Ii
+            rh.add_result(Di, Ii)
 
-        rh = ResultHeap(x.shape[0], k)
-
-        for Di, Ii in self.pool.imap(do_query, range(self.ni)):
-            # print("ADD", Ii, rh.I)
-            rh.add_batch_result(Di, Ii, 0)
+        self.pool.map(do_query, range(self.ni))
         rh.finalize()
         return rh.D, rh.I
 
@@ -193,6 +163,7 @@ class SplitPerListIndex:
         xqo, list_nos, coarse_dis = self.index.transform_and_assign(x)
         assign = self.balance_lists(list_nos)
         nq = len(x)
+        merger = faiss.RangeResultMerger(nq)
 
         def do_query(i):
             sub_index = self.sub_indexes[i]
@@ -203,20 +174,8 @@ class SplitPerListIndex:
                 xqo, list_nos_i, coarse_dis, radius)
             if self.verbose:
                 print('slice %d: %.3f s' % (i, time.time() - t0))
-            return limi, Di, Ii
-
-        D = [[] for i in range(nq)]
-        I = [[] for i in range(nq)]
-
-        sizes = np.zeros(nq, dtype=int)
-        for lims, Di, Ii in self.pool.imap(do_query, range(self.ni)):
-            for i in range(nq):
-                l0, l1 = lims[i:i + 2]
-                D[i].append(Di[l0:l1])
-                I[i].append(Ii[l0:l1])
-                sizes[i] += l1 - l0
-        lims = np.zeros(nq + 1, dtype=int)
-        lims[1:] = np.cumsum(sizes)
-        D = np.hstack([j for i in D for j in i])
-        I = np.hstack([j for i in I for j in i])
-        return lims, D, I
+            # merged in slice order, whatever the order of completion
+            merger.add_result(limi, Di, Ii, rank=i)
+
+        self.pool.map(do_query, range(self.ni))
+        return merger.finalize()
@@ -117,10 +117,20 @@ class BigBatchSearcher:
         index = self.index
         # prepare queries
         i0, i1 = self.bucket_lims[l], self.bucket_lims[l + 1]
-        q_subset = self.query_ids[i0:i1]
-        xq_l = self.xq[q_subset]
-        if self.by_residual:
-            xq_l = xq_l - index.quantizer.reconstruct(l)
+        q_subset = self.query_ids[i0:i1].astype('int64')
+        centroid = index.quantizer.reconstruct(l) if self.by_residual else None
+        if self.xq.dtype == 'float32' and self.xq.flags.c_contiguous:
+            # gather in C++, without the GIL
+            xq_l = np.empty((len(q_subset), self.xq.shape[1]), dtype='float32')
+            faiss.gather_bucket_queries(
+                len(q_subset), faiss.swig_ptr(q_subset),
+                self.xq.shape[1], faiss.swig_ptr(self.xq),
+                None if centroid is None else faiss.swig_ptr(centroid),
+                faiss.swig_ptr(xq_l))
+        else:
+            xq_l = self.xq[q_subset]
+            if centroid is not None:
+                xq_l = xq_l - centroid
         t1 = time.time()
         # prepare database side
         list_ids, xb_l = get_invlist(index.invlists, l)
@@ -144,35 +154,137 @@ class BigBatchSearcher:
         if D is None:
             return
         t0 = time.time()
-        if I is None:
-            I = list_ids
+        # maps the offsets to ids and updates the heaps in C++, without the
+        # GIL. A query appears at most once per bucket so this is parallel
+        D = np.ascontiguousarray(D, dtype='float32')
+        nq_l, nres = D.shape
+        assert q_subset.dtype == 'int64' and len(q_subset) == nq_l
+        if I is not None:
+            I = np.ascontiguousarray(I, dtype='int64')
+            assert I.shape == D.shape
         else:
-            I = list_ids[I]
-        self.rh.add_result_subset(q_subset, D, I)
+            assert nres == len(list_ids)
+        faiss.add_bucket_results_to_heap(
+            self.rh.heaps, nq_l, faiss.swig_ptr(q_subset), nres,
+            faiss.swig_ptr(D), None if I is None else faiss.swig_ptr(I),
+            faiss.swig_ptr(list_ids))
         self.t_accu[3] += time.time() - t0
 
     def sizes_in_checkpoint(self):
         return (self.xq.shape, self.index.nprobe, self.index.nlist)
 
-    def write_checkpoint(self, fname, completed):
-        # write to temp file then move to final file
-        tmpname = fname + ".tmp"
-        with open(tmpname, "wb") as f:
-            pickle.dump(
-                {
-                    "sizes": self.sizes_in_checkpoint(),
-                    "completed": completed,
-                    "rh": (self.rh.D, self.rh.I),
-                }, f, -1)
-        os.replace(tmpname, fname)
-
-    def read_checkpoint(self, fname):
+    # Checkpointing. The checkpoint consists of
+    # - fname + ".D", fname + ".I": the result heaps, as raw arrays
+    # - fname: a log of pickled records. The first one contains the sizes,
+    #   the next ones the lists completed since the previous record and the
+    #   heap rows that they modified.
+    # A checkpoint appends a record to the log, then copies the rows to the
+    # heap files. If it is interrupted, the copy is redone from the log
+    # when the checkpoint is opened.
+
+    def open_checkpoint(self, fname):
+        """ open (or create) the checkpoint and return the set of completed
+        lists. The heaps become a copy-on-write mapping of the checkpoint
+        arrays, so the recovery does not read them upfront """
+        nq, k = self.rh.D.shape
+        heap_sizes = {".D": nq * k * 4, ".I": nq * k * 8}
+        if os.path.exists(fname) and not all(
+                os.path.exists(fname + suffix) and
+                os.path.getsize(fname + suffix) == size
+                for suffix, size in heap_sizes.items()):
+            # the log cannot be replayed without the heap files
+            logging.warning(f"checkpoint {fname}: heap files missing or "
+                            "with wrong size, starting a new checkpoint")
+            os.unlink(fname)
+        if not os.path.exists(fname):
+            for suffix, a in (".D", self.rh.D), (".I", self.rh.I):
+                with open(fname + suffix, "wb") as f:
+                    a.tofile(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+            with open(fname + ".tmp", "wb") as f:
+                pickle.dump({"sizes": self.sizes_in_checkpoint()}, f, -1)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(fname + ".tmp", fname)
+
+        records = []
         with open(fname, "rb") as f:
-            ckp = pickle.load(f)
-        assert ckp["sizes"] == self.sizes_in_checkpoint()
-        self.rh.D[:] = ckp["rh"][0]
-        self.rh.I[:] = ckp["rh"][1]
-        return ckp["completed"]
+            header = pickle.load(f)
+            assert header["sizes"] == self.sizes_in_checkpoint()
+            log_size = f.tell()
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except Exception:
+                    # end of file or record truncated by a crash
+                    break
+                log_size = f.tell()
+
+        self.ckp_fname = fname
+        self.ckp_D = np.memmap(
+            fname + ".D", dtype='float32', mode='r+', shape=(nq, k))
+        self.ckp_I = np.memmap(
+            fname + ".I", dtype='int64', mode='r+', shape=(nq, k))
+        completed = set()
+        for rec in records:
+            completed.update(rec["lists"])
+            self.ckp_D[rec["rows"]] = rec["D"]
+            self.ckp_I[rec["rows"]] = rec["I"]
+        self.ckp_D.flush()
+        self.ckp_I.flush()
+
+        self.rh.D = np.memmap(
+            fname + ".D", dtype='float32', mode='c', shape=(nq, k))
+        self.rh.I = np.memmap(
+            fname + ".I", dtype='int64', mode='c', shape=(nq, k))
+        self.rh.heaps.val = faiss.swig_ptr(self.rh.D)
+        self.rh.heaps.ids = faiss.swig_ptr(self.rh.I)
+
+        self.ckp_log = open(fname, "r+b")
+        self.ckp_log.truncate(log_size)
+        self.ckp_log.seek(log_size)
+        return completed
+
+    def write_checkpoint(self, new_lists, completed):
+        """ save the results of the lists completed since the previous
+        checkpoint, the cost is proportional to the nb of heap rows they
+        modified """
+        rows = [self.query_ids[self.bucket_lims[l]:self.bucket_lims[l + 1]]
+                for l in new_lists]
+        rows = np.unique(np.hstack(rows)) if rows else np.zeros(0, 'int64')
+        D, I = np.asarray(self.rh.D[rows]), np.asarray(self.rh.I[rows])
+        pickle.dump({"lists": list(new_lists), "rows": rows, "D": D, "I": I},
+                    self.ckp_log, -1)
+        self.ckp_log.flush()
+        os.fsync(self.ckp_log.fileno())
+        self.ckp_D[rows] = D
+        self.ckp_I[rows] = I
+        if self.ckp_log.tell() > self.ckp_D.nbytes + self.ckp_I.nbytes:
+            self.compact_checkpoint(completed)
+
+    def compact_checkpoint(self, completed):
+        """ replace the log with a single record, once the heap files are
+        on disk """
+        self.ckp_D.flush()
+        self.ckp_I.flush()
+        fname = self.ckp_fname
+        with open(fname + ".tmp", "wb") as f:
+            pickle.dump({"sizes": self.sizes_in_checkpoint()}, f, -1)
+            pickle.dump({
+                "lists": sorted(completed), "rows": np.zeros(0, 'int64'),
+                "D": np.asarray(self.ckp_D[:0]),
+                "I": np.asarray(self.ckp_I[:0])}, f, -1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(fname + ".tmp", fname)
+        self.ckp_log.close()
+        self.ckp_log = open(fname, "r+b")
+        self.ckp_log.seek(0, os.SEEK_END)
+
+    def close_checkpoint(self):
+        self.ckp_log.close()
+        del self.ckp_D, self.ckp_I
 
 
 class BlockComputer:
@@ -246,7 +358,8 @@ def big_batch_search(
         checkpoint_freq=7200,
         start_list=0,
         end_list=None,
-        crash_at=-1
+        crash_at=-1,
+        queue_size=2
         ):
     """
     Search queries xq in the IVF index, with a search function that collects
@@ -266,6 +379,8 @@ def big_batch_search(
     threaded=0: sequential execution
     threaded=1: prefetch next bucket while computing the current one
     threaded=2: prefetch prefetch_threads buckets at a time.
+        The prefetch, computation and writeback stages are connected by
+        queues of queue_size buckets.
 
     compute_threads>1: the knn function will get an additional thread_no that
         tells which worker should handle this.
@@ -278,7 +393,9 @@ def big_batch_search(
     q_assign: override coarse assignment, should be a matrix of size nq * nprobe
 
     checkpointing (only for threaded > 1):
-    checkpoint: file where the checkpoints are stored
+    checkpoint: file where the checkpoints are stored, the result arrays are
+        stored in checkpoint + ".D" and checkpoint + ".I". The checkpoints are
+        incremental and the returned arrays are mapped from these files.
     checkpoint_freq: when to perform checkpointing. Should be a multiple of threaded
 
     start_list, end_list: process only a subset of invlists
@@ -330,10 +447,10 @@ def big_batch_search(
         assert (start_list, end_list) == (0, index.nlist)
         if os.path.exists(checkpoint):
             logging.info(f"recovering checkpoint: {checkpoint}")
-            completed = bbs.read_checkpoint(checkpoint)
-            logging.info(f"   already completed: {len(completed)}")
         else:
             logging.info("no checkpoint: starting from scratch")
+        completed = bbs.open_checkpoint(checkpoint)
+        logging.info(f"   already completed: {len(completed)}")
 
     if threaded == 0:
         # simple sequential version
@@ -460,8 +577,8 @@ def big_batch_search(
                 _thread.interrupt_main()
                 raise
 
-        prepare_to_compute_queue = Queue(2)
-        compute_to_main_queue = Queue(2)
+        prepare_to_compute_queue = Queue(queue_size)
+        compute_to_main_queue = Queue(queue_size)
         compute_task_manager = task_manager(
             compute_task,
             computation_threads,
@@ -482,6 +599,7 @@ def big_batch_search(
         )
 
         t_checkpoint = time.time()
+        new_lists = []
         while True:
             logging.info("Waiting for result")
             value = compute_to_main_queue.get()
@@ -498,15 +616,20 @@ def big_batch_search(
             bbs.add_results_to_heap(q_subset, D, list_ids, I)
             logging.info(f"Adding to heap end: centroid {centroid}")
             completed.add(centroid)
+            new_lists.append(centroid)
             bbs.report(centroid)
             if checkpoint is not None:
                 if time.time() - t_checkpoint > checkpoint_freq:
                     logging.info("writing checkpoint")
-                    bbs.write_checkpoint(checkpoint, completed)
+                    bbs.write_checkpoint(new_lists, completed)
+                    new_lists = []
                     t_checkpoint = time.time()
 
         prepare_task_manager.join()
         compute_task_manager.join()
+        if checkpoint is not None:
+            bbs.write_checkpoint(new_lists, completed)
+            bbs.close_checkpoint()
 
     bbs.tic("finalize heap")
     bbs.rh.finalize()
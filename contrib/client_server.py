@@ -3,9 +3,15 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, as_completed
 from multiprocessing.pool import ThreadPool
 import faiss
-from typing import List, Tuple
+import numpy as np
+from typing import Dict, List, Optional, Tuple
 
 from . import rpc
 
@@ -14,13 +20,117 @@ from . import rpc
 ############################################################
 
 
+class SearchBatcher:
+    """ Coalesces concurrent searches of the same index into one call to
+    index.search, to use the BLAS / OpenMP parallelism on small query
+    batches. The searches are run by a dedicated thread: a batch starts
+    max_delay seconds after its first request or when max_batch_size query
+    vectors are waiting. A request larger than max_batch_size is run alone.
+    """
+
+    def __init__(self, index: faiss.Index, max_batch_size: int = 256,
+                 max_delay: float = 0.002):
+        self.index = index
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def search(self, x, k: int):
+        """ blocks until the batch that contains x is searched """
+        fut = Future()
+        self.queue.put((np.ascontiguousarray(x, dtype='float32'), k,
+                        time.time(), fut))
+        return fut.result()
+
+    def run(self):
+        carry = None
+        while True:
+            req = carry if carry is not None else self.queue.get()
+            carry = None
+            batch = [req]
+            nq = len(req[0])
+            deadline = req[2] + self.max_delay
+            while nq < self.max_batch_size:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        req = self.queue.get(timeout=timeout)
+                    else:
+                        req = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nq + len(req[0]) > self.max_batch_size:
+                    carry = req
+                    break
+                batch.append(req)
+                nq += len(req[0])
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        t0 = time.time()
+        try:
+            kmax = max(k for _, k, _, _ in batch)
+            D, I = self.index.search(
+                np.vstack([x for x, _, _, _ in batch]), kmax)
+        except Exception as e:
+            for _, _, _, fut in batch:
+                fut.set_exception(e)
+            return
+        with self.stats_lock:
+            self.nbatch += 1
+            self.nrequest += len(batch)
+            self.nquery += len(D)
+            self.queue_delay += sum(t0 - t for _, _, t, _ in batch)
+        # results are sorted, so the first k columns are the top-k
+        i0 = 0
+        for x, k, _, fut in batch:
+            i1 = i0 + len(x)
+            fut.set_result((D[i0:i1, :k], I[i0:i1, :k]))
+            i0 = i1
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.nbatch = self.nrequest = self.nquery = 0
+            self.queue_delay = 0.0
+
+    def get_stats(self) -> Dict[str, float]:
+        """ nb of batches, requests and queries, mean batch size, batch fill
+        rate (mean batch size / max_batch_size) and mean queueing delay of
+        the requests (in s) """
+        with self.stats_lock:
+            nbatch = max(self.nbatch, 1)
+            return {
+                "nbatch": self.nbatch,
+                "nrequest": self.nrequest,
+                "nquery": self.nquery,
+                "mean_batch_size": self.nquery / nbatch,
+                "fill_rate": self.nquery / nbatch / self.max_batch_size,
+                "mean_queue_delay": self.queue_delay / max(self.nrequest, 1),
+            }
+
+
 class SearchServer(rpc.Server):
     """ Assign version that can be exposed via RPC """
 
-    def __init__(self, s: int, index: faiss.Index):
+    def __init__(self, s: int, index: faiss.Index,
+                 batcher: Optional[SearchBatcher] = None):
         rpc.Server.__init__(self, s)
         self.index = index
         self.index_ivf = faiss.extract_index_ivf(index)
+        self.batcher = batcher
+
+    def search(self, x, k: int):
+        if self.batcher is None:
+            return self.index.search(x, k)
+        return self.batcher.search(x, k)
+
+    def get_batch_stats(self) -> Dict[str, float]:
+        assert self.batcher is not None, "search batching is not enabled"
+        return self.batcher.get_stats()
 
     def set_nprobe(self, nprobe: int) -> int:
         """ set nprobe field """
@@ -34,11 +144,20 @@ class SearchServer(rpc.Server):
         return getattr(self.index, f)
 
 
-def run_index_server(index: faiss.Index, port: int, v6: bool = False):
-    """ serve requests for that index forever """
+def run_index_server(index: faiss.Index, port: int, v6: bool = False,
+                     max_workers: Optional[int] = None,
+                     batch_size: Optional[int] = None,
+                     batch_delay: float = 0.002):
+    """ serve requests for that index forever. With max_workers, up to that
+    many calls are run concurrently (searches are thread-safe). With
+    batch_size, the concurrent searches of all clients are grouped in
+    batches of up to batch_size queries (see SearchBatcher) """
+    batcher = None
+    if batch_size is not None:
+        batcher = SearchBatcher(index, batch_size, batch_delay)
     rpc.run_server(
-        lambda s: SearchServer(s, index),
-        port, v6=v6)
+        lambda s: SearchServer(s, index, batcher),
+        port, v6=v6, max_workers=max_workers)
 
 
 ############################################################
@@ -48,13 +167,22 @@ def run_index_server(index: faiss.Index, port: int, v6: bool = False):
 class ClientIndex:
     """manages a set of distance sub-indexes. The sub_indexes search a
     subset of the inverted lists. Searches are merged afterwards
+
+    Each sub-index is accessed through a pool of nconn connections
+    (rpc.ClientPool) that are re-opened when the server restarts. The
+    settings (nprobe, nb of threads) are restored on the new connections.
     """
 
-    def __init__(self, machine_ports: List[Tuple[str, int]], v6: bool = False):
-        """ connect to a series of (host, port) pairs """
+    def __init__(self, machine_ports: List[Tuple[str, int]], v6: bool = False,
+                 nconn: int = 1, **pool_kwargs):
+        """ connect to a series of (host, port) pairs, pool_kwargs are
+        forwarded to rpc.ClientPool """
+        self.settings = {}
         self.sub_indexes = []
         for machine, port in machine_ports:
-            self.sub_indexes.append(rpc.Client(machine, port, v6))
+            self.sub_indexes.append(rpc.ClientPool(
+                machine, port, v6, nconn=nconn,
+                on_connect=self.restore_settings, **pool_kwargs))
 
         self.ni = len(self.sub_indexes)
         # pool of threads. Each thread manages one sub-index.
@@ -63,13 +191,19 @@ class ClientIndex:
         self.ntotal = self.get_ntotal()
         self.verbose = False
 
+    def restore_settings(self, client: rpc.Client) -> None:
+        for fname, args in self.settings.items():
+            client.generic_fun(fname, args)
+
     def set_nprobe(self, nprobe: int) -> None:
+        self.settings["set_nprobe"] = (nprobe, )
         self.pool.map(
             lambda idx: idx.set_nprobe(nprobe),
             self.sub_indexes
         )
 
     def set_omp_num_threads(self, nt: int) -> None:
+        self.settings["set_omp_num_threads"] = (nt, )
         self.pool.map(
             lambda idx: idx.set_omp_num_threads(nt),
             self.sub_indexes
@@ -81,11 +215,150 @@ class ClientIndex:
             self.sub_indexes
         ))
 
-    def search(self, x, k: int):
-
-        rh = faiss.ResultHeap(x.shape[0], k)
+    def search(self, x, k: int, batch_size: Optional[int] = None):
+        """ search all the sub-indexes. The queries are sent in batches of
+        batch_size (default: all at once), all the batches are in flight
+        simultaneously and the results are merged as they arrive """
+        nq = x.shape[0]
+        if batch_size is None:
+            batch_size = max(nq, 1)
+        rh = faiss.ResultHeap(nq, k)
 
-        for Di, Ii in self.pool.imap(lambda idx: idx.search(x, k), self.sub_indexes):
-            rh.add_result(Di, Ii)
+        futures = {}
+        for i0 in range(0, nq, batch_size):
+            i1 = min(nq, i0 + batch_size)
+            for idx in self.sub_indexes:
+                futures[idx.submit("search", x[i0:i1], k)] = i0
+        for fut in as_completed(futures):
+            i0 = futures[fut]
+            Di, Ii = fut.result()
+            rh.add_result_subset(np.arange(i0, i0 + len(Di)), Di, Ii)
         rh.finalize()
         return rh.D, rh.I
+
+    def close(self):
+        for idx in self.sub_indexes:
+            idx.close()
+        self.pool.close()
+
+
+class AsyncClientIndex:
+    """asyncio version of ClientIndex, where each shard can be served by
+    several replica servers. The results of the shards are merged as they
+    arrive.
+
+    A shard search is sent to the first replica. If it does not answer
+    within hedge_delay seconds (or fails), the same search is also sent to
+    the next replica, and the first answer is kept. Shards that do not
+    answer within timeout seconds are left out of the results.
+    """
+
+    def __init__(self, shards: List[List[Tuple[str, int]]], v6: bool = False,
+                 timeout: Optional[float] = None,
+                 hedge_delay: Optional[float] = None):
+        """ shards[i] is the list of (host, port) replicas of shard i """
+        assert all(len(replicas) > 0 for replicas in shards)
+        self.shards = [
+            [rpc.ClientPool(machine, port, v6) for machine, port in replicas]
+            for replicas in shards
+        ]
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+
+    async def _call_replicas(self, replicas, hedge_delay, fname, *args):
+        pending = set()
+        error = None
+
+        async def wait_pending(timeout):
+            # returns (True, result) for the first successful reply
+            nonlocal pending, error
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for fut in done:
+                    if fut.exception() is None:
+                        return True, fut.result()
+                    error = fut.exception()
+            return False, None
+
+        try:
+            for i, client in enumerate(replicas):
+                try:
+                    pending.add(asyncio.wrap_future(
+                        client.submit(fname, *args)))
+                except rpc.ClientExit as e:
+                    error = e
+                    continue
+                last = i == len(replicas) - 1
+                found, ret = await wait_pending(None if last else hedge_delay)
+                if found:
+                    return ret
+            found, ret = await wait_pending(None)
+            if found:
+                return ret
+            raise error
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+    async def _search_shard(self, no, x, k, timeout, hedge_delay):
+        try:
+            D, I = await asyncio.wait_for(
+                self._call_replicas(
+                    self.shards[no], hedge_delay, "search", x, k),
+                timeout)
+            return no, D, I, None
+        except Exception as e:
+            return no, None, None, e
+
+    async def search(self, x, k: int, timeout: Optional[float] = None,
+                     hedge_delay: Optional[float] = None,
+                     allow_partial: bool = True):
+        """ search all the shards, timeout and hedge_delay override the
+        defaults of the object.
+        Returns D, I and the list of shards that did not answer (only
+        possible if allow_partial, otherwise the first error is raised) """
+        if timeout is None:
+            timeout = self.timeout
+        if hedge_delay is None:
+            hedge_delay = self.hedge_delay
+        rh = faiss.ResultHeap(x.shape[0], k)
+        failed = []
+        tasks = [
+            asyncio.create_task(
+                self._search_shard(no, x, k, timeout, hedge_delay))
+            for no in range(len(self.shards))
+        ]
+        try:
+            for coro in asyncio.as_completed(tasks):
+                no, Di, Ii, error = await coro
+                if error is not None:
+                    if not allow_partial:
+                        raise error
+                    failed.append(no)
+                else:
+                    rh.add_result(Di, Ii)
+        finally:
+            # on error, do not leave the other shards hedging in the
+            # background
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        rh.finalize()
+        return rh.D, rh.I, sorted(failed)
+
+    async def get_ntotal(self) -> int:
+        ntotals = await asyncio.gather(*[
+            self._call_replicas(replicas, self.hedge_delay, "get_ntotal")
+            for replicas in self.shards
+        ])
+        return sum(ntotals)
+
+    def close(self):
+        for replicas in self.shards:
+            for client in replicas:
+                client.close()
@@ -25,6 +25,39 @@ def knn_intersection_measure(I1, I2):
     )
     return ninter / I1.size
 
+
+def knn_intersection_sizes(I, gt):
+    """ per-query number of ids in common between the result table I of
+    size (nq, k) and the ground-truth table gt of size (nq, k_gt).
+    Duplicates are counted once and negative ids (missing results) are
+    ignored. Computed in C++, in parallel over the queries. """
+    nq, k = I.shape
+    nq2, k_gt = gt.shape
+    assert nq2 == nq
+    I = np.ascontiguousarray(I, dtype='int64')
+    gt = np.ascontiguousarray(gt, dtype='int64')
+    inter = np.empty(nq, dtype='int64')
+    faiss.ranklist_intersection_sizes(
+        nq, k, faiss.swig_ptr(I), k_gt, faiss.swig_ptr(gt),
+        faiss.swig_ptr(inter))
+    return inter
+
+
+def knn_recall(I, gt, k=None):
+    """ per-query recall@k: fraction of the k first ground-truth neighbors
+    that are in the k first results (default: as many as both tables
+    have) """
+    if k is None:
+        k = min(I.shape[1], gt.shape[1])
+    assert k <= I.shape[1] and k <= gt.shape[1]
+    return knn_intersection_sizes(I[:, :k], gt[:, :k]) / k
+
+
+def knn_fnr(I, gt, k=None):
+    """ per-query false negative rate, 1 - recall@k """
+    return 1 - knn_recall(I, gt, k)
+
+
 ###############################################################
 # Range search results can be compared with Precision-Recall
 
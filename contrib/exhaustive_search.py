@@ -4,18 +4,84 @@
 # LICENSE file in the root directory of this source tree.
 
 import faiss
+import os
+import pickle
+import threading
 import time
 import numpy as np
+from queue import Full, Queue
 
 import logging
 
 LOG = logging.getLogger(__name__)
 
 
-def knn_ground_truth(xq, db_iterator, k, metric_type=faiss.METRIC_L2, shard=False, ngpu=-1):
+def _prefetch_iterator(iterator, prefetch):
+    """ iterate in a background thread, that reads up to prefetch items
+    ahead """
+    if prefetch == 0:
+        yield from iterator
+        return
+    q = Queue(prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        # give up when the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for item in iterator:
+                if not put((True, item)):
+                    return
+            put((True, None))
+        except BaseException as e:
+            put((False, e))
+
+    threading.Thread(target=reader, daemon=True).start()
+    try:
+        while True:
+            ok, item = q.get()
+            if not ok:
+                raise item
+            if item is None:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def knn_ground_truth(xq, db_iterator, k, metric_type=faiss.METRIC_L2, shard=False, ngpu=-1,
+                     prefetch=0, rank=0, nrank=1,
+                     checkpoint=None, checkpoint_freq=600):
     """Computes the exact KNN search results for a dataset that possibly
     does not fit in RAM but for which we have an iterator that
     returns it block by block.
+
+    prefetch: number of database blocks read ahead by a background thread,
+        to overlap the I/O with the computation.
+
+    rank, nrank: process only the blocks b with b % nrank == rank (the ids
+        are global). This distributes the computation over nrank processes,
+        whose results are combined with faiss.merge_knn_results.
+
+    checkpoint: file where the partial results are stored every
+        checkpoint_freq seconds. If it exists, the computation resumes from
+        there. The db_iterator should return the same blocks, the blocks
+        that are already processed are iterated over but not searched.
+
+    db_iterator can also be a function that takes a block number and
+    returns the iterator over the blocks from that one on. Then the blocks
+    already processed when resuming from a checkpoint are not read, eg.
+    for an fvecs file:
+
+        lambda b0: vecs_io.fvecs_iter(fname, bs, i0=b0 * bs)
     """
     LOG.info("knn_ground_truth queries size %s k=%d" % (xq.shape, k))
     t0 = time.time()
@@ -33,18 +99,61 @@ def knn_ground_truth(xq, db_iterator, k, metric_type=faiss.METRIC_L2, shard=Fals
         co.shard = shard
         index = faiss.index_cpu_to_all_gpus(index, co=co, ngpu=ngpu)
 
-    # compute ground-truth by blocks, and add to heaps
-    i0 = 0
-    for xbi in db_iterator:
-        ni = xbi.shape[0]
-        index.add(xbi)
-        D, I = index.search(xq, k)
-        I += i0
-        rh.add_result(D, I)
-        index.reset()
-        i0 += ni
-        LOG.info("%d db elements, %.3f s" % (i0, time.time() - t0))
+    sizes = (nq, d, k, metric_type, rank, nrank)
+    nblock_done = i0_done = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint, "rb") as f:
+            ckp = pickle.load(f)
+        assert ckp["sizes"] == sizes
+        rh.D[:] = ckp["D"]
+        rh.I[:] = ckp["I"]
+        nblock_done = ckp["nblock"]
+        i0_done = ckp["i0"]
+        LOG.info("resuming from checkpoint %s: %d blocks done" % (
+            checkpoint, nblock_done))
+
+    def write_checkpoint(nblock, i0):
+        # write to temp file then move to final file
+        with open(checkpoint + ".tmp", "wb") as f:
+            pickle.dump({
+                "sizes": sizes, "nblock": nblock, "i0": i0,
+                "D": rh.D, "I": rh.I,
+            }, f, -1)
+        os.replace(checkpoint + ".tmp", checkpoint)
 
+    # compute ground-truth by blocks, and add to heaps
+    if callable(db_iterator):
+        # start directly after the blocks that are already processed
+        db_iterator = db_iterator(nblock_done)
+        b0, i0 = nblock_done, i0_done
+    else:
+        b0 = i0 = 0
+    nblock = nblock_done
+    t_checkpoint = time.time()
+    blocks = _prefetch_iterator(db_iterator, prefetch)
+    try:
+        for b, xbi in enumerate(blocks, b0):
+            ni = xbi.shape[0]
+            nblock = b + 1
+            if b >= nblock_done and b % nrank == rank:
+                index.add(xbi)
+                D, I = index.search(xq, k)
+                I += i0
+                rh.add_result(D, I)
+                index.reset()
+                LOG.info("%d db elements, %.3f s" % (
+                    i0 + ni, time.time() - t0))
+                if checkpoint is not None and \
+                        time.time() - t_checkpoint > checkpoint_freq:
+                    write_checkpoint(nblock, i0 + ni)
+                    t_checkpoint = time.time()
+            i0 += ni
+    finally:
+        # stops the prefetch thread if the loop is interrupted
+        blocks.close()
+
+    if checkpoint is not None:
+        write_checkpoint(nblock, i0)
     rh.finalize()
     LOG.info("GT time: %.3f s (%d vectors)" % (time.time() - t0, i0))
 
@@ -0,0 +1,107 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import faiss
+
+from faiss.contrib.evaluation import knn_fnr
+
+
+def conformal_scores(conformal, D, I):
+    """ regularized non-conformity scores of search_checkpoints results
+    D, I of shape (nq, n_checkpoints, k), as computed online by the
+    HNSW_TERMINATION_CONFORMAL mode. Returns an (nq, n_checkpoints) table """
+    nq, nc, k = D.shape
+    dist_k = D[:, :, -1]
+    found = (I[:, :, -1] >= 0) & np.isfinite(dist_k)
+    norm_score = np.ones((nq, nc), dtype='float32')
+    norm_score[found] = np.minimum(dist_k[found] / conformal.max_dist, 1)
+    penalty = conformal.gamma * np.maximum(
+        0, np.arange(nc, dtype='float32') - conformal.c_reg)
+    return ((1 - norm_score) + penalty) / conformal.max_reg_val
+
+
+def calibrate_termination(
+        index, xq_calib, gt, alpha, schedule=None,
+        schedule_method=faiss.HNSW_TERMINATION_EF_SEARCH,
+        params=None, gamma=0.01, c_reg=2, nlambda=1000):
+    """
+    Calibrate the conformal early termination of an HNSW index so that the
+    expected false negative rate of the k-NN results is at most alpha.
+
+    The calibration queries are searched once with search_checkpoints
+    through the schedule of efforts. The threshold lambda_hat is the
+    smallest value on a grid of nlambda + 1 points in [0, 1] for which the
+    conformal risk control bound (nq * FNR + 1) / (nq + 1) is below alpha.
+    If no threshold satisfies it, lambda_hat = 1 and all queries use the
+    full schedule.
+
+    Use the result with
+        SearchParametersHNSW(
+            termination_method=faiss.HNSW_TERMINATION_CONFORMAL,
+            conformal=conformal)
+    For schedule methods other than efSearch, the efSearch of these
+    parameters sets the queue size and should be the same as in params.
+
+    Parameters
+    ----------
+    index : IndexHNSW
+    xq_calib : array_like
+        calibration queries, shape (nq, d)
+    gt : array_like
+        ground-truth neighbors, shape (nq, k), k is the number of results
+        the guarantee applies to
+    alpha : float
+        target false negative rate
+    schedule : array_like
+        non-decreasing efforts, interpreted with schedule_method
+
+    Returns
+    -------
+    conformal : HNSWConformalTermination
+    """
+    if schedule is None:
+        assert schedule_method == faiss.HNSW_TERMINATION_EF_SEARCH
+        schedule = [10, 16, 24, 32, 64, 128, 256, 512, 1024]
+    schedule = np.array(schedule, dtype='float32')
+    nc, = schedule.shape
+    nq, k = gt.shape
+    assert xq_calib.shape[0] == nq
+
+    if params is None:
+        params = faiss.SearchParametersHNSW(efSearch=index.hnsw.efSearch)
+    termination_method = params.termination_method
+    params.termination_method = schedule_method
+    try:
+        D, I = index.search_checkpoints(xq_calib, k, schedule, params=params)
+    finally:
+        params.termination_method = termination_method
+    fnr = knn_fnr(
+        I.reshape(nq * nc, k), np.repeat(gt, nc, axis=0)).reshape(nq, nc)
+
+    conformal = faiss.HNSWConformalTermination()
+    conformal.schedule_method = schedule_method
+    faiss.copy_array_to_vector(schedule, conformal.schedule)
+    conformal.gamma = gamma
+    conformal.c_reg = c_reg
+    dist_k = D[:, :, -1]
+    valid = (I[:, :, -1] >= 0) & np.isfinite(dist_k)
+    conformal.max_dist = float(dist_k[valid].max()) if valid.any() else 1.0
+    # largest possible raw score, so that the scores are in [0, 1]
+    conformal.max_reg_val = 1 + gamma * max(0, nc - 1 - c_reg)
+    scores = conformal_scores(conformal, D, I)
+
+    # the search stops at the first checkpoint whose score exceeds lambda,
+    # ie. the first one where the running max of the scores exceeds it
+    running_max = np.maximum.accumulate(scores, axis=1)
+    lambda_hat = 1.0
+    for lam in np.linspace(0, 1, nlambda + 1, dtype='float32'):
+        col = np.minimum((running_max <= lam).sum(axis=1), nc - 1)
+        risk = (fnr[np.arange(nq), col].sum() + 1) / (nq + 1)
+        if risk <= alpha:
+            lambda_hat = float(lam)
+            break
+    conformal.lambda_hat = lambda_hat
+    return conformal
@@ -7,19 +7,37 @@
 Simplistic RPC implementation.
 Exposes all functions of a Server object.
 
+Messages are framed as follows:
+- a fixed header: length of the array descriptors, length of the
+  skeleton, number of arrays
+- the array descriptors: dtype and shape of each array
+- the skeleton: the message pickled with the numpy arrays replaced by
+  references (persistent ids)
+- the raw data of the arrays
+so that arrays are sent directly from their memory and received in place,
+without being copied through pickle.
+
 This code is for demonstration purposes only, and does not include certain
 security protections. It is not meant to be run on an untrusted network or
 in a production environment.
 """
 
 import importlib
+import io
 import os
 import pickle
+import random
+import struct
 import sys
+import threading
+import time
 import _thread
 import traceback
 import socket
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
 
 LOG = logging.getLogger(__name__)
 
@@ -43,46 +61,146 @@ class RestrictedUnpickler(pickle.Unpickler):
                                      (module, name))
 
 
-class FileSock:
-    " wraps a socket so that it is usable by pickle/cPickle "
-
-    def __init__(self,sock):
-        self.sock = sock
-        self.nr=0
-
-    def write(self, buf):
-        # print("sending %d bytes"%len(buf))
-        #self.sock.sendall(buf)
-        # print("...done")
-        bs = 512 * 1024
-        ns = 0
-        while ns < len(buf):
-            sent = self.sock.send(buf[ns:ns + bs])
-            ns += sent
-
-    def read(self,bs=512*1024):
-        #if self.nr==10000: pdb.set_trace()
-        self.nr+=1
-        # print("read bs=%d"%bs)
-        b = []
-        nb = 0
-        while len(b)<bs:
-            # print('   loop')
-            rb = self.sock.recv(bs - nb)
-            if not rb: break
-            b.append(rb)
-            nb += len(rb)
-        return b''.join(b)
-
-    def readline(self):
-        # print("readline!")
-        """may be optimized..."""
-        s=bytes()
-        while True:
-            c=self.read(1)
-            s+=c
-        if len(c)==0 or chr(c[0])=='\n':
-            return s
+# descr_len, skeleton_len, n_arrays
+HEADER = struct.Struct('<IQI')
+
+# max nb of buffers passed to sendmsg at once
+MAX_IOV = 512
+
+# max size of a received message, in bytes. The sizes come from the peer,
+# so they are checked before allocating anything
+MAX_MESSAGE_SIZE = 1 << 34
+
+# dtype kinds of the arrays that are sent out of the pickle: bool, ints,
+# floats and complex
+ARRAY_KINDS = 'biufc'
+
+
+class ArrayPickler(pickle.Pickler):
+    """ pickles the skeleton of a message, the numpy arrays are collected
+    in arrays and replaced by their index """
+
+    def __init__(self, file, arrays):
+        pickle.Pickler.__init__(self, file, protocol=4)
+        self.arrays = arrays
+
+    def persistent_id(self, obj):
+        if (type(obj) is np.ndarray and obj.dtype.kind in ARRAY_KINDS
+                and obj.dtype.fields is None):
+            self.arrays.append(np.ascontiguousarray(obj))
+            return len(self.arrays) - 1
+        return None
+
+
+class ArrayUnpickler(RestrictedUnpickler):
+    """ loads the skeleton of a message, references to arrays are resolved
+    to the received arrays """
+
+    def __init__(self, file, arrays):
+        RestrictedUnpickler.__init__(self, file)
+        self.arrays = arrays
+
+    def persistent_load(self, pid):
+        if type(pid) is not int or not 0 <= pid < len(self.arrays):
+            raise pickle.UnpicklingError("invalid array reference")
+        return self.arrays[pid]
+
+
+def byte_view(a):
+    " writable or read-only flat byte view of a contiguous array "
+    return memoryview(a.reshape(-1).view('uint8'))
+
+
+def send_buffers(sock, bufs):
+    bufs = [memoryview(b).cast('B') for b in bufs]
+    bufs = [b for b in bufs if len(b) > 0]
+    if not hasattr(sock, 'sendmsg'):
+        for b in bufs:
+            sock.sendall(b)
+        return
+    while bufs:
+        sent = sock.sendmsg(bufs[:MAX_IOV])
+        # drop what was sent, sendmsg may stop in the middle of a buffer
+        while sent > 0:
+            if sent >= len(bufs[0]):
+                sent -= len(bufs[0])
+                bufs.pop(0)
+            else:
+                bufs[0] = bufs[0][sent:]
+                sent = 0
+
+
+def recv_into(sock, view):
+    """ fill view completely, raises EOFError if the connection is closed
+    before """
+    nr = 0
+    while nr < len(view):
+        n = sock.recv_into(view[nr:])
+        if n == 0:
+            raise EOFError("connection closed")
+        nr += n
+
+
+def send_message(sock, obj):
+    """ send one framed message """
+    arrays = []
+    f = io.BytesIO()
+    ArrayPickler(f, arrays).dump(obj)
+    skeleton = f.getbuffer()
+    descrs = []
+    for a in arrays:
+        dt = a.dtype.str.encode('ascii')
+        descrs.append(struct.pack('<BB', len(dt), a.ndim) + dt)
+        descrs.append(struct.pack('<%dq' % a.ndim, *a.shape))
+    descr = b''.join(descrs)
+    header = HEADER.pack(len(descr), len(skeleton), len(arrays))
+    send_buffers(
+        sock, [header, descr, skeleton] + [byte_view(a) for a in arrays])
+
+
+def recv_message(sock, max_size=None):
+    """ receive one framed message, the arrays are received directly in
+    their final memory. The total size of the message is limited to
+    max_size bytes (MAX_MESSAGE_SIZE by default) """
+    if max_size is None:
+        max_size = MAX_MESSAGE_SIZE
+    header = bytearray(HEADER.size)
+    recv_into(sock, memoryview(header))
+    descr_len, skeleton_len, n_arrays = HEADER.unpack(header)
+    size = descr_len + skeleton_len
+    if size > max_size:
+        raise pickle.UnpicklingError("message too large")
+    buf = bytearray(size)
+    recv_into(sock, memoryview(buf))
+    shapes = []
+    ofs = 0
+    try:
+        for _ in range(n_arrays):
+            dt_len, ndim = struct.unpack_from('<BB', buf, ofs)
+            ofs += 2
+            dtype = np.dtype(buf[ofs:ofs + dt_len].decode('ascii'))
+            ofs += dt_len
+            shape = struct.unpack_from('<%dq' % ndim, buf, ofs)
+            ofs += 8 * ndim
+            if dtype.kind not in ARRAY_KINDS or dtype.fields is not None:
+                raise pickle.UnpicklingError(
+                    "forbidden array dtype %s" % dtype)
+            if min(shape, default=0) < 0:
+                raise pickle.UnpicklingError("invalid array shape")
+            size += int(np.prod(shape, dtype=object)) * dtype.itemsize
+            if size > max_size:
+                raise pickle.UnpicklingError("message too large")
+            shapes.append((shape, dtype))
+    except (struct.error, TypeError, ValueError, UnicodeDecodeError):
+        raise pickle.UnpicklingError("invalid array descriptors")
+    arrays = [np.empty(shape, dtype=dtype) for shape, dtype in shapes]
+    if ofs != descr_len:
+        raise pickle.UnpicklingError("invalid array descriptors")
+    for a in arrays:
+        if a.nbytes > 0:
+            recv_into(sock, byte_view(a))
+    skeleton = io.BytesIO(memoryview(buf)[descr_len:])
+    return ArrayUnpickler(skeleton, arrays).load()
 
 
 class ClientExit(Exception):
@@ -106,7 +224,11 @@ class Server:
         # connection
 
         self.conn = s
-        self.fs = FileSock(s)
+
+        # if set, the calls are run in this pool and the replies may be
+        # sent out of order, otherwise they are run one after the other
+        self.executor = None
+        self.send_lock = threading.Lock()
 
 
     def log(self, s):
@@ -114,10 +236,12 @@ class Server:
 
     def one_function(self):
         """
-        Executes a single function with associated I/O.
+        Reads a single call and executes it, in the executor if there is one.
         Protocol:
-        - the arguments and results are serialized with the pickle protocol
-        - client sends : (fname,args)
+        - the arguments and results are sent as framed messages (see
+          send_message)
+        - client sends : (rid,fname,args)
+            rid = request id, chosen by the client
             fname = method name to call
             args = tuple of arguments
         - server sends result: (rid,st,ret)
@@ -127,38 +251,58 @@ class Server:
         """
 
         try:
-            (fname, args) = RestrictedUnpickler(self.fs).load()
+            (rid, fname, args) = recv_message(self.conn)
         except EOFError:
             raise ClientExit("read args")
+        except pickle.UnpicklingError as e:
+            # the stream cannot be resynchronized, drop the client
+            raise ClientExit("invalid message: %s" % e)
+        if self.executor is None:
+            self.run_function(rid, fname, args)
+        else:
+            self.executor.submit(self.run_function_async, rid, fname, args)
+
+    def run_function(self, rid, fname, args):
+        """ executes a function and sends the result """
         self.log("executing method %s"%(fname))
         st = None
         ret = None
         try:
             f=getattr(self,fname)
         except AttributeError:
-            st = AttributeError("unknown method "+fname)
+            st = "unknown method " + fname
             self.log("unknown method")
 
-        try:
-            ret = f(*args)
-        except Exception as e:
-            # due to a bug (in mod_python?), ServerException cannot be
-            # unpickled, so send the string and make the exception on the client side
-
-            #st=ServerException(
-            #  "".join(traceback.format_tb(sys.exc_info()[2]))+
-            #  str(e))
-            st="".join(traceback.format_tb(sys.exc_info()[2]))+str(e)
-            self.log("exception in method")
-            traceback.print_exc(50,self.logf)
-            self.logf.flush()
+        if st is None:
+            try:
+                ret = f(*args)
+            except Exception as e:
+                # due to a bug (in mod_python?), ServerException cannot be
+                # unpickled, so send the string and make the exception on the client side
+
+                #st=ServerException(
+                #  "".join(traceback.format_tb(sys.exc_info()[2]))+
+                #  str(e))
+                st="".join(traceback.format_tb(sys.exc_info()[2]))+str(e)
+                self.log("exception in method")
+                traceback.print_exc(50,self.logf)
+                self.logf.flush()
 
         LOG.info("return")
         try:
-            pickle.dump((st ,ret), self.fs, protocol=4)
+            with self.send_lock:
+                send_message(self.conn, (rid, st, ret))
         except EOFError:
             raise ClientExit("function return")
 
+    def run_function_async(self, rid, fname, args):
+        """ run_function in a worker thread: errors are only logged, the
+        connection is closed by exec_loop """
+        try:
+            self.run_function(rid, fname, args)
+        except BaseException as e:
+            self.log("error while sending the result of %s: %s" % (fname, e))
+
     def exec_loop(self):
         """ main execution loop. Loops and handles exit states"""
 
@@ -184,6 +328,10 @@ class Server:
     def exec_loop_cleanup(self):
         pass
 
+    def ping(self):
+        """ used by the clients to check that the connection is alive """
+        return True
+
     ###################################################################
     # spying stuff
 
@@ -203,33 +351,311 @@ class Client:
     """
     Methods of the server object can be called transparently. Exceptions are
     re-raised.
+
+    Calls can also be pipelined with submit(): several calls can be in flight
+    on the connection, their results are matched by request id when the
+    replies arrive (possibly out of order if the server has a worker pool).
     """
-    def __init__(self, HOST, port=PORT, v6=False):
+    def __init__(self, HOST, port=PORT, v6=False, connect_timeout=None):
         socktype = socket.AF_INET6 if v6 else socket.AF_INET
 
+        # set before anything else, because __getattr__ forwards unknown
+        # attributes to the server
+        self.pending = {}
+        self.next_rid = 0
+        self.error = None
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+
         sock = socket.socket(socktype, socket.SOCK_STREAM)
         LOG.info("connecting to %s:%d, socket type: %s", HOST, port, socktype)
-        sock.connect((HOST, port))
+        sock.settimeout(connect_timeout)
+        try:
+            sock.connect((HOST, port))
+        except BaseException:
+            sock.close()
+            raise
+        sock.settimeout(None)
         self.sock = sock
-        self.fs = FileSock(sock)
+
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def submit(self, fname, *args):
+        """ call method fname of the server without waiting for the result.
+        Returns a concurrent.futures.Future """
+        fut = Future()
+        with self.lock:
+            if self.error is not None:
+                raise ClientExit("connection closed: %s" % self.error)
+            rid = self.next_rid
+            self.next_rid += 1
+            self.pending[rid] = fut
+        try:
+            with self.send_lock:
+                send_message(self.sock, (rid, fname, args))
+        except BaseException:
+            with self.lock:
+                self.pending.pop(rid, None)
+            raise
+        return fut
 
     def generic_fun(self, fname, args):
-        # int "gen fun",fname
-        pickle.dump((fname, args), self.fs, protocol=4)
-        return self.get_result()
-
-    def get_result(self):
-        (st, ret) = RestrictedUnpickler(self.fs).load()
-        if st!=None:
-            raise ServerException(st)
-        else:
-            return ret
+        return self.submit(fname, *args).result()
+
+    def read_loop(self):
+        """ receives the replies and completes the corresponding futures,
+        runs in its own thread until the connection is closed """
+        try:
+            while True:
+                (rid, st, ret) = recv_message(self.sock)
+                with self.lock:
+                    fut = self.pending.pop(rid)
+                if not fut.set_running_or_notify_cancel():
+                    # cancelled by the caller, drop the result
+                    continue
+                if st is not None:
+                    fut.set_exception(ServerException(st))
+                else:
+                    fut.set_result(ret)
+        except BaseException as e:
+            with self.lock:
+                self.error = e
+                pending = self.pending
+                self.pending = {}
+            for fut in pending.values():
+                if fut.set_running_or_notify_cancel():
+                    fut.set_exception(ClientExit("connection closed: %s" % e))
+
+    def close(self):
+        """ close the connection, the calls in flight fail """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.reader.join()
+        self.sock.close()
 
     def __getattr__(self,name):
         return lambda *x: self.generic_fun(name,x)
 
 
-def run_server(new_handler, port=PORT, report_to_file=None, v6=False):
+class ClientPool:
+    """
+    Same interface as Client, with nconn connections to the server that
+    are used in turn, so that calls are spread over several sockets.
+
+    Connections that fail are re-opened with an exponential backoff
+    (min_backoff to max_backoff seconds, with jitter), and the calls that
+    were in flight on them are re-sent on another connection up to
+    max_retries times (so the calls should be idempotent, like searches).
+    If health_check_interval is set, a background thread
+    pings the connections at that interval and drops the ones that do not
+    answer within health_check_timeout, so that a restarted server is
+    detected before the next call.
+
+    on_connect(client) is called on each new connection, eg. to restore
+    the server-side settings after a restart.
+    """
+
+    def __init__(self, HOST, port=PORT, v6=False, nconn=1,
+                 connect_timeout=5.0, min_backoff=0.1, max_backoff=10.0,
+                 max_retries=2, health_check_interval=5.0,
+                 health_check_timeout=5.0, on_connect=None):
+        assert nconn > 0
+        self.host, self.port, self.v6 = HOST, port, v6
+        self.connect_timeout = connect_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.health_check_timeout = health_check_timeout
+        self.on_connect = on_connect
+        self.lock = threading.Lock()
+        self.clients = [None] * nconn
+        self.retry_at = [0.0] * nconn
+        self.backoff = [min_backoff] * nconn
+        self.next_conn = 0
+        self.dead = []
+        self.stop = threading.Event()
+        # fail early if the server is not there
+        with self.lock:
+            for i in range(nconn):
+                if not self._connect(i):
+                    raise self.connect_error
+
+        self.health_thread = None
+        if health_check_interval is not None:
+            self.health_thread = threading.Thread(
+                target=self.health_loop, args=(health_check_interval, ),
+                daemon=True)
+            self.health_thread.start()
+
+    def _connect(self, i):
+        """ (re-)open connection i, called with the lock held """
+        try:
+            client = Client(self.host, self.port, self.v6,
+                            self.connect_timeout)
+        except OSError as e:
+            LOG.info("connection to %s:%d failed: %s", self.host, self.port, e)
+            self.connect_error = e
+            self.retry_at[i] = time.time() + \
+                self.backoff[i] * random.uniform(0.5, 1)
+            self.backoff[i] = min(2 * self.backoff[i], self.max_backoff)
+            return False
+        if self.on_connect is not None:
+            try:
+                self.on_connect(client)
+            except BaseException as e:
+                self._discard(client)
+                self.connect_error = e
+                return False
+        self.clients[i] = client
+        self.backoff[i] = self.min_backoff
+        return True
+
+    def _discard(self, client):
+        # may be called from the reader thread of the client, so the socket
+        # is only shut down here and closed later by _close_dead
+        try:
+            client.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.dead.append(client)
+
+    def _close_dead(self):
+        with self.lock:
+            me = threading.current_thread()
+            dead = [c for c in self.dead if c.reader is not me]
+            self.dead = [c for c in self.dead if c.reader is me]
+        for client in dead:
+            client.close()
+
+    def _drop(self, client):
+        with self.lock:
+            for i, c in enumerate(self.clients):
+                if c is client:
+                    self.clients[i] = None
+        self._discard(client)
+
+    def _get_client(self):
+        """ next live connection, re-opens the failed ones whose backoff
+        delay has passed """
+        self._close_dead()
+        with self.lock:
+            n = len(self.clients)
+            for j in range(n):
+                i = (self.next_conn + j) % n
+                client = self.clients[i]
+                if client is not None and client.error is not None:
+                    self._discard(client)
+                    self.clients[i] = client = None
+                if client is None and time.time() >= self.retry_at[i]:
+                    if self._connect(i):
+                        client = self.clients[i]
+                if client is not None:
+                    self.next_conn = i + 1
+                    return client
+        raise ClientExit("no connection to %s:%d" % (self.host, self.port))
+
+    def submit(self, fname, *args):
+        """ same as Client.submit, the call is re-sent if its connection
+        fails """
+        fut = Future()
+        self._submit(fut, self.max_retries, fname, args)
+        return fut
+
+    def _submit(self, fut, nretry, fname, args):
+        while True:
+            try:
+                client = self._get_client()
+            except ClientExit as e:
+                if fut.set_running_or_notify_cancel():
+                    fut.set_exception(e)
+                return
+            try:
+                inner = client.submit(fname, *args)
+                break
+            except (ClientExit, OSError) as e:
+                self._drop(client)
+                if nretry == 0:
+                    if fut.set_running_or_notify_cancel():
+                        fut.set_exception(e)
+                    return
+                nretry -= 1
+
+        def done(inner):
+            e = inner.exception()
+            if isinstance(e, ClientExit) and nretry > 0 and not fut.done():
+                self._drop(client)
+                self._submit(fut, nretry - 1, fname, args)
+            elif fut.set_running_or_notify_cancel():
+                if e is None:
+                    fut.set_result(inner.result())
+                else:
+                    fut.set_exception(e)
+
+        inner.add_done_callback(done)
+
+    def generic_fun(self, fname, args):
+        return self.submit(fname, *args).result()
+
+    def health_loop(self, interval):
+        while not self.stop.wait(interval):
+            self.check_health()
+
+    def check_health(self):
+        """ ping the idle connections and re-open the failed ones """
+        with self.lock:
+            clients = list(self.clients)
+        for i, client in enumerate(clients):
+            if client is None or client.error is not None:
+                with self.lock:
+                    if self.clients[i] is client and \
+                            time.time() >= self.retry_at[i]:
+                        if client is not None:
+                            self._discard(client)
+                        self.clients[i] = None
+                        self._connect(i)
+                continue
+            if client.pending:
+                # busy: a ping would wait behind the calls in flight
+                continue
+            try:
+                client.submit("ping").result(self.health_check_timeout)
+            except Exception as e:
+                LOG.info("health check of %s:%d failed: %s",
+                         self.host, self.port, e)
+                self._drop(client)
+        self._close_dead()
+
+    def nconn_alive(self):
+        with self.lock:
+            return sum(c is not None and c.error is None
+                       for c in self.clients)
+
+    def close(self):
+        self.stop.set()
+        if self.health_thread is not None:
+            self.health_thread.join()
+        with self.lock:
+            clients = [c for c in self.clients if c is not None]
+            self.clients = [None] * len(self.clients)
+        for client in clients:
+            client.close()
+        self._close_dead()
+
+    def __getattr__(self, name):
+        return lambda *x: self.generic_fun(name, x)
+
+
+def run_server(new_handler, port=PORT, report_to_file=None, v6=False,
+               max_workers=None):
+    """
+    accept connections forever, each connection is handled by a Server
+    object returned by new_handler(conn) in its own thread. If max_workers
+    is set, the calls from all connections are run in a pool of that many
+    threads, so that several calls of a client can run concurrently.
+    """
 
     HOST = ''                 # Symbolic name meaning the local host
     socktype = socket.AF_INET6 if v6 else socket.AF_INET
@@ -240,6 +666,10 @@ def run_server(new_handler, port=PORT, report_to_file=None, v6=False):
     s.bind((HOST, port))
     s.listen(5)
 
+    executor = None
+    if max_workers is not None:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
     LOG.info("accepting connections")
     if report_to_file is not None:
         LOG.info('storing host+port in %s', report_to_file)
@@ -255,6 +685,7 @@ def run_server(new_handler, port=PORT, report_to_file=None, v6=False):
         LOG.info('Connected to %s', addr)
 
         ibs = new_handler(conn)
+        ibs.executor = executor
 
         tid = _thread.start_new_thread(ibs.exec_loop,())
 
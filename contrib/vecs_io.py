@@ -6,6 +6,7 @@
 import sys
 import numpy as np
 import os
+from multiprocessing.pool import ThreadPool
 
 """
 I/O functions in fvecs, bvecs, ivecs formats
@@ -13,23 +14,62 @@ definition of the formats here: http://corpus-texmex.irisa.fr/
 """
 
 
-def ivecs_read(fname):
-    a = np.fromfile(fname, dtype='int32')
-    if sys.byteorder == 'big':
-        a.byteswap(inplace=True)
-    d = a[0]
-    return a.reshape(-1, d + 1)[:, 1:].copy()
+def _vecs_records(fname, dtype, mode='r'):
+    """ memory-map the records of a vecs file as an (n, d + header) array
+    of dtype, the header is the dimension, stored as an int32 """
+    with open(fname, 'rb') as f:
+        d = int(np.frombuffer(f.read(4), dtype='<i4')[0])
+    hsize = 4 // np.dtype(dtype).itemsize
+    a = np.memmap(fname, dtype=dtype, mode=mode)
+    assert a.size % (d + hsize) == 0, f"{fname}: size does not match d={d}"
+    return a.reshape(-1, d + hsize), hsize
+
+
+def _vecs_read(fname, dtype, i0, i1, nt, chunk_size):
+    records, hsize = _vecs_records(fname, dtype)
+    n = len(records)
+    i1 = n if i1 is None else min(i1, n)
+    assert 0 <= i0 <= i1
+    # strided view: the vectors are copied once, from the page cache to
+    # the result
+    x = records[i0:i1, hsize:]
+    out = np.empty(x.shape, dtype=dtype)
+
+    def copy_chunk(j0):
+        j1 = min(j0 + chunk_size, len(x))
+        out[j0:j1] = x[j0:j1]
+        if sys.byteorder == 'big' and dtype != 'uint8':
+            out[j0:j1].byteswap(inplace=True)
+
+    chunks = range(0, len(x), chunk_size)
+    if nt > 1:
+        with ThreadPool(nt) as pool:
+            pool.map(copy_chunk, chunks)
+    else:
+        for j0 in chunks:
+            copy_chunk(j0)
+    return out
+
+
+def ivecs_read(fname, i0=0, i1=None, nt=1, chunk_size=65536):
+    """ read vectors i0:i1 of the file (default: all). The file is
+    memory-mapped and copied by chunks of chunk_size vectors, in nt threads,
+    so that only the result is allocated """
+    return _vecs_read(fname, 'int32', i0, i1, nt, chunk_size)
+
+
+def fvecs_read(fname, i0=0, i1=None, nt=1, chunk_size=65536):
+    return _vecs_read(fname, 'float32', i0, i1, nt, chunk_size)
 
 
-def fvecs_read(fname):
-    return ivecs_read(fname).view('float32')
+def bvecs_read(fname, i0=0, i1=None, nt=1, chunk_size=65536):
+    return _vecs_read(fname, 'uint8', i0, i1, nt, chunk_size)
 
 
 def ivecs_mmap(fname):
     assert sys.byteorder != 'big'
-    a = np.memmap(fname, dtype='int32', mode='r')
-    d = a[0]
-    return a.reshape(-1, d + 1)[:, 1:]
+    records, hsize = _vecs_records(fname, 'int32')
+    return records[:, hsize:]
 
 
 def fvecs_mmap(fname):
@@ -37,28 +77,101 @@ def fvecs_mmap(fname):
 
 
 def bvecs_mmap(fname):
-    x = np.memmap(fname, dtype='uint8', mode='r')
-    if sys.byteorder == 'big':
-        da = x[:4][::-1].copy()
-        d = da.view('int32')[0]
-    else:
-        d = x[:4].view('int32')[0]
-    return x.reshape(-1, d + 4)[:, 4:]
+    records, hsize = _vecs_records(fname, 'uint8')
+    return records[:, hsize:]
 
 
-def ivecs_write(fname, m):
+def _vecs_write(fname, m, dtype, nt, chunk_size):
     n, d = m.shape
-    m1 = np.empty((n, d + 1), dtype='int32')
-    m1[:, 0] = d
-    m1[:, 1:] = m
-    if sys.byteorder == 'big':
-        m1.byteswap(inplace=True)
-    m1.tofile(fname)
+    hsize = 4 // np.dtype(dtype).itemsize
+    if n == 0:
+        open(fname, 'wb').close()
+        return
+    records = np.memmap(fname, dtype=dtype, mode='w+', shape=(n, d + hsize))
+    # bit pattern of the dimension
+    header = np.array([d], dtype='<i4').view(dtype)
+
+    def write_chunk(i0):
+        i1 = min(i0 + chunk_size, n)
+        records[i0:i1, :hsize] = header
+        # converts the type by chunk if needed
+        records[i0:i1, hsize:] = m[i0:i1]
+        if sys.byteorder == 'big' and dtype != 'uint8':
+            records[i0:i1, hsize:].byteswap(inplace=True)
+
+    chunks = range(0, n, chunk_size)
+    if nt > 1:
+        with ThreadPool(nt) as pool:
+            pool.map(write_chunk, chunks)
+    else:
+        for i0 in chunks:
+            write_chunk(i0)
+    records.flush()
+    del records
+
+
+def ivecs_write(fname, m, nt=1, chunk_size=65536):
+    """ write the matrix m by chunks of chunk_size vectors, in nt threads,
+    through a memory map of the output file (no full copy of m) """
+    _vecs_write(fname, m, 'int32', nt, chunk_size)
 
 
-def fvecs_write(fname, m):
-    m = m.astype('float32')
-    ivecs_write(fname, m.view('int32'))
+def fvecs_write(fname, m, nt=1, chunk_size=65536):
+    _vecs_write(fname, m, 'float32', nt, chunk_size)
+
+
+def bvecs_write(fname, m, nt=1, chunk_size=65536):
+    _vecs_write(fname, m, 'uint8', nt, chunk_size)
+
+
+def fvecs_iter(fname, batch_size=100_000, i0=0):
+    """ iterate over batches of vectors of the file, as memory-mapped views,
+    starting at vector i0 """
+    assert sys.byteorder != 'big'
+    x = fvecs_mmap(fname)
+    for i0 in range(i0, len(x), batch_size):
+        yield x[i0:i0 + batch_size]
+
+
+def ivecs_iter(fname, batch_size=100_000, i0=0):
+    assert sys.byteorder != 'big'
+    x = ivecs_mmap(fname)
+    for i0 in range(i0, len(x), batch_size):
+        yield x[i0:i0 + batch_size]
+
+
+class VecsWriter:
+    """ write a vecs file by appending batches of vectors, when the whole
+    matrix is not available at once. dtype is float32 (fvecs), int32 (ivecs)
+    or uint8 (bvecs) """
+
+    def __init__(self, fname, dtype='float32'):
+        self.dtype = np.dtype(dtype)
+        self.hsize = 4 // self.dtype.itemsize
+        self.d = None
+        self.f = open(fname, 'wb')
+
+    def write(self, m):
+        n, d = m.shape
+        if self.d is None:
+            self.d = d
+        assert d == self.d
+        records = np.empty((n, d + self.hsize), dtype=self.dtype)
+        records[:, :self.hsize] = np.array([d], dtype='<i4').view(self.dtype)
+        records[:, self.hsize:] = m
+        if sys.byteorder == 'big' and self.dtype != 'uint8':
+            records[:, self.hsize:].byteswap(inplace=True)
+        records.tofile(self.f)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 
 def bvecs_iter(filepath, batch_size=100_000):
     """
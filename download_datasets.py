@@ -12,13 +12,16 @@ def ensure_dir(directory):
 def write_fvecs(filename, vecs):
     """Converts a numpy array of vectors into the standard .fvecs binary format."""
     print(f"Writing {len(vecs)} vectors to {filename}...")
-    vecs = vecs.astype(np.float32)
-    _, d = vecs.shape
+    n, d = vecs.shape
+    chunk_size = 65536
     with open(filename, "wb") as f:
-        for vec in vecs:
+        for i0 in range(0, n, chunk_size):
+            chunk = vecs[i0:i0 + chunk_size]
             # fvecs format: [dimension (int32)] [vector data (float32)]
-            f.write(np.int32(d).tobytes())
-            f.write(vec.tobytes())
+            records = np.empty((len(chunk), d + 1), dtype="<f4")
+            records[:, 0] = np.array([d], dtype="<i4").view("<f4")
+            records[:, 1:] = chunk
+            records.tofile(f)
     print(f"Finished writing {filename}\n")
 
 def download_and_extract_texmex(name, url, output_dir):
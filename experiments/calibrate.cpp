@@ -131,25 +131,27 @@ int main(int argc, char* argv[]) {
     float global_min_dist = std::numeric_limits<float>::max();
     float global_max_dist = 0.0f;
     
-    std::vector<float> distances(nq_calib * k);
-    std::vector<faiss::idx_t> labels(nq_calib * k);
+    // all efSearch values are covered by one resumed traversal per query
+    std::vector<float> schedule(efSearch_values.begin(), efSearch_values.end());
+    std::vector<float> distances(nq_calib * num_ef * k);
+    std::vector<faiss::idx_t> labels(nq_calib * num_ef * k);
 
     std::cout << "Building Non-Conformity Matrix across " << num_ef << " efSearch values..." << std::endl;
+    index.search_checkpoints(
+            nq_calib, calib_queries, k, num_ef, schedule.data(),
+            distances.data(), labels.data());
+
     for (size_t col = 0; col < num_ef; ++col) {
-        int ef = efSearch_values[col];
-        index.hnsw.efSearch = ef; 
-        
-        index.search(nq_calib, calib_queries, k, distances.data(), labels.data());
-        
         for (size_t row = 0; row < nq_calib; ++row) {
-            float dist_k = distances[row * k + (k - 1)];
+            size_t ofs = (row * num_ef + col) * k;
+            float dist_k = distances[ofs + (k - 1)];
             nonconf_matrix[row][col] = dist_k;
             
             if (dist_k < global_min_dist) global_min_dist = dist_k;
             if (dist_k > global_max_dist) global_max_dist = dist_k;
             
             for (int j = 0; j < k; ++j) {
-                all_preds_list[row][col][j] = labels[row * k + j];
+                all_preds_list[row][col][j] = labels[ofs + j];
             }
         }
     }
@@ -5,6 +5,7 @@
 #include <cstring>
 #include <sys/stat.h>
 #include <chrono>
+#include <map>
 
 #include <faiss/IndexHNSW.h>
 #include <faiss/impl/HNSW.h>
@@ -79,10 +80,16 @@ int main(int argc, char** argv) {
     std::vector<faiss::idx_t> I(n_queries * k);
     std::vector<float> D(n_queries * k);
 
+    // record the convergence of every query in memory
+    faiss::HNSWSearchTrace trace(1 << 20);
+    faiss::SearchParametersHNSW params;
+    params.efSearch = efSearch;
+    params.trace = &trace;
+
     // --- TIMING START ---
     auto start = std::chrono::high_resolution_clock::now();
     
-    index.search(n_queries, xq, k, D.data(), I.data());
+    index.search(n_queries, xq, k, D.data(), I.data(), &params);
     
     auto end = std::chrono::high_resolution_clock::now();
     // --- TIMING END ---
@@ -106,6 +113,39 @@ int main(int argc, char** argv) {
         std::cerr << "Error writing " << result_dir << "/" << exp_name << ".bin" << std::endl;
     }
 
+    // 7. Dump the traces, one CSV per query: ndis, current k-th distance
+    size_t nrec = trace.nrecords();
+    std::vector<faiss::idx_t> rec_query(nrec);
+    std::vector<int32_t> rec_nstep(nrec), rec_ncand(nrec);
+    std::vector<int64_t> rec_ndis(nrec);
+    std::vector<float> rec_threshold(nrec);
+    trace.get_records(
+            rec_query.data(),
+            rec_nstep.data(),
+            rec_ncand.data(),
+            rec_ndis.data(),
+            rec_threshold.data());
+    std::map<faiss::idx_t, FILE*> logs;
+    for (size_t i = 0; i < nrec; i++) {
+        FILE*& f_log = logs[rec_query[i]];
+        if (!f_log) {
+            std::string fname = result_dir + "/log_q_" +
+                    std::to_string(rec_query[i]) + ".csv";
+            f_log = fopen(fname.c_str(), "w");
+            if (!f_log) {
+                std::cerr << "Error writing " << fname << std::endl;
+                break;
+            }
+            fprintf(f_log, "ndis,radius\n");
+        }
+        fprintf(f_log, "%ld,%g\n", long(rec_ndis[i]), rec_threshold[i]);
+    }
+    for (auto& it : logs) {
+        if (it.second) {
+            fclose(it.second);
+        }
+    }
+
     delete[] xb;
     delete[] xq;
     return 0;
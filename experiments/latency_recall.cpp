@@ -145,29 +145,32 @@ int main(int argc, char** argv) {
 
     for (const auto& [term_method, sweep_values] : sweep_configs) {
         std::cout << "\n[C++] Starting sweep for method: " << term_method << std::endl;
-        setenv("HNSW_TERMINATION_METHOD", term_method.c_str(), 1);
 
         for (float val : sweep_values) {
             // Configure the specific limits
+            faiss::SearchParametersHNSW params;
             if (term_method == "ef_search") {
-                index.hnsw.efSearch = (int)val;
+                params.efSearch = (int)val;
             } 
             else if (term_method == "patience") {
-                index.hnsw.efSearch = std::max(2000, k); // Infinite queue
-                setenv("HNSW_PATIENCE", std::to_string((int)val).c_str(), 1);
+                params.efSearch = std::max(2000, k); // Infinite queue
+                params.termination_method = faiss::HNSW_TERMINATION_PATIENCE;
+                params.patience = (int)val;
             } 
             else if (term_method == "hardlimit") {
-                index.hnsw.efSearch = std::max(3000, k); // Infinite queue
-                setenv("HNSW_HARDLIMIT_MAX_NODES", std::to_string((int)val).c_str(), 1);
+                params.efSearch = std::max(3000, k); // Infinite queue
+                params.termination_method = faiss::HNSW_TERMINATION_HARDLIMIT;
+                params.hardlimit_max_nodes = (int)val;
             } 
             else if (term_method == "radiuslimit") {
-                index.hnsw.efSearch = std::max(2000, k); // Infinite queue
-                setenv("HNSW_RADIUSLIMIT_RADIUS", std::to_string(val).c_str(), 1);
+                params.efSearch = std::max(2000, k); // Infinite queue
+                params.termination_method = faiss::HNSW_TERMINATION_RADIUSLIMIT;
+                params.radiuslimit_radius = val;
             }
 
             // Execute Search & Measure Time
             auto start = std::chrono::high_resolution_clock::now();
-            index.search(nq, xq, k, D.data(), I.data());
+            index.search(nq, xq, k, D.data(), I.data(), &params);
             auto end = std::chrono::high_resolution_clock::now();
 
             double duration_ms = std::chrono::duration<double, std::milli>(end - start).count();
@@ -75,27 +75,31 @@ float calculate_fnr(const faiss::idx_t* preds, const int* gt_row, int k) {
             (static_cast<float>(intersection_size) / static_cast<float>(k));
 }
 
-// Set termination environment correctly 
-void set_termination_env(faiss::IndexHNSWFlat& index, faiss::SearchParametersHNSW& hnsw_params, 
+// Set termination parameters for one sweep value
+void set_termination_params(faiss::IndexHNSWFlat& index, faiss::SearchParametersHNSW& hnsw_params, 
                          const std::string& term_method, float val, int k) {
     if (term_method == "ef_search") {
         index.hnsw.efSearch = (int)val;
         hnsw_params.efSearch = (int)val;
+        hnsw_params.termination_method = faiss::HNSW_TERMINATION_EF_SEARCH;
     } else if (term_method == "patience") {
         int queue_size = std::max(2000, k);
         index.hnsw.efSearch = queue_size;
         hnsw_params.efSearch = queue_size;
-        setenv("HNSW_PATIENCE", std::to_string((int)val).c_str(), 1);
+        hnsw_params.termination_method = faiss::HNSW_TERMINATION_PATIENCE;
+        hnsw_params.patience = (int)val;
     } else if (term_method == "hardlimit") {
         int queue_size = std::max(3000, k);
         index.hnsw.efSearch = queue_size;
         hnsw_params.efSearch = queue_size;
-        setenv("HNSW_HARDLIMIT_MAX_NODES", std::to_string((int)val).c_str(), 1);
+        hnsw_params.termination_method = faiss::HNSW_TERMINATION_HARDLIMIT;
+        hnsw_params.hardlimit_max_nodes = (int)val;
     } else if (term_method == "radiuslimit") {
         int queue_size = std::max(2000, k);
         index.hnsw.efSearch = queue_size;
         hnsw_params.efSearch = queue_size;
-        setenv("HNSW_RADIUSLIMIT_RADIUS", std::to_string(val).c_str(), 1);
+        hnsw_params.termination_method = faiss::HNSW_TERMINATION_RADIUSLIMIT;
+        hnsw_params.radiuslimit_radius = val;
     }
 }
 
@@ -152,8 +156,15 @@ void search_hnsw_conann_batch(
             active_caches[i] = &all_caches[orig_idx];
         }
 
+        // the hardlimit schedule is a cumulative budget (as in
+        // search_checkpoints), each resumed step only gets the increment
+        float step_val = current_val;
+        if (params.term_method == "hardlimit" && p > 0) {
+            step_val -= params.sweep_schedule[p - 1];
+        }
+
         faiss::SearchParametersHNSW hnsw_params;
-        set_termination_env(index, hnsw_params, params.term_method, current_val, k);
+        set_termination_params(index, hnsw_params, params.term_method, step_val, k);
 
         index.search_resume(
                 num_active,
@@ -310,8 +321,6 @@ int main(int argc, char* argv[]) {
         return -1;
     }
 
-    setenv("HNSW_TERMINATION_METHOD", term_method.c_str(), 1);
-
     // -------------------------------------------------------------
     // STEP 2: Build the HNSW Index
     // -------------------------------------------------------------
@@ -319,11 +328,6 @@ int main(int argc, char* argv[]) {
     faiss::IndexHNSWFlat index(d_base, M);
     index.hnsw.efConstruction = 300;
 
-    std::vector<faiss::HNSWSearchCache> calib_caches;
-    for (size_t i = 0; i < nq_calib; ++i) {
-        calib_caches.emplace_back(2000); 
-    }
-
     std::cerr << "2. Building HNSW index on " << nb << " vectors..." << std::endl;
     index.add(nb, xb);
 
@@ -356,41 +360,37 @@ int main(int argc, char* argv[]) {
     float global_min_dist = std::numeric_limits<float>::max();
     float global_max_dist = 0.0f;
 
-    std::vector<float> distances(nq_calib * k);
-    std::vector<faiss::idx_t> labels(nq_calib * k);
     faiss::SearchParametersHNSW hnsw_params;
 
     std::cerr << "3. Running Calibration (Building Non-Conformity Matrix for " << term_method << ")..." << std::endl;
-    for (size_t col = 0; col < num_steps; ++col) {
-        float val = sweep_schedule[col];
-        
-        set_termination_env(index, hnsw_params, term_method, val, k);
-
-        std::vector<faiss::HNSWSearchCache*> batch_calib_caches(nq_calib);
-        for (size_t i = 0; i < nq_calib; i++) {
-            batch_calib_caches[i] = &calib_caches[i];
-        }
-
-        index.search_resume(
-                nq_calib,
-                calib_queries,
-                k,
-                distances.data(),
-                labels.data(),
-                batch_calib_caches,
-                reinterpret_cast<faiss::SearchParameters*>(&hnsw_params));
+    // one resumed traversal per query, snapshotted at every schedule value
+    set_termination_params(index, hnsw_params, term_method, sweep_schedule.back(), k);
+    std::vector<float> ckpt_distances(nq_calib * num_steps * k);
+    std::vector<faiss::idx_t> ckpt_labels(nq_calib * num_steps * k);
+    index.search_checkpoints(
+            nq_calib,
+            calib_queries,
+            k,
+            num_steps,
+            sweep_schedule.data(),
+            ckpt_distances.data(),
+            ckpt_labels.data(),
+            &hnsw_params);
 
+    for (size_t col = 0; col < num_steps; ++col) {
         for (size_t row = 0; row < nq_calib; ++row) {
-            float dist_k = distances[row * k + (k - 1)];
+            const float* distances = &ckpt_distances[(row * num_steps + col) * k];
+            const faiss::idx_t* labels = &ckpt_labels[(row * num_steps + col) * k];
+            float dist_k = distances[k - 1];
             nonconf_matrix[row][col] = dist_k;
 
-            if (dist_k < std::numeric_limits<float>::max() && labels[row * k + (k-1)] != -1) {
+            if (dist_k < std::numeric_limits<float>::max() && labels[k - 1] != -1) {
                 if (dist_k < global_min_dist) global_min_dist = dist_k;
                 if (dist_k > global_max_dist) global_max_dist = dist_k;
             }
 
             for (int j = 0; j < k; ++j) {
-                all_preds_list[row][col][j] = labels[row * k + j];
+                all_preds_list[row][col][j] = labels[j];
             }
         }
     }
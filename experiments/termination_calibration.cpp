@@ -158,9 +158,6 @@ int main(int argc, char** argv) {
     // =========================================================================
     std::cout << "[Calibration] Building HNSW Index for hop counting..." << std::endl;
     
-    // Ensure we are using standard ef_search termination logic
-    setenv("HNSW_TERMINATION_METHOD", "ef_search", 1);
-    
     faiss::IndexHNSWFlat index(d_base, M);
     index.hnsw.efConstruction = efConstruction;
     index.hnsw.efSearch = efSearch;
@@ -8,6 +8,7 @@
 #include <faiss/IVFlib.h>
 #include <omp.h>
 
+#include <cstring>
 #include <memory>
 
 #include <faiss/IndexAdditiveQuantizer.h>
@@ -548,6 +549,82 @@ void ivf_residual_add_from_flat_codes(
     index->ntotal += nb;
 }
 
+void gather_bucket_queries(
+        size_t n,
+        const idx_t* subset,
+        size_t d,
+        const float* xq,
+        const float* centroid,
+        float* xq_out) {
+#pragma omp parallel for if (n * d > 100000)
+    for (int64_t i = 0; i < n; i++) {
+        const float* src = xq + subset[i] * d;
+        float* dst = xq_out + i * d;
+        if (centroid) {
+            for (size_t j = 0; j < d; j++) {
+                dst[j] = src[j] - centroid[j];
+            }
+        } else {
+            memcpy(dst, src, sizeof(float) * d);
+        }
+    }
+}
+
+namespace {
+
+template <class C>
+void add_bucket_results_to_heap_tpl(
+        HeapArray<C>* heaps,
+        size_t n,
+        const idx_t* subset,
+        size_t nres,
+        const float* D,
+        const idx_t* I,
+        const idx_t* list_ids) {
+    size_t k = heaps->k;
+#pragma omp parallel for if (n * nres > 100000)
+    for (int64_t i = 0; i < n; i++) {
+        float* simi = heaps->get_val(subset[i]);
+        idx_t* idxi = heaps->get_ids(subset[i]);
+        const float* Di = D + i * nres;
+        const idx_t* Ii = I ? I + i * nres : nullptr;
+        for (size_t j = 0; j < nres; j++) {
+            if (!C::cmp(simi[0], Di[j])) {
+                continue;
+            }
+            idx_t ofs = Ii ? Ii[j] : j;
+            if (ofs < 0) {
+                continue;
+            }
+            heap_replace_top<C>(k, simi, idxi, Di[j], list_ids[ofs]);
+        }
+    }
+}
+
+} // anonymous namespace
+
+void add_bucket_results_to_heap(
+        float_maxheap_array_t* heaps,
+        size_t n,
+        const idx_t* subset,
+        size_t nres,
+        const float* D,
+        const idx_t* I,
+        const idx_t* list_ids) {
+    add_bucket_results_to_heap_tpl(heaps, n, subset, nres, D, I, list_ids);
+}
+
+void add_bucket_results_to_heap(
+        float_minheap_array_t* heaps,
+        size_t n,
+        const idx_t* subset,
+        size_t nres,
+        const float* D,
+        const idx_t* I,
+        const idx_t* list_ids) {
+    add_bucket_results_to_heap_tpl(heaps, n, subset, nres, D, I, list_ids);
+}
+
 int64_t DefaultShardingFunction::operator()(int64_t i, int64_t shard_count) {
     return i % shard_count;
 }
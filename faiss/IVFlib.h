@@ -168,6 +168,51 @@ void ivf_residual_add_from_flat_codes(
         const uint8_t* codes,
         int64_t code_size = -1);
 
+/** Gather the queries assigned to one inverted list, for searches that
+ * process the queries bucket by bucket (contrib/big_batch_search.py):
+ * xq_out[i] = xq[subset[i]] - centroid
+ *
+ * @param subset    query numbers, size n
+ * @param xq        all queries, size (nq, d)
+ * @param centroid  vector to subtract (by_residual), size d, or null
+ * @param xq_out    output, size (n, d)
+ */
+void gather_bucket_queries(
+        size_t n,
+        const idx_t* subset,
+        size_t d,
+        const float* xq,
+        const float* centroid,
+        float* xq_out);
+
+/** Add the results of the queries of one inverted list to a heap array.
+ * Result j of query i is D[i * nres + j], its id is list_ids[I[i * nres + j]]
+ * (I entries < 0 are ignored), or list_ids[j] if I is null (D is then a
+ * full distance matrix).
+ *
+ * @param subset    heaps to update, size n, no duplicates
+ * @param D         distances, size (n, nres)
+ * @param I         offsets in the list, size (n, nres), or null
+ * @param list_ids  ids of the inverted list
+ */
+void add_bucket_results_to_heap(
+        float_maxheap_array_t* heaps,
+        size_t n,
+        const idx_t* subset,
+        size_t nres,
+        const float* D,
+        const idx_t* I,
+        const idx_t* list_ids);
+
+void add_bucket_results_to_heap(
+        float_minheap_array_t* heaps,
+        size_t n,
+        const idx_t* subset,
+        size_t nres,
+        const float* D,
+        const idx_t* I,
+        const idx_t* list_ids);
+
 struct ShardingFunction {
     virtual int64_t operator()(int64_t i, int64_t shard_count) = 0;
     virtual ~ShardingFunction() = default;
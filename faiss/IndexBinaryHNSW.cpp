@@ -386,6 +386,12 @@ void IndexBinaryHNSWCagra::search(
                     nearest[i] >= 0, "Could not find a valid entrypoint.");
         }
 
+        HNSWSearchTrace* trace = nullptr;
+        if (const SearchParametersHNSW* hnsw_params =
+                    dynamic_cast<const SearchParametersHNSW*>(params)) {
+            trace = hnsw_params->trace;
+        }
+
 #pragma omp parallel
         {
             VisitedTable vt(ntotal);
@@ -397,6 +403,9 @@ void IndexBinaryHNSWCagra::search(
             for (idx_t i = 0; i < n; i++) {
                 res.begin(i);
                 dis->set_query((float*)(x + i * code_size));
+                if (trace) {
+                    trace->begin_query(i);
+                }
 
                 hnsw.search_level_0(
                         *dis,
@@ -15,6 +15,7 @@
 
 #include <limits>
 #include <memory>
+#include <numeric>
 #include <queue>
 #include <random>
 
@@ -23,9 +24,11 @@
 
 #include <faiss/Index2Layer.h>
 #include <faiss/IndexFlat.h>
+#include <faiss/IndexIDMap.h>
 #include <faiss/IndexIVFPQ.h>
 #include <faiss/impl/AuxIndexStructures.h>
 #include <faiss/impl/FaissAssert.h>
+#include <faiss/impl/IDSelector.h>
 #include <faiss/impl/ResultHandler.h>
 #include <faiss/utils/random.h>
 #include <faiss/utils/sorting.h>
@@ -52,6 +55,75 @@ DistanceComputer* storage_distance_computer(const Index* storage) {
     }
 }
 
+/// throw before entering the parallel search loops
+void check_termination_params(const SearchParametersHNSW& params) {
+    FAISS_THROW_IF_NOT_MSG(
+            params.termination_method != HNSW_TERMINATION_CUSTOM ||
+                    params.termination_callback,
+            "HNSW_TERMINATION_CUSTOM requires a termination_callback");
+    if (params.termination_method == HNSW_TERMINATION_CONFORMAL) {
+        const HNSWConformalTermination* conformal = params.conformal;
+        FAISS_THROW_IF_NOT_MSG(
+                conformal, "HNSW_TERMINATION_CONFORMAL requires conformal");
+        FAISS_THROW_IF_NOT_MSG(
+                conformal->schedule_method >= HNSW_TERMINATION_EF_SEARCH &&
+                        conformal->schedule_method <=
+                                HNSW_TERMINATION_RADIUSLIMIT,
+                "invalid conformal schedule_method");
+        const std::vector<float>& schedule = conformal->schedule;
+        FAISS_THROW_IF_NOT_MSG(
+                !schedule.empty(), "the conformal schedule is empty");
+        for (size_t c = 1; c < schedule.size(); c++) {
+            FAISS_THROW_IF_NOT_MSG(
+                    schedule[c] >= schedule[c - 1],
+                    "the schedule should be non-decreasing");
+        }
+    }
+}
+
+/** While in scope, the IDSelector of the search parameters, that is in
+ * terms of labels, is replaced with a selector on the stored positions
+ * (hence the const_cast, as in IndexIDMap). No-op without a label map. */
+struct ScopedLabelSelector {
+    IDSelectorTranslated translated;
+    SearchParameters* params = nullptr;
+    IDSelector* old_sel = nullptr;
+
+    ScopedLabelSelector(
+            const std::vector<idx_t>& label_map,
+            const SearchParameters* search_params)
+            : translated(label_map, nullptr) {
+        if (!label_map.empty() && search_params && search_params->sel) {
+            params = const_cast<SearchParameters*>(search_params);
+            old_sel = params->sel;
+            translated.sel = old_sel;
+            params->sel = &translated;
+        }
+    }
+
+    ~ScopedLabelSelector() {
+        if (params) {
+            params->sel = old_sel;
+        }
+    }
+};
+
+/// replace the stored positions in the results with their labels
+void apply_label_map(
+        const std::vector<idx_t>& label_map,
+        size_t n,
+        idx_t* labels) {
+    if (label_map.empty()) {
+        return;
+    }
+#pragma omp parallel for if (n > 10000)
+    for (int64_t i = 0; i < int64_t(n); i++) {
+        if (labels[i] >= 0) {
+            labels[i] = label_map[labels[i]];
+        }
+    }
+}
+
 void hnsw_add_vertices(
         IndexHNSW& index_hnsw,
         size_t n0,
@@ -81,8 +153,14 @@ void hnsw_add_vertices(
         printf("  max_level = %d\n", max_level);
     }
 
-    std::vector<omp_lock_t> locks(ntotal);
-    for (int i = 0; i < ntotal; i++) {
+    // either one lock per vertex or a fixed table of striped locks
+    bool striped = index_hnsw.add_lock_stripes > 0;
+    std::unique_ptr<HNSWStripedLocks> striped_locks;
+    std::vector<omp_lock_t> locks(striped ? 0 : ntotal);
+    if (striped) {
+        striped_locks.reset(new HNSWStripedLocks(index_hnsw.add_lock_stripes));
+    }
+    for (size_t i = 0; i < locks.size(); i++) {
         omp_init_lock(&locks[i]);
     }
 
@@ -163,13 +241,25 @@ void hnsw_add_vertices(
                         continue;
                     }
 
-                    hnsw.add_with_locks(
-                            *dis,
-                            pt_level,
-                            pt_id,
-                            locks,
-                            vt,
-                            index_hnsw.keep_max_size_level0 && (pt_level == 0));
+                    bool keep_max_size_level0 =
+                            index_hnsw.keep_max_size_level0 && (pt_level == 0);
+                    if (striped) {
+                        hnsw.add_with_striped_locks(
+                                *dis,
+                                pt_level,
+                                pt_id,
+                                *striped_locks,
+                                vt,
+                                keep_max_size_level0);
+                    } else {
+                        hnsw.add_with_locks(
+                                *dis,
+                                pt_level,
+                                pt_id,
+                                locks,
+                                vt,
+                                keep_max_size_level0);
+                    }
 
                     if (prev_display >= 0 && i - i0 > prev_display + 10000) {
                         prev_display = i - i0;
@@ -199,7 +289,7 @@ void hnsw_add_vertices(
         printf("Done in %.3f ms\n", getmillisecs() - t0);
     }
 
-    for (int i = 0; i < ntotal; i++) {
+    for (size_t i = 0; i < locks.size(); i++) {
         omp_destroy_lock(&locks[i]);
     }
 }
@@ -222,6 +312,9 @@ IndexHNSW::~IndexHNSW() {
     if (own_fields) {
         delete storage;
     }
+    if (own_prefilter) {
+        delete prefilter;
+    }
 }
 
 void IndexHNSW::train(idx_t n, const float* x) {
@@ -230,6 +323,9 @@ void IndexHNSW::train(idx_t n, const float* x) {
             "Please use IndexHNSWFlat (or variants) instead of IndexHNSW directly");
     // hnsw structure does not require training
     storage->train(n, x);
+    if (prefilter && !prefilter->is_trained) {
+        prefilter->train(n, x);
+    }
     is_trained = true;
 }
 
@@ -249,12 +345,34 @@ void hnsw_search(
     const HNSW& hnsw = index->hnsw;
 
     int efSearch = hnsw.efSearch;
+    HNSWSearchTrace* trace = nullptr;
     if (params) {
         if (const SearchParametersHNSW* hnsw_params =
                     dynamic_cast<const SearchParametersHNSW*>(params)) {
             efSearch = hnsw_params->efSearch;
+            trace = hnsw_params->trace;
+            check_termination_params(*hnsw_params);
+            FAISS_THROW_IF_NOT_MSG(
+                    hnsw_params->termination_method !=
+                            HNSW_TERMINATION_CONFORMAL,
+                    "conformal termination is only supported by "
+                    "IndexHNSW::search");
         }
     }
+    const Index* prefilter = index->prefilter;
+    if (prefilter) {
+        FAISS_THROW_IF_NOT_MSG(
+                prefilter->ntotal == index->ntotal &&
+                        prefilter->metric_type == index->metric_type,
+                "prefilter does not contain the same vectors");
+        const SearchParametersHNSW* hnsw_params =
+                dynamic_cast<const SearchParametersHNSW*>(params);
+        FAISS_THROW_IF_NOT_MSG(
+                !hnsw.is_panorama &&
+                        (hnsw_params ? hnsw_params->bounded_queue
+                                     : hnsw.search_bounded_queue),
+                "prefilter needs a bounded queue and no Panorama");
+    }
     size_t n1 = 0, n2 = 0, ndis = 0, nhops = 0;
 
     idx_t check_period = InterruptCallback::get_period_hint(
@@ -270,13 +388,23 @@ void hnsw_search(
 
             std::unique_ptr<DistanceComputer> dis(
                     storage_distance_computer(index->storage));
+            std::unique_ptr<DistanceComputer> approx_dis(
+                    prefilter ? storage_distance_computer(prefilter)
+                              : nullptr);
 
 #pragma omp for reduction(+ : n1, n2, ndis, nhops) schedule(guided)
             for (idx_t i = i0; i < i1; i++) {
                 res.begin(i);
                 dis->set_query(x + i * index->d);
+                if (approx_dis) {
+                    approx_dis->set_query(x + i * index->d);
+                }
+                if (trace) {
+                    trace->begin_query(i);
+                }
 
-                HNSWStats stats = hnsw.search(*dis, index, res, vt, params);
+                HNSWStats stats = hnsw.search(
+                        *dis, index, res, vt, params, approx_dis.get());
                 n1 += stats.n1;
                 n2 += stats.n2;
                 ndis += stats.ndis;
@@ -315,6 +443,195 @@ namespace {
             return false;
         }
     };
+
+    /// size of the candidate queue needed to reach the last checkpoint
+    int checkpoint_queue_size(
+            HNSWTerminationMethod method,
+            float last_effort,
+            int efSearch,
+            idx_t k) {
+        int queue_size = method == HNSW_TERMINATION_EF_SEARCH
+                ? int(last_effort)
+                : efSearch;
+        return std::max(queue_size, int(k));
+    }
+
+    /** Resume the search of one query up to the effort val of a schedule
+     * interpreted with method. step_params holds the parameters of the
+     * search, its termination fields are overwritten. */
+    HNSWStats resume_to_checkpoint(
+            const HNSW& hnsw,
+            DistanceComputer& dis,
+            ResumeSingleResultHandler& res,
+            HNSWSearchCache& cache,
+            HNSWTerminationMethod method,
+            float val,
+            SearchParametersHNSW& step_params) {
+        int ef = step_params.efSearch;
+        switch (method) {
+            case HNSW_TERMINATION_EF_SEARCH:
+                ef = int(val);
+                break;
+            case HNSW_TERMINATION_PATIENCE:
+                step_params.patience = int(val);
+                break;
+            case HNSW_TERMINATION_HARDLIMIT:
+                // the budget is cumulative over the schedule
+                step_params.hardlimit_max_nodes = int(val) - cache.nstep;
+                if (step_params.hardlimit_max_nodes <= 0) {
+                    return HNSWStats();
+                }
+                break;
+            case HNSW_TERMINATION_RADIUSLIMIT:
+                step_params.radiuslimit_radius = val;
+                break;
+            default:
+                FAISS_ASSERT(false);
+        }
+        step_params.termination_method = method;
+        return hnsw.search_resume(dis, res, cache, ef, &step_params);
+    }
+
+    /** Search where each query is resumed through the schedule of
+     * params.conformal until its non-conformity score crosses lambda_hat.
+     * The distances are output as stored in the HNSW (ie. negated for
+     * similarity metrics). */
+    void hnsw_search_conformal(
+            const IndexHNSW& index,
+            idx_t n,
+            const float* x,
+            idx_t k,
+            float* distances,
+            idx_t* labels,
+            const SearchParametersHNSW& params) {
+        const HNSW& hnsw = index.hnsw;
+        const HNSWConformalTermination& conformal = *params.conformal;
+        const std::vector<float>& schedule = conformal.schedule;
+        HNSWTerminationMethod method = conformal.schedule_method;
+        bool is_similarity = is_similarity_metric(index.metric_type);
+        int queue_size = checkpoint_queue_size(
+                method, schedule.back(), params.efSearch, k);
+
+        size_t n1 = 0, n2 = 0, ndis = 0, nhops = 0;
+
+#pragma omp parallel if (n > 1)
+        {
+            std::unique_ptr<DistanceComputer> dis(
+                    storage_distance_computer(index.storage));
+            HNSWSearchCache cache(queue_size);
+            cache.resize_visited(index.ntotal);
+            SearchParametersHNSW step_params = params;
+
+#pragma omp for reduction(+ : n1, n2, ndis, nhops) schedule(guided)
+            for (idx_t i = 0; i < n; i++) {
+                float* heap_dis = distances + i * k;
+                idx_t* heap_ids = labels + i * k;
+                dis->set_query(x + i * index.d);
+                cache.initialized = false;
+                heap_heapify<HNSW::C>(k, heap_dis, heap_ids);
+                ResumeSingleResultHandler res(k, heap_dis, heap_ids);
+
+                for (size_t c = 0; c < schedule.size(); c++) {
+                    HNSWStats stats = resume_to_checkpoint(
+                            hnsw,
+                            *dis,
+                            res,
+                            cache,
+                            method,
+                            schedule[c],
+                            step_params);
+                    ndis += stats.ndis;
+                    nhops += stats.nhops;
+
+                    // the k-th result is at the top of the heap
+                    float dist_k = is_similarity ? -heap_dis[0] : heap_dis[0];
+                    if (conformal.score(dist_k, heap_ids[0] >= 0, c) >
+                        conformal.lambda_hat) {
+                        break;
+                    }
+                }
+                heap_reorder<HNSW::C>(k, heap_dis, heap_ids);
+                n1++;
+                if (cache.candidates.size() == 0) {
+                    n2++;
+                }
+            }
+        }
+
+        hnsw_stats.combine({n1, n2, ndis, nhops});
+    }
+
+    /** Search where each thread advances params.n_interleave queries in
+     * lockstep, see HNSW::search_interleaved. Each query of a group needs
+     * its own visited table. */
+    void hnsw_search_interleaved(
+            const IndexHNSW& index,
+            idx_t n,
+            const float* x,
+            idx_t k,
+            float* distances,
+            idx_t* labels,
+            const SearchParametersHNSW& params) {
+        const HNSW& hnsw = index.hnsw;
+        int group = params.n_interleave;
+        using RH = HeapBlockResultHandler<HNSW::C>;
+        RH bres(n, distances, labels, k);
+
+        size_t n1 = 0, n2 = 0, ndis = 0, nhops = 0;
+
+        idx_t check_period = InterruptCallback::get_period_hint(
+                hnsw.max_level * index.d * params.efSearch);
+        check_period = (check_period + group - 1) / group * group;
+
+        for (idx_t i0 = 0; i0 < n; i0 += check_period) {
+            idx_t i1 = std::min(i0 + check_period, n);
+
+#pragma omp parallel if (i1 - i0 > group)
+            {
+                std::vector<std::unique_ptr<DistanceComputer>> dis(group);
+                std::vector<std::unique_ptr<VisitedTable>> vt(group);
+                std::vector<RH::SingleResultHandler> res(
+                        group, RH::SingleResultHandler(bres));
+                std::vector<DistanceComputer*> dis_ptrs(group);
+                std::vector<VisitedTable*> vt_ptrs(group);
+                std::vector<ResultHandler*> res_ptrs(group);
+                for (int q = 0; q < group; q++) {
+                    dis[q].reset(storage_distance_computer(index.storage));
+                    vt[q].reset(new VisitedTable(index.ntotal));
+                    dis_ptrs[q] = dis[q].get();
+                    vt_ptrs[q] = vt[q].get();
+                    res_ptrs[q] = &res[q];
+                }
+
+#pragma omp for reduction(+ : n1, n2, ndis, nhops) schedule(guided)
+                for (idx_t j0 = i0; j0 < i1; j0 += group) {
+                    int nq = std::min(idx_t(group), i1 - j0);
+                    for (int q = 0; q < nq; q++) {
+                        res[q].begin(j0 + q);
+                        dis[q]->set_query(x + (j0 + q) * index.d);
+                    }
+
+                    HNSWStats stats = hnsw.search_interleaved(
+                            nq,
+                            dis_ptrs.data(),
+                            res_ptrs.data(),
+                            vt_ptrs.data(),
+                            &params);
+                    n1 += stats.n1;
+                    n2 += stats.n2;
+                    ndis += stats.ndis;
+                    nhops += stats.nhops;
+
+                    for (int q = 0; q < nq; q++) {
+                        res[q].end();
+                    }
+                }
+            }
+            InterruptCallback::check();
+        }
+
+        hnsw_stats.combine({n1, n2, ndis, nhops});
+    }
 } // anonymous namespace
 
 // -------------------------------------------------------------
@@ -323,14 +640,29 @@ namespace {
 HNSWStats IndexHNSW::search_resume(
         idx_t n, const float* x, idx_t k, float* distances, idx_t* labels, 
         std::vector<HNSWSearchCache*>& caches, const SearchParameters* params) const {
+    FAISS_THROW_IF_NOT_MSG(
+            !hnsw.is_panorama, "search_resume does not support Panorama");
 
-    // Safely resize VisitedTable for each query
+    // the dense visited tables need one entry per vector
     for (idx_t i = 0; i < n; i++) {
-        if (caches[i]->vt.visited.size() < ntotal) {
-            caches[i]->vt.visited.resize(ntotal, 0);
-        }
+        caches[i]->resize_visited(ntotal);
     }
         
+    int efSearch = hnsw.efSearch;
+    if (params) {
+        if (const SearchParametersHNSW* hnsw_params =
+                    dynamic_cast<const SearchParametersHNSW*>(params)) {
+            efSearch = hnsw_params->efSearch;
+            check_termination_params(*hnsw_params);
+            FAISS_THROW_IF_NOT_MSG(
+                    hnsw_params->termination_method !=
+                            HNSW_TERMINATION_CONFORMAL,
+                    "conformal termination is not supported by "
+                    "search_resume");
+        }
+    }
+
+    ScopedLabelSelector label_sel(label_map, params);
     HNSWStats total_stats;
     size_t total_n1 = 0, total_n2 = 0, total_ndis = 0, total_nhops = 0;
 
@@ -344,6 +676,12 @@ HNSWStats IndexHNSW::search_resume(
             
             HNSWSearchCache& cache = *(caches[i]);
 
+            // the top-k heap of the cache is sized for the k of the first
+            // call, a different k restarts the search
+            if (cache.initialized && cache.topk_distances.size() != size_t(k)) {
+                cache.initialized = false;
+            }
+
             if (!cache.initialized) {
                 cache.topk_distances.resize(k);
                 cache.topk_labels.resize(k);
@@ -353,9 +691,8 @@ HNSWStats IndexHNSW::search_resume(
 
             ResumeSingleResultHandler res(k, cache.topk_distances.data(), cache.topk_labels.data());
 
-            // int ef = std::max(hnsw.efSearch, k);
-
-            HNSWStats stats = hnsw.search_resume(*dis, res, cache, hnsw.efSearch, params);
+            HNSWStats stats =
+                    hnsw.search_resume(*dis, res, cache, efSearch, params);
             
             std::memcpy(distances + i * k, cache.topk_distances.data(), k * sizeof(float));
             std::memcpy(labels + i * k, cache.topk_labels.data(), k * sizeof(idx_t));
@@ -373,9 +710,151 @@ HNSWStats IndexHNSW::search_resume(
     total_stats.ndis = total_ndis;
     total_stats.nhops = total_nhops;
 
+    if (is_similarity_metric(metric_type)) {
+        // the caches keep the negated distances, revert them in the output
+        for (idx_t i = 0; i < k * n; i++) {
+            distances[i] = -distances[i];
+        }
+    }
+    // the caches keep the stored positions
+    apply_label_map(label_map, k * n, labels);
+
     return total_stats;
 }
 
+HNSWStats IndexHNSW::search_sessions(
+        idx_t n,
+        const float* x,
+        idx_t k,
+        const idx_t* session_ids,
+        HNSWSearchCachePool& pool,
+        float* distances,
+        idx_t* labels,
+        const SearchParameters* params) const {
+    std::vector<HNSWSearchCache*> caches(n);
+    idx_t nacquired = 0;
+    try {
+        for (; nacquired < n; nacquired++) {
+            caches[nacquired] = pool.acquire(session_ids[nacquired]);
+        }
+    } catch (...) {
+        for (idx_t i = 0; i < nacquired; i++) {
+            pool.release(session_ids[i]);
+        }
+        throw;
+    }
+
+    HNSWStats stats;
+    try {
+        stats = search_resume(n, x, k, distances, labels, caches, params);
+    } catch (...) {
+        // the state of the caches is undefined, restart the sessions
+        for (idx_t i = 0; i < n; i++) {
+            caches[i]->initialized = false;
+            pool.release(session_ids[i]);
+        }
+        throw;
+    }
+    for (idx_t i = 0; i < n; i++) {
+        pool.release(session_ids[i]);
+    }
+    return stats;
+}
+
+void IndexHNSW::search_checkpoints(
+        idx_t n,
+        const float* x,
+        idx_t k,
+        size_t n_checkpoints,
+        const float* schedule,
+        float* distances,
+        idx_t* labels,
+        const SearchParameters* params) const {
+    FAISS_THROW_IF_NOT(k > 0);
+    FAISS_THROW_IF_NOT(n_checkpoints > 0);
+    FAISS_THROW_IF_NOT_MSG(
+            storage,
+            "No storage index, please use IndexHNSWFlat (or variants) "
+            "instead of IndexHNSW directly");
+    for (size_t c = 1; c < n_checkpoints; c++) {
+        FAISS_THROW_IF_NOT_MSG(
+                schedule[c] >= schedule[c - 1],
+                "the schedule should be non-decreasing");
+    }
+
+    SearchParametersHNSW hnsw_params;
+    hnsw_params.efSearch = hnsw.efSearch;
+    if (params) {
+        if (const SearchParametersHNSW* p =
+                    dynamic_cast<const SearchParametersHNSW*>(params)) {
+            hnsw_params = *p;
+        } else {
+            hnsw_params.sel = params->sel;
+        }
+    }
+    IDSelectorTranslated label_sel(label_map, hnsw_params.sel);
+    if (!label_map.empty() && hnsw_params.sel) {
+        hnsw_params.sel = &label_sel;
+    }
+    HNSWTerminationMethod method = hnsw_params.termination_method;
+    FAISS_THROW_IF_NOT_MSG(
+            method != HNSW_TERMINATION_CUSTOM &&
+                    method != HNSW_TERMINATION_CONFORMAL,
+            "custom and conformal termination are not supported by "
+            "search_checkpoints");
+
+    // the candidate queue should be large enough for the largest effort
+    int queue_size = checkpoint_queue_size(
+            method, schedule[n_checkpoints - 1], hnsw_params.efSearch, k);
+
+    size_t n1 = 0, n2 = 0, ndis = 0, nhops = 0;
+
+#pragma omp parallel if (n > 1)
+    {
+        std::unique_ptr<DistanceComputer> dis(
+                storage_distance_computer(storage));
+        HNSWSearchCache cache(queue_size);
+        cache.resize_visited(ntotal);
+        std::vector<float> heap_dis(k);
+        std::vector<idx_t> heap_ids(k);
+        SearchParametersHNSW step_params = hnsw_params;
+
+#pragma omp for reduction(+ : n1, n2, ndis, nhops) schedule(guided)
+        for (idx_t i = 0; i < n; i++) {
+            dis->set_query(x + i * d);
+            cache.initialized = false;
+            heap_heapify<HNSW::C>(k, heap_dis.data(), heap_ids.data());
+            ResumeSingleResultHandler res(k, heap_dis.data(), heap_ids.data());
+
+            for (size_t c = 0; c < n_checkpoints; c++) {
+                HNSWStats stats = resume_to_checkpoint(
+                        hnsw, *dis, res, cache, method, schedule[c], step_params);
+                ndis += stats.ndis;
+                nhops += stats.nhops;
+
+                size_t ofs = (i * n_checkpoints + c) * k;
+                memcpy(distances + ofs, heap_dis.data(), k * sizeof(float));
+                memcpy(labels + ofs, heap_ids.data(), k * sizeof(idx_t));
+                heap_reorder<HNSW::C>(k, distances + ofs, labels + ofs);
+            }
+            n1++;
+            if (cache.candidates.size() == 0) {
+                n2++;
+            }
+        }
+    }
+
+    hnsw_stats.combine({n1, n2, ndis, nhops});
+
+    if (is_similarity_metric(metric_type)) {
+        // we need to revert the negated distances
+        for (size_t i = 0; i < k * n * n_checkpoints; i++) {
+            distances[i] = -distances[i];
+        }
+    }
+    apply_label_map(label_map, k * n * n_checkpoints, labels);
+}
+
 void IndexHNSW::search(
         idx_t n,
         const float* x,
@@ -385,10 +864,42 @@ void IndexHNSW::search(
         const SearchParameters* params) const {
     FAISS_THROW_IF_NOT(k > 0);
 
-    using RH = HeapBlockResultHandler<HNSW::C>;
-    RH bres(n, distances, labels, k);
+    ScopedLabelSelector label_sel(label_map, params);
+    const SearchParametersHNSW* hnsw_params =
+            dynamic_cast<const SearchParametersHNSW*>(params);
+    if (hnsw_params &&
+        hnsw_params->termination_method == HNSW_TERMINATION_CONFORMAL) {
+        FAISS_THROW_IF_NOT_MSG(
+                storage,
+                "No storage index, please use IndexHNSWFlat (or variants) "
+                "instead of IndexHNSW directly");
+        check_termination_params(*hnsw_params);
+        hnsw_search_conformal(
+                *this, n, x, k, distances, labels, *hnsw_params);
+    } else if (hnsw_params && hnsw_params->n_interleave > 1) {
+        FAISS_THROW_IF_NOT_MSG(
+                storage,
+                "No storage index, please use IndexHNSWFlat (or variants) "
+                "instead of IndexHNSW directly");
+        FAISS_THROW_IF_NOT_MSG(
+                hnsw_params->bounded_queue,
+                "interleaved search requires a bounded queue");
+        FAISS_THROW_IF_NOT_MSG(
+                !hnsw_params->trace,
+                "interleaved search does not support search traces");
+        FAISS_THROW_IF_NOT_MSG(
+                !hnsw.is_panorama && !prefilter,
+                "interleaved search does not support Panorama or a "
+                "prefilter");
+        check_termination_params(*hnsw_params);
+        hnsw_search_interleaved(
+                *this, n, x, k, distances, labels, *hnsw_params);
+    } else {
+        using RH = HeapBlockResultHandler<HNSW::C>;
+        RH bres(n, distances, labels, k);
 
-    hnsw_search(this, n, x, bres, params);
+        hnsw_search(this, n, x, bres, params);
+    }
 
     if (is_similarity_metric(this->metric_type)) {
         // we need to revert the negated distances
@@ -396,6 +907,7 @@ void IndexHNSW::search(
             distances[i] = -distances[i];
         }
     }
+    apply_label_map(label_map, k * n, labels);
 }
 
 void IndexHNSW::range_search(
@@ -407,6 +919,7 @@ void IndexHNSW::range_search(
     using RH = RangeSearchBlockResultHandler<HNSW::C>;
     RH bres(result, is_similarity_metric(metric_type) ? -radius : radius);
 
+    ScopedLabelSelector label_sel(label_map, params);
     hnsw_search(this, n, x, bres, params);
 
     if (is_similarity_metric(this->metric_type)) {
@@ -415,6 +928,7 @@ void IndexHNSW::range_search(
             result->distances[i] = -result->distances[i];
         }
     }
+    apply_label_map(label_map, result->lims[result->nq], result->labels);
 }
 
 void IndexHNSW::search1(
@@ -431,8 +945,20 @@ void IndexHNSW::add(idx_t n, const float* x) {
             "Please use IndexHNSWFlat (or variants) instead of IndexHNSW directly");
     FAISS_THROW_IF_NOT(is_trained);
     int n0 = ntotal;
+    if (prefilter) {
+        FAISS_THROW_IF_NOT_MSG(
+                prefilter->is_trained && prefilter->ntotal == n0,
+                "prefilter must be trained and contain the same vectors");
+        prefilter->add(n, x);
+    }
     storage->add(n, x);
     ntotal = storage->ntotal;
+    if (!label_map.empty()) {
+        // the new vectors are labeled sequentially after the others
+        for (idx_t i = n0; i < ntotal; i++) {
+            label_map.push_back(i);
+        }
+    }
 
     hnsw_add_vertices(*this, n0, n, x, verbose, hnsw.levels.size() == ntotal);
 }
@@ -440,6 +966,10 @@ void IndexHNSW::add(idx_t n, const float* x) {
 void IndexHNSW::reset() {
     hnsw.reset();
     storage->reset();
+    if (prefilter) {
+        prefilter->reset();
+    }
+    label_map.clear();
     ntotal = 0;
 }
 
@@ -514,6 +1044,12 @@ void IndexHNSW::search_level_0(
 
     using RH = HeapBlockResultHandler<HNSW::C>;
     RH bres(n, distances, labels, k);
+    ScopedLabelSelector label_sel(label_map, params);
+    HNSWSearchTrace* trace = nullptr;
+    if (const SearchParametersHNSW* hnsw_params =
+                dynamic_cast<const SearchParametersHNSW*>(params)) {
+        trace = hnsw_params->trace;
+    }
 
 #pragma omp parallel
     {
@@ -527,6 +1063,9 @@ void IndexHNSW::search_level_0(
         for (idx_t i = 0; i < n; i++) {
             res.begin(i);
             qdis->set_query(x + i * d);
+            if (trace) {
+                trace->begin_query(i);
+            }
 
             hnsw.search_level_0(
                     *qdis.get(),
@@ -553,6 +1092,7 @@ void IndexHNSW::search_level_0(
             distances[i] = -distances[i];
         }
     }
+    apply_label_map(label_map, k * n, labels);
 }
 
 void IndexHNSW::init_level_0_from_knngraph(
@@ -716,8 +1256,80 @@ void IndexHNSW::permute_entries(const idx_t* perm) {
     auto flat_storage = dynamic_cast<IndexFlatCodes*>(storage);
     FAISS_THROW_IF_NOT_MSG(
             flat_storage, "don't know how to permute this index");
+    if (prefilter) {
+        auto flat_prefilter = dynamic_cast<IndexFlatCodes*>(prefilter);
+        FAISS_THROW_IF_NOT_MSG(
+                flat_prefilter, "don't know how to permute the prefilter");
+        flat_prefilter->permute_entries(perm);
+    }
     flat_storage->permute_entries(perm);
     hnsw.permute_entries(perm);
+    if (!label_map.empty()) {
+        std::vector<idx_t> new_label_map(ntotal);
+        for (idx_t i = 0; i < ntotal; i++) {
+            new_label_map[i] = label_map[perm[i]];
+        }
+        std::swap(label_map, new_label_map);
+    }
+}
+
+void IndexHNSW::reorder_graph(HNSWReorderMethod method, idx_t* perm) {
+    std::vector<idx_t> new_perm(ntotal);
+    hnsw.reorder_permutation(method, new_perm.data());
+    if (label_map.empty()) {
+        // keep the labels from before the reordering
+        label_map.resize(ntotal);
+        std::iota(label_map.begin(), label_map.end(), 0);
+    }
+    permute_entries(new_perm.data());
+    if (perm) {
+        std::copy(new_perm.begin(), new_perm.end(), perm);
+    }
+}
+
+size_t IndexHNSW::remove_ids(const IDSelector& sel) {
+    size_t nremove = 0;
+    for (idx_t i = 0; i < ntotal; i++) {
+        idx_t label = label_map.empty() ? i : label_map[i];
+        if (sel.is_member(label) && hnsw.mark_deleted(i)) {
+            nremove++;
+        }
+    }
+    return nremove;
+}
+
+size_t IndexHNSW::compact() {
+    if (hnsw.ndeleted_linked == 0) {
+        return 0;
+    }
+    size_t nrepaired = 0;
+
+#pragma omp parallel reduction(+ : nrepaired)
+    {
+        std::unique_ptr<DistanceComputer> dis(
+                storage_distance_computer(storage));
+
+        // a vertex only writes its own lists and reads the lists of the
+        // deleted vertices, that are not modified before unlink_deleted
+#pragma omp for schedule(static)
+        for (idx_t i = 0; i < ntotal; i++) {
+            if (hnsw.is_deleted(i)) {
+                continue;
+            }
+            for (int level = 0; level < hnsw.levels[i]; level++) {
+                if (hnsw.repair_neighbors(
+                            *dis,
+                            i,
+                            level,
+                            keep_max_size_level0 && level == 0)) {
+                    nrepaired++;
+                }
+            }
+        }
+    }
+
+    hnsw.unlink_deleted();
+    return nrepaired;
 }
 
 DistanceComputer* IndexHNSW::get_distance_computer() const {
@@ -796,12 +1408,9 @@ HNSWStats IndexHNSWFlatPanorama::search_resume(
         idx_t* labels,
         std::vector<HNSWSearchCache*>& caches,
         const SearchParameters* params) const {
-
-    std::vector<float> query_cum_sums(n * (pano.n_levels + 1));
-    // compute cumulative sums first
-    pano.compute_cumulative_sums(query_cum_sums.data(), 0, n, x);
-    // delegate to base HNSW
-    return IndexHNSW::search_resume(n, x, k, distances, labels, caches, params);
+    // the resumed search computes full distances, that would silently give
+    // different results from the Panorama search
+    FAISS_THROW_MSG("search_resume does not support Panorama");
 }
 
 
@@ -929,7 +1538,7 @@ int search_from_candidates_2(
                 candidates.push(v1, d);
 
                 // never seen before --> add to heap
-                if (vt.visited[v1] < vt.visno) {
+                if (vt.visited[v1] < vt.visno && !hnsw.is_deleted(v1)) {
                     if (nres < k) {
                         faiss::maxheap_push(++nres, D, I, d, v1);
                     } else if (d < D[0]) {
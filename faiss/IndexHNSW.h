@@ -48,6 +48,29 @@ struct IndexHNSW : Index {
     // used when GpuIndexCagra::copyFrom(IndexHNSWCagra*) is invoked.
     bool keep_max_size_level0 = false;
 
+    // When > 0, add() protects the neighbor lists with this many striped
+    // spinlocks (see HNSWStripedLocks) instead of one omp_lock_t per
+    // vector. This uses less memory and scales better to many threads.
+    // Not serialized.
+    int add_lock_stripes = 0;
+
+    // Optional compact codes of the same vectors (eg. an IndexPQ with 4-bit
+    // codes, an IndexScalarQuantizer with QT_4bit or an IndexRaBitQ), whose
+    // distance estimates let search() and range_search() skip the exact
+    // distance computation of neighbors that cannot enter the result set
+    // (see SearchParametersHNSW::prefilter_margin, not used with
+    // n_interleave > 1). It is trained by
+    // train() and filled by add(). Owned if own_prefilter. Not serialized.
+    Index* prefilter = nullptr;
+    bool own_prefilter = false;
+
+    // Label of each stored vector, set by reorder_graph() so that the
+    // results keep the ids from before the reordering. When empty, the
+    // labels are the storage positions. The IDSelectors of the search
+    // parameters and of remove_ids() are in terms of labels, reconstruct()
+    // takes storage positions.
+    std::vector<idx_t> label_map;
+
     explicit IndexHNSW(int d = 0, int M = 32, MetricType metric = METRIC_L2);
     explicit IndexHNSW(Index* storage, int M = 32);
 
@@ -82,10 +105,59 @@ struct IndexHNSW : Index {
 
     void reconstruct(idx_t key, float* recons) const override;
 
+    /** Search that can be continued with a larger effort: the search
+     * state of query i is kept in caches[i] between calls (use
+     * HNSW_VISITED_HASHSET caches to keep many of them alive on a large
+     * index). The results are the top-k found so far. This works with
+     * any storage (flat, SQ, PQ) and the results are filtered by
+     * params->sel, if any. */
     HNSWStats search_resume(
         idx_t n, const float* x, idx_t k, float* distances, idx_t* labels, 
         std::vector<HNSWSearchCache*>& caches, const SearchParameters* params = nullptr) const;
 
+    /** search_resume where the search states are kept in a pool, keyed by
+     * session id. A session found in the pool continues its search (use an
+     * increasing efSearch to get more results), a new or evicted session
+     * starts from scratch. The queries of a session and k should not change
+     * from one call to the next.
+     *
+     * @param session_ids  session of each query, size n (no duplicates)
+     */
+    HNSWStats search_sessions(
+            idx_t n,
+            const float* x,
+            idx_t k,
+            const idx_t* session_ids,
+            HNSWSearchCachePool& pool,
+            float* distances,
+            idx_t* labels,
+            const SearchParameters* params = nullptr) const;
+
+    /** Search with a schedule of increasing efforts and return the top-k
+     * results obtained at each step of the schedule. The search of each
+     * query is resumed from one step to the next (see search_resume), so
+     * the whole schedule costs a single traversal.
+     *
+     * The schedule values set the parameter of the termination method of
+     * params (efSearch for HNSW_TERMINATION_EF_SEARCH, the patience, the
+     * total nb of expanded nodes or the radius for the other methods). It
+     * should be non-decreasing.
+     *
+     * @param n_checkpoints  size of the schedule
+     * @param schedule       effort values, size n_checkpoints
+     * @param distances      output distances, size n * n_checkpoints * k
+     * @param labels         output labels, size n * n_checkpoints * k
+     */
+    void search_checkpoints(
+            idx_t n,
+            const float* x,
+            idx_t k,
+            size_t n_checkpoints,
+            const float* schedule,
+            float* distances,
+            idx_t* labels,
+            const SearchParameters* params = nullptr) const;
+
     void reset() override;
 
     void shrink_level_0_neighbors(int size);
@@ -124,6 +196,33 @@ struct IndexHNSW : Index {
 
     virtual void permute_entries(const idx_t* perm);
 
+    /** Reorder the vectors as in HNSW::reorder_permutation, so that nodes
+     * traversed together are stored close to each other (both in the
+     * neighbor table and in the storage). The search results keep the
+     * same labels, through label_map.
+     *
+     * @param perm  if not null, output map from new to old storage
+     *              positions, size ntotal
+     */
+    void reorder_graph(HNSWReorderMethod method, idx_t* perm = nullptr);
+
+    /** Mark the selected vectors as deleted. They are not returned by the
+     * searches anymore but still route them until compact() is called. The
+     * ids of the other vectors do not change and ntotal still counts the
+     * deleted vectors, whose storage is not reclaimed.
+     *
+     * @return nb of vectors that were not deleted yet
+     */
+    size_t remove_ids(const IDSelector& sel) override;
+
+    /** Repair the neighbor lists that point to deleted vectors (see
+     * HNSW::repair_neighbors) and unlink the deleted vectors from the
+     * graph. Must not run concurrently with add or search.
+     *
+     * @return nb of repaired neighbor lists
+     */
+    size_t compact();
+
     DistanceComputer* get_distance_computer() const override;
 };
 
@@ -13,6 +13,7 @@
 
 #include <stdint.h>
 
+#include <algorithm>
 #include <cstring>
 #include <memory>
 #include <mutex>
@@ -197,6 +198,80 @@ struct VisitedTable {
     }
 };
 
+/** Set of non-negative int32 ids with the same interface as VisitedTable,
+ * whose memory is proportional to the number of elements that were set
+ * rather than to the size of the id space.
+ *
+ * Open addressing with linear probing, the table is kept at most half
+ * full.
+ */
+struct VisitedHashSet {
+    std::vector<int32_t> slots; ///< -1 = empty slot, size is a power of 2
+    size_t count = 0;           ///< nb of ids in the set
+    int shift = 28;             ///< 32 - log2(slots.size())
+
+    explicit VisitedHashSet(size_t initial_capacity = 64) {
+        size_t cap = 16;
+        while (cap < 2 * initial_capacity) {
+            cap *= 2;
+            shift--;
+        }
+        slots.resize(cap, -1);
+    }
+
+    /// set flag #no to true
+    void set(int no) {
+        if (2 * (count + 1) > slots.size()) {
+            grow();
+        }
+        size_t i = find_slot(no);
+        if (slots[i] != no) {
+            slots[i] = no;
+            count++;
+        }
+    }
+
+    /// get flag #no
+    bool get(int no) const {
+        return slots[find_slot(no)] == no;
+    }
+
+    /// reset all flags to false (keeps the capacity)
+    void advance() {
+        std::fill(slots.begin(), slots.end(), -1);
+        count = 0;
+    }
+
+    /// memory used by the table, in bytes
+    size_t memory_usage() const {
+        return slots.capacity() * sizeof(slots[0]);
+    }
+
+   private:
+    /// slot that contains no or the empty slot where it would be inserted
+    size_t find_slot(int no) const {
+        size_t mask = slots.size() - 1;
+        // Fibonacci hashing: use the high bits of the product so that
+        // consecutive ids are spread over the table
+        size_t i = uint32_t(uint32_t(no) * 2654435769u) >> shift;
+        while (slots[i] != -1 && slots[i] != no) {
+            i = (i + 1) & mask;
+        }
+        return i;
+    }
+
+    void grow() {
+        std::vector<int32_t> old_slots(slots.size() * 2, -1);
+        std::swap(slots, old_slots);
+        shift--;
+        for (int32_t v : old_slots) {
+            if (v != -1) {
+                slots[find_slot(v)] = v;
+            }
+        }
+    }
+};
+
 } // namespace faiss
 
 #endif
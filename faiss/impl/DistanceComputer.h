@@ -8,6 +8,7 @@
 #pragma once
 
 #include <faiss/Index.h>
+#include <faiss/utils/prefetch.h>
 
 namespace faiss {
 
@@ -56,6 +57,10 @@ struct DistanceComputer {
     /// compute distance between two stored vectors
     virtual float symmetric_dis(idx_t i, idx_t j) = 0;
 
+    /// hint that the distance to vector i will be computed soon, so that
+    /// it can be fetched from memory in the meantime
+    virtual void prefetch(idx_t /* i */) {}
+
     virtual ~DistanceComputer() {}
 };
 
@@ -100,6 +105,10 @@ struct NegativeDistanceComputer : DistanceComputer {
         return -basedis->symmetric_dis(i, j);
     }
 
+    void prefetch(idx_t i) override {
+        basedis->prefetch(i);
+    }
+
     virtual ~NegativeDistanceComputer() override {
         delete basedis;
     }
@@ -130,6 +139,13 @@ struct FlatCodesDistanceComputer : DistanceComputer {
         return distance_to_code(codes + i * code_size);
     }
 
+    void prefetch(idx_t i) override {
+        const uint8_t* code = codes + i * code_size;
+        for (size_t ofs = 0; ofs < code_size; ofs += 64) {
+            prefetch_L2(code + ofs);
+        }
+    }
+
     /// Computes a partial dot product over a slice of the query vector.
     /// The slice is defined by the following parameters:
     ///   — `offset`: the starting index of the first component to include
@@ -7,8 +7,13 @@
 
 #include <faiss/impl/HNSW.h>
 
-#include <cstdlib>
+#include <cinttypes>
+#include <cmath>
 #include <cstddef>
+#include <cstdlib>
+#include <numeric>
+#include <thread>
+#include <unordered_set>
 
 #include <faiss/IndexHNSW.h>
 
@@ -25,14 +30,6 @@
 #include <type_traits>
 #endif
 
-#include <fstream>
-#include <atomic>
-#include <string>
-#include <iostream>
-
-// Global atomic counter to name files uniquely (query_0.txt, query_1.txt...)
-std::atomic<size_t> query_log_counter{0};
-
 namespace faiss {
 
 /**************************************************************
@@ -113,6 +110,8 @@ void HNSW::reset() {
     offsets.push_back(0);
     levels.clear();
     neighbors.clear();
+    deleted.clear();
+    ndeleted_linked = 0;
 }
 
 void HNSW::print_neighbor_stats(int level) const {
@@ -592,6 +591,106 @@ void HNSW::add_with_locks(
     }
 }
 
+void HNSW::add_with_striped_locks(
+        DistanceComputer& ptdis,
+        int pt_level,
+        int pt_id,
+        HNSWStripedLocks& locks,
+        VisitedTable& vt,
+        bool keep_max_size_level0) {
+    storage_idx_t nearest;
+#pragma omp critical
+    {
+        nearest = entry_point;
+
+        if (nearest == -1) {
+            max_level = pt_level;
+            entry_point = pt_id;
+        }
+    }
+
+    if (nearest < 0) {
+        return;
+    }
+
+    int level = max_level; // level at which we start adding neighbors
+    float d_nearest = ptdis(nearest);
+
+    for (; level > pt_level; level--) {
+        greedy_update_nearest(*this, ptdis, level, nearest, d_nearest);
+    }
+
+    std::vector<storage_idx_t> neighbors_to_add;
+    for (; level >= 0; level--) {
+        std::priority_queue<NodeDistCloser> link_targets;
+
+        search_neighbors_to_add(
+                *this, ptdis, link_targets, nearest, d_nearest, level, vt);
+
+        ::faiss::shrink_neighbor_list(
+                ptdis, link_targets, nb_neighbors(level), keep_max_size_level0);
+
+        // other threads can link to pt_id at this level as soon as they
+        // reach it from an upper level, so its own list is locked as well
+        neighbors_to_add.clear();
+        locks.lock(pt_id);
+        while (!link_targets.empty()) {
+            storage_idx_t other_id = link_targets.top().id;
+            add_link(
+                    *this, ptdis, pt_id, other_id, level, keep_max_size_level0);
+            neighbors_to_add.push_back(other_id);
+            link_targets.pop();
+        }
+        locks.unlock(pt_id);
+
+        for (storage_idx_t other_id : neighbors_to_add) {
+            locks.lock(other_id);
+            add_link(
+                    *this, ptdis, other_id, pt_id, level, keep_max_size_level0);
+            locks.unlock(other_id);
+        }
+    }
+
+    if (pt_level > max_level) {
+        max_level = pt_level;
+        entry_point = pt_id;
+    }
+}
+
+/**************************************************************
+ * Striped locks
+ **************************************************************/
+
+HNSWStripedLocks::HNSWStripedLocks(size_t nlock) {
+    FAISS_THROW_IF_NOT_MSG(nlock > 0, "need at least one lock");
+    size_t n = 1;
+    while (n < nlock) {
+        n *= 2;
+    }
+    stripes.reset(new Stripe[n]);
+    mask = n - 1;
+}
+
+void HNSWStripedLocks::lock(idx_t i) {
+    std::atomic<bool>& l = stripes[i & mask].locked;
+    // test-and-test-and-set: spin on a plain load so that waiting threads
+    // do not bounce the cache line, give up the core after a while in case
+    // the machine is oversubscribed
+    int nspin = 0;
+    while (l.exchange(true, std::memory_order_acquire)) {
+        while (l.load(std::memory_order_relaxed)) {
+            if (++nspin > 1000) {
+                std::this_thread::yield();
+                nspin = 0;
+            }
+        }
+    }
+}
+
+void HNSWStripedLocks::unlock(idx_t i) {
+    stripes[i & mask].locked.store(false, std::memory_order_release);
+}
+
 /**************************************************************
  * Searching
  **************************************************************/
@@ -600,29 +699,255 @@ using MinimaxHeap = HNSW::MinimaxHeap;
 using Node = HNSW::Node;
 using C = HNSW::C;
 
+namespace {
+
+/// excludes the deleted vertices from the results, on top of an optional
+/// user selector
+struct IDSelectorNotDeleted : IDSelector {
+    const HNSW* hnsw = nullptr;
+    const IDSelector* sel = nullptr;
+
+    bool is_member(idx_t id) const final {
+        return !hnsw->is_deleted(id) && (!sel || sel->is_member(id));
+    }
+};
+
+/// termination settings, extracted once per search call
+struct TerminationParams {
+    HNSWTerminationMethod method = HNSW_TERMINATION_EF_SEARCH;
+    bool do_dis_check = true;
+    int efSearch = 16;
+    int patience = 20;
+    int hardlimit_max_nodes = 0;
+    float radiuslimit_radius = 0;
+    const HNSWTerminationCallback* callback = nullptr;
+    /// selector returned by extract_search_params if there are deletions
+    IDSelectorNotDeleted not_deleted;
+};
+
 /** Helper to extract search parameters from HNSW and SearchParameters */
-static inline void extract_search_params(
+inline void extract_search_params(
         const HNSW& hnsw,
         const SearchParameters* params,
-        bool& do_dis_check,
-        int& efSearch,
+        TerminationParams& tp,
         const IDSelector*& sel) {
     // can be overridden by search params
-    do_dis_check = hnsw.check_relative_distance;
-    efSearch = hnsw.efSearch;
+    tp.do_dis_check = hnsw.check_relative_distance;
+    tp.efSearch = hnsw.efSearch;
     sel = nullptr;
     if (params) {
         if (const SearchParametersHNSW* hnsw_params =
                     dynamic_cast<const SearchParametersHNSW*>(params)) {
-            do_dis_check = hnsw_params->check_relative_distance;
-            efSearch = hnsw_params->efSearch;
+            tp.do_dis_check = hnsw_params->check_relative_distance;
+            tp.efSearch = hnsw_params->efSearch;
+            tp.method = hnsw_params->termination_method;
+            tp.patience = hnsw_params->patience;
+            tp.hardlimit_max_nodes = hnsw_params->hardlimit_max_nodes;
+            tp.radiuslimit_radius = hnsw_params->radiuslimit_radius;
+            tp.callback = hnsw_params->termination_callback;
         }
         sel = params->sel;
     }
+    if (!hnsw.deleted.empty()) {
+        tp.not_deleted.hnsw = &hnsw;
+        tp.not_deleted.sel = sel;
+        sel = &tp.not_deleted;
+    }
+}
+
+/// trace of SearchParametersHNSW, if any
+inline HNSWSearchTrace* extract_trace(const SearchParameters* params) {
+    const SearchParametersHNSW* hnsw_params =
+            dynamic_cast<const SearchParametersHNSW*>(params);
+    return hnsw_params ? hnsw_params->trace : nullptr;
+}
+
+/* Termination policies. They are instantiated once per call to the search
+ * loop (so they can hold per-query state) and are used as template
+ * parameters so that the stopping test is inlined in the hot loop.
+ *
+ * stop_before_expand is called after popping the next candidate (which is
+ * not expanded if it returns true), stop_after_expand after the neighbors
+ * of the candidate have been processed. */
+
+struct TerminationEfSearch {
+    bool do_dis_check;
+    int efSearch;
+
+    explicit TerminationEfSearch(const TerminationParams& tp)
+            : do_dis_check(tp.do_dis_check), efSearch(tp.efSearch) {}
+
+    bool stop_before_expand(
+            float d0,
+            MinimaxHeap& candidates,
+            int /* nstep */,
+            size_t /* ndis */,
+            float /* threshold */) {
+        // tricky stopping condition: there are more that ef distances that
+        // are processed already that are smaller than d0
+        return do_dis_check && candidates.count_below(d0) >= efSearch;
+    }
+
+    bool stop_after_expand(
+            float /* d0 */,
+            const MinimaxHeap& /* candidates */,
+            int nstep,
+            size_t /* ndis */,
+            float /* threshold */,
+            bool /* improved */) {
+        return !do_dis_check && nstep > efSearch;
+    }
+};
+
+struct TerminationPatience {
+    int patience;
+    int nstep_no_improvement = 0;
+
+    explicit TerminationPatience(const TerminationParams& tp)
+            : patience(tp.patience) {}
+
+    bool stop_before_expand(float, MinimaxHeap&, int, size_t, float) {
+        return false;
+    }
+
+    bool stop_after_expand(
+            float,
+            const MinimaxHeap&,
+            int,
+            size_t,
+            float,
+            bool improved) {
+        if (improved) {
+            nstep_no_improvement = 0;
+            return false;
+        }
+        return ++nstep_no_improvement >= patience;
+    }
+};
+
+struct TerminationHardlimit {
+    int max_nodes;
+
+    explicit TerminationHardlimit(const TerminationParams& tp)
+            : max_nodes(tp.hardlimit_max_nodes) {}
+
+    bool stop_before_expand(float, MinimaxHeap&, int, size_t, float) {
+        return false;
+    }
+
+    bool stop_after_expand(
+            float,
+            const MinimaxHeap&,
+            int nstep,
+            size_t,
+            float,
+            bool) {
+        return max_nodes > 0 && nstep >= max_nodes;
+    }
+};
+
+struct TerminationRadiuslimit {
+    float radius;
+
+    explicit TerminationRadiuslimit(const TerminationParams& tp)
+            : radius(tp.radiuslimit_radius) {}
+
+    bool stop_before_expand(float d0, MinimaxHeap&, int, size_t, float) {
+        // the closest unexplored candidate is outside the radius
+        return d0 > radius;
+    }
+
+    bool stop_after_expand(
+            float,
+            const MinimaxHeap&,
+            int,
+            size_t,
+            float,
+            bool) {
+        return false;
+    }
+};
+
+struct TerminationCustom {
+    const HNSWTerminationCallback* callback;
+    HNSWSearchProgress progress;
+
+    explicit TerminationCustom(const TerminationParams& tp)
+            : callback(tp.callback) {
+        FAISS_THROW_IF_NOT_MSG(
+                callback,
+                "HNSW_TERMINATION_CUSTOM requires a termination_callback");
+    }
+
+    bool stop_before_expand(
+            float d0,
+            MinimaxHeap& candidates,
+            int nstep,
+            size_t ndis,
+            float threshold) {
+        progress.d0 = d0;
+        progress.threshold = threshold;
+        progress.nstep = nstep;
+        progress.ndis = ndis;
+        progress.ncandidates = candidates.size();
+        progress.after_expand = false;
+        return callback->should_stop(progress);
+    }
+
+    bool stop_after_expand(
+            float d0,
+            const MinimaxHeap& candidates,
+            int nstep,
+            size_t ndis,
+            float threshold,
+            bool improved) {
+        progress.d0 = d0;
+        progress.threshold = threshold;
+        progress.nstep = nstep;
+        progress.ndis = ndis;
+        progress.ncandidates = candidates.size();
+        progress.nstep_no_improvement =
+                improved ? 0 : progress.nstep_no_improvement + 1;
+        progress.after_expand = true;
+        return callback->should_stop(progress);
+    }
+};
+
+/// call consumer with the termination policy corresponding to tp
+template <class Consumer>
+decltype(auto) with_termination_policy(
+        const TerminationParams& tp,
+        Consumer consumer) {
+    switch (tp.method) {
+        case HNSW_TERMINATION_EF_SEARCH: {
+            TerminationEfSearch term(tp);
+            return consumer(term);
+        }
+        case HNSW_TERMINATION_PATIENCE: {
+            TerminationPatience term(tp);
+            return consumer(term);
+        }
+        case HNSW_TERMINATION_HARDLIMIT: {
+            TerminationHardlimit term(tp);
+            return consumer(term);
+        }
+        case HNSW_TERMINATION_RADIUSLIMIT: {
+            TerminationRadiuslimit term(tp);
+            return consumer(term);
+        }
+        case HNSW_TERMINATION_CUSTOM: {
+            TerminationCustom term(tp);
+            return consumer(term);
+        }
+        default:
+            FAISS_THROW_FMT(
+                    "unknown HNSW termination method %d", int(tp.method));
+    }
 }
 
 /** Do a BFS on the candidates list */
-int search_from_candidates(
+template <class Termination>
+int search_from_candidates_tpl(
         const HNSW& hnsw,
         DistanceComputer& qdis,
         ResultHandler& res,
@@ -631,56 +956,15 @@ int search_from_candidates(
         HNSWStats& stats,
         int level,
         int nres_in,
-        const SearchParameters* params) {
+        const IDSelector* sel,
+        HNSWSearchTrace* trace,
+        Termination& term,
+        DistanceComputer* approx_dis = nullptr,
+        float prefilter_margin = 0) {
     int nres = nres_in;
     int ndis = 0;
 
-    // --- LOGGING SETUP ---
-    // Only log for the first 100 queries to save disk space/time
-    // We assume the Python script created the folder "results/efficiency/"
-    size_t query_id = query_log_counter.fetch_add(1);
-    std::ofstream log_file;
-    static bool logging_enabled = (std::getenv("HNSW_ENABLE_LOGGING") != nullptr);
-    bool do_log = (level == 0 && query_id < 100 && logging_enabled); 
-    
-    if (do_log) {
-        std::string fname = "results/efficiency/log_q_" + std::to_string(query_id) + ".csv";
-        log_file.open(fname);
-        // Header: computations, current_kth_distance
-        log_file << "ndis,radius\n";
-    }
-    // ---------------------
-    // Read termination parameters from environment variables once per run
-    std::string term_method = []() {
-        const char* s = std::getenv("HNSW_TERMINATION_METHOD");
-        return s ? std::string(s) : "ef_search"; // Options: ef_search, patience, hardlimit, radiuslimit
-    }();
-
-    int patience_val = []() {
-        const char* s = std::getenv("HNSW_PATIENCE");
-        return s ? std::atoi(s) : 20; 
-    }();
-
-    int hardlimit_nodes = []() {
-        const char* s = std::getenv("HNSW_HARDLIMIT_MAX_NODES");
-        return s ? std::atoi(s) : 0; 
-    }();
-
-    float radius_limit = []() {
-        const char* s = std::getenv("HNSW_RADIUSLIMIT_RADIUS");
-        return s ? std::atof(s) : 0.0f;
-    }();
-
-    // Trackers for patience termination
-    int no_improvement_counter = 0;
     bool top_k_improved = false;
-    // ====================================================
-    // ----------------------------------------------
-
-    bool do_dis_check;
-    int efSearch;
-    const IDSelector* sel;
-    extract_search_params(hnsw, params, do_dis_check, efSearch, sel);
 
     C::T threshold = res.threshold;
     for (int i = 0; i < candidates.size(); i++) {
@@ -702,22 +986,10 @@ int search_from_candidates(
     while (candidates.size() > 0) {
         float d0 = 0;
         int v0 = candidates.pop_min(&d0);
-        // === NEW: PRE-EVALUATION TERMINATION CHECKS ===
-        if (term_method == "radiuslimit") {
-            // Stop immediately if the closest unexplored candidate is strictly outside the radius cutoff
-            if (d0 > radius_limit) {
-                break;
-            }
-        } else if (term_method == "ef_search") {
-            // Standard FAISS behavior
-            if (do_dis_check) {
-                int n_dis_below = candidates.count_below(d0);
-                if (n_dis_below >= efSearch) {
-                    break;
-                }
-            }
+        if (term.stop_before_expand(
+                    d0, candidates, nstep, ndis, res.threshold)) {
+            break;
         }
-        // ==============================================
 
         size_t begin, end;
         hnsw.neighbor_range(v0, level, &begin, &end);
@@ -759,6 +1031,16 @@ int search_from_candidates(
 
             bool vget = vt.get(v1);
             vt.set(v1);
+            if (approx_dis && !vget) {
+                // neighbors that are unlikely to enter the results are
+                // still queued, with their estimated distance, so that the
+                // graph remains navigable
+                float est = (*approx_dis)(v1);
+                if (est > threshold + prefilter_margin * std::fabs(threshold)) {
+                    candidates.push(v1, est);
+                    continue;
+                }
+            }
             saved_j[counter] = v1;
             counter += vget ? 0 : 1;
 
@@ -790,37 +1072,22 @@ int search_from_candidates(
 
             ndis += 1;
         }
-        
-        // --- LOGGING STEP ---
-        if (do_log && log_file.is_open()) {
-            // Write current effort (ndis) and current best radius (threshold)
-            log_file << ndis << "," << threshold << "\n";
-        }
-        // --------------------
 
         nstep++;
 
-        if (term_method == "patience") {
-            if (top_k_improved) {
-                no_improvement_counter = 0; // Reset patience if we found a better node
-            } else {
-                no_improvement_counter++;
-                if (no_improvement_counter >= patience_val) {
-                    break; // Saturated: Break loop early
-                }
-            }
-        } else if (term_method == "hardlimit") {
-            // Strict node visit budget
-            if (hardlimit_nodes > 0 && nstep >= hardlimit_nodes) {
-                break;
-            }
-        } else if (term_method == "ef_search") {
-            // Standard FAISS fallback limit
-            if (!do_dis_check && nstep > efSearch) {
-                break;
-            }
+        if (trace) {
+            trace->add(nstep, candidates.size(), ndis, res.threshold);
         }
 
+        if (term.stop_after_expand(
+                    d0,
+                    candidates,
+                    nstep,
+                    ndis,
+                    res.threshold,
+                    top_k_improved)) {
+            break;
+        }
     }
 
     if (level == 0) {
@@ -831,15 +1098,12 @@ int search_from_candidates(
         stats.ndis += ndis;
         stats.nhops += nstep;
     }
-    
-    if (do_log && log_file.is_open()) {
-        log_file.close();
-    }
 
     return nres;
 }
 
-int search_from_candidates_panorama(
+template <class Termination>
+int search_from_candidates_panorama_tpl(
         const HNSW& hnsw,
         const IndexHNSW* index,
         DistanceComputer& qdis,
@@ -849,23 +1113,14 @@ int search_from_candidates_panorama(
         HNSWStats& stats,
         int level,
         int nres_in,
-        const SearchParameters* params) {
+        const IDSelector* sel,
+        HNSWSearchTrace* trace,
+        Termination& term) {
     int nres = nres_in;
     int ndis = 0;
 
-    std::string term_method = []() { const char* s = std::getenv("HNSW_TERMINATION_METHOD"); return s ? std::string(s) : "ef_search"; }();
-    int patience_val = []() { const char* s = std::getenv("HNSW_PATIENCE"); return s ? std::atoi(s) : 20; }();
-    int hardlimit_nodes = []() { const char* s = std::getenv("HNSW_HARDLIMIT_MAX_NODES"); return s ? std::atoi(s) : 0; }();
-    float radius_limit = []() { const char* s = std::getenv("HNSW_RADIUSLIMIT_RADIUS"); return s ? std::atof(s) : 0.0f; }();
-
-    int no_improvement_counter = 0;
     bool top_k_improved = false;
 
-    bool do_dis_check;
-    int efSearch;
-    const IDSelector* sel;
-    extract_search_params(hnsw, params, do_dis_check, efSearch, sel);
-
     C::T threshold = res.threshold;
     for (int i = 0; i < candidates.size(); i++) {
         idx_t v1 = candidates.ids[i];
@@ -908,15 +1163,9 @@ int search_from_candidates_panorama(
         float d0 = 0;
         int v0 = candidates.pop_min(&d0);
 
-        if (term_method == "radiuslimit") {
-            if (d0 > radius_limit) break;
-        } else if (term_method == "ef_search") {
-            if (do_dis_check) {
-                int n_dis_below = candidates.count_below(d0);
-                if (n_dis_below >= efSearch) {
-                    break;
-                }
-            }
+        if (term.stop_before_expand(
+                    d0, candidates, nstep, ndis, res.threshold)) {
+            break;
         }
 
         size_t begin, end;
@@ -1076,19 +1325,19 @@ int search_from_candidates_panorama(
 
         nstep++;
 
-        if (term_method == "patience") {
-            if (top_k_improved) {
-                no_improvement_counter = 0;
-            } else {
-                no_improvement_counter++;
-                if (no_improvement_counter >= patience_val) break;
-            }
-        } else if (term_method == "hardlimit") {
-            if (hardlimit_nodes > 0 && nstep >= hardlimit_nodes) break;
-        } else if (term_method == "ef_search") {
-            if (!do_dis_check && nstep > efSearch) break;
+        if (trace) {
+            trace->add(nstep, candidates.size(), ndis, res.threshold);
         }
 
+        if (term.stop_after_expand(
+                    d0,
+                    candidates,
+                    nstep,
+                    ndis,
+                    res.threshold,
+                    top_k_improved)) {
+            break;
+        }
     }
 
     if (level == 0) {
@@ -1103,6 +1352,70 @@ int search_from_candidates_panorama(
     return nres;
 }
 
+} // anonymous namespace
+
+int search_from_candidates(
+        const HNSW& hnsw,
+        DistanceComputer& qdis,
+        ResultHandler& res,
+        MinimaxHeap& candidates,
+        VisitedTable& vt,
+        HNSWStats& stats,
+        int level,
+        int nres_in,
+        const SearchParameters* params) {
+    TerminationParams tp;
+    const IDSelector* sel;
+    extract_search_params(hnsw, params, tp, sel);
+    HNSWSearchTrace* trace = level == 0 ? extract_trace(params) : nullptr;
+    return with_termination_policy(tp, [&](auto& term) {
+        return search_from_candidates_tpl(
+                hnsw,
+                qdis,
+                res,
+                candidates,
+                vt,
+                stats,
+                level,
+                nres_in,
+                sel,
+                trace,
+                term);
+    });
+}
+
+int search_from_candidates_panorama(
+        const HNSW& hnsw,
+        const IndexHNSW* index,
+        DistanceComputer& qdis,
+        ResultHandler& res,
+        MinimaxHeap& candidates,
+        VisitedTable& vt,
+        HNSWStats& stats,
+        int level,
+        int nres_in,
+        const SearchParameters* params) {
+    TerminationParams tp;
+    const IDSelector* sel;
+    extract_search_params(hnsw, params, tp, sel);
+    HNSWSearchTrace* trace = level == 0 ? extract_trace(params) : nullptr;
+    return with_termination_policy(tp, [&](auto& term) {
+        return search_from_candidates_panorama_tpl(
+                hnsw,
+                index,
+                qdis,
+                res,
+                candidates,
+                vt,
+                stats,
+                level,
+                nres_in,
+                sel,
+                trace,
+                term);
+    });
+}
+
 std::priority_queue<HNSW::Node> search_from_candidate_unbounded(
         const HNSW& hnsw,
         const Node& node,
@@ -1307,7 +1620,8 @@ HNSWStats HNSW::search(
         const IndexHNSW* index,
         ResultHandler& res,
         VisitedTable& vt,
-        const SearchParameters* params) const {
+        const SearchParameters* params,
+        DistanceComputer* approx_dis) const {
     HNSWStats stats;
     if (entry_point == -1) {
         return stats;
@@ -1316,13 +1630,18 @@ HNSWStats HNSW::search(
 
     bool bounded_queue = this->search_bounded_queue;
     int efSearch = this->efSearch;
+    float prefilter_margin = SearchParametersHNSW().prefilter_margin;
     if (params) {
         if (const SearchParametersHNSW* hnsw_params =
                     dynamic_cast<const SearchParametersHNSW*>(params)) {
             bounded_queue = hnsw_params->bounded_queue;
             efSearch = hnsw_params->efSearch;
+            prefilter_margin = hnsw_params->prefilter_margin;
         }
     }
+    FAISS_THROW_IF_NOT_MSG(
+            !approx_dis || (bounded_queue && !is_panorama),
+            "distance estimates need a bounded queue and no Panorama");
 
     //  greedy search on upper levels
     storage_idx_t nearest = entry_point;
@@ -1341,7 +1660,28 @@ HNSWStats HNSW::search(
 
         candidates.push(nearest, d_nearest);
 
-        if (!is_panorama) {
+        if (approx_dis) {
+            TerminationParams tp;
+            const IDSelector* sel;
+            extract_search_params(*this, params, tp, sel);
+            HNSWSearchTrace* trace = extract_trace(params);
+            with_termination_policy(tp, [&](auto& term) {
+                return search_from_candidates_tpl(
+                        *this,
+                        qdis,
+                        res,
+                        candidates,
+                        vt,
+                        stats,
+                        0,
+                        0,
+                        sel,
+                        trace,
+                        term,
+                        approx_dis,
+                        prefilter_margin);
+            });
+        } else if (!is_panorama) {
             search_from_candidates(
                     *this, qdis, res, candidates, vt, stats, 0, 0, params);
         } else {
@@ -1362,16 +1702,19 @@ HNSWStats HNSW::search(
                 search_from_candidate_unbounded(
                         *this, Node(d_nearest, nearest), qdis, ef, &vt, stats);
 
-        while (top_candidates.size() > k) {
+        // drop the deleted vertices before keeping the k nearest
+        std::vector<Node> results;
+        while (!top_candidates.empty()) {
+            if (!is_deleted(top_candidates.top().second)) {
+                results.push_back(top_candidates.top());
+            }
             top_candidates.pop();
         }
 
-        while (!top_candidates.empty()) {
-            float d;
-            storage_idx_t label;
-            std::tie(d, label) = top_candidates.top();
-            res.add_result(d, label);
-            top_candidates.pop();
+        for (size_t i = results.size() > size_t(k) ? results.size() - k : 0;
+             i < results.size();
+             i++) {
+            res.add_result(results[i].first, results[i].second);
         }
     }
 
@@ -1380,94 +1723,499 @@ HNSWStats HNSW::search(
     return stats;
 }
 
-HNSWStats HNSW::search_resume(
-        DistanceComputer& qdis,
-        ResultHandler& res,
-        HNSWSearchCache& cache,
-        int ef,
-        const SearchParameters* params) const {
+namespace {
 
-    HNSWStats stats;
+/// level-0 part of HNSW::search_interleaved
+template <class Termination>
+void search_interleaved_tpl(
+        const HNSW& hnsw,
+        int nq,
+        DistanceComputer** qdis,
+        ResultHandler** res,
+        VisitedTable** vt,
+        std::vector<MinimaxHeap>& candidates,
+        HNSWStats& stats,
+        const IDSelector* sel,
+        const Termination& term) {
+    // per-query states
+    std::vector<Termination> terms(nq, term);
+    std::vector<int> nstep(nq), ndis(nq);
+    std::vector<float> d0s(nq);
+    std::vector<size_t> begins(nq), ends(nq);
+
+    // unvisited neighbors of the node being expanded for each query
+    size_t max_degree = hnsw.nb_neighbors(0);
+    std::vector<storage_idx_t> todo(nq * max_degree);
+    std::vector<int> ntodo(nq);
+
+    std::vector<int> active(nq);
+    for (int q = 0; q < nq; q++) {
+        active[q] = q;
+        MinimaxHeap& cand = candidates[q];
+        for (int i = 0; i < cand.size(); i++) {
+            idx_t v1 = cand.ids[i];
+            float d = cand.dis[i];
+            if (!sel || sel->is_member(v1)) {
+                if (d < res[q]->threshold) {
+                    res[q]->add_result(d, v1);
+                }
+            }
+            vt[q]->set(v1);
+        }
+    }
+    int nactive = nq;
 
-    std::string term_method = []() { 
-        const char* s = std::getenv("HNSW_TERMINATION_METHOD"); 
-        return s ? std::string(s) : "ef_search"; 
-    }();
+    while (nactive > 0) {
+        // pop the next node of each query and prefetch its neighbor list
+        int na = 0;
+        for (int a = 0; a < nactive; a++) {
+            int q = active[a];
+            MinimaxHeap& cand = candidates[q];
+            if (cand.size() == 0) {
+                continue;
+            }
+            float d0 = 0;
+            int v0 = cand.pop_min(&d0);
+            if (terms[q].stop_before_expand(
+                        d0, cand, nstep[q], ndis[q], res[q]->threshold)) {
+                continue;
+            }
+            d0s[q] = d0;
+            hnsw.neighbor_range(v0, 0, &begins[q], &ends[q]);
+            prefetch_L2(hnsw.neighbors.data() + begins[q]);
+            active[na++] = q;
+        }
+        nactive = na;
+
+        // collect the unvisited neighbors and prefetch their vectors
+        for (int a = 0; a < nactive; a++) {
+            int q = active[a];
+            storage_idx_t* todo_q = todo.data() + q * max_degree;
+            int nt = 0;
+            for (size_t j = begins[q]; j < ends[q]; j++) {
+                storage_idx_t v1 = hnsw.neighbors[j];
+                if (v1 < 0) {
+                    break;
+                }
+                if (vt[q]->get(v1)) {
+                    continue;
+                }
+                vt[q]->set(v1);
+                todo_q[nt++] = v1;
+                qdis[q]->prefetch(v1);
+            }
+            ntodo[q] = nt;
+        }
 
-    int hardlimit_nodes = []() { 
-        const char* s = std::getenv("HNSW_HARDLIMIT_MAX_NODES"); 
-        return s ? std::atoi(s) : 0; 
-    }();
+        // compute the distances, by then hopefully in cache
+        na = 0;
+        for (int a = 0; a < nactive; a++) {
+            int q = active[a];
+            ResultHandler& r = *res[q];
+            MinimaxHeap& cand = candidates[q];
+            DistanceComputer& dis_q = *qdis[q];
+            const storage_idx_t* todo_q = todo.data() + q * max_degree;
+            int nt = ntodo[q];
+            bool improved = false;
+
+            auto add_to_heap = [&](idx_t idx, float dis) {
+                if (!sel || sel->is_member(idx)) {
+                    if (dis < r.threshold) {
+                        improved |= r.add_result(dis, idx);
+                    }
+                }
+                cand.push(idx, dis);
+            };
 
-    if (!cache.initialized) {
+            int j = 0;
+            for (; j + 4 <= nt; j += 4) {
+                float dis[4];
+                dis_q.distances_batch_4(
+                        todo_q[j],
+                        todo_q[j + 1],
+                        todo_q[j + 2],
+                        todo_q[j + 3],
+                        dis[0],
+                        dis[1],
+                        dis[2],
+                        dis[3]);
+                for (int id4 = 0; id4 < 4; id4++) {
+                    add_to_heap(todo_q[j + id4], dis[id4]);
+                }
+            }
+            for (; j < nt; j++) {
+                add_to_heap(todo_q[j], dis_q(todo_q[j]));
+            }
+            ndis[q] += nt;
+            nstep[q]++;
+
+            if (!terms[q].stop_after_expand(
+                        d0s[q],
+                        cand,
+                        nstep[q],
+                        ndis[q],
+                        r.threshold,
+                        improved)) {
+                active[na++] = q;
+            }
+        }
+        nactive = na;
+    }
 
-        cache.vt.advance();
+    for (int q = 0; q < nq; q++) {
+        stats.n1++;
+        if (candidates[q].size() == 0) {
+            stats.n2++;
+        }
+        stats.ndis += ndis[q];
+        stats.nhops += nstep[q];
+    }
+}
 
-        // greedy upper layer descent
+} // anonymous namespace
+
+HNSWStats HNSW::search_interleaved(
+        int nq,
+        DistanceComputer** qdis,
+        ResultHandler** res,
+        VisitedTable** vt,
+        const SearchParameters* params) const {
+    HNSWStats stats;
+    if (entry_point == -1 || nq == 0) {
+        return stats;
+    }
+
+    TerminationParams tp;
+    const IDSelector* sel;
+    extract_search_params(*this, params, tp, sel);
+    bool bounded_queue = this->search_bounded_queue;
+    if (const SearchParametersHNSW* hnsw_params =
+                dynamic_cast<const SearchParametersHNSW*>(params)) {
+        bounded_queue = hnsw_params->bounded_queue;
+    }
+    FAISS_THROW_IF_NOT_MSG(
+            bounded_queue,
+            "interleaved search requires a bounded queue");
+
+    // greedy search on upper levels, one query at a time
+    std::vector<MinimaxHeap> candidates;
+    candidates.reserve(nq);
+    for (int q = 0; q < nq; q++) {
         storage_idx_t nearest = entry_point;
-        float d_nearest = qdis(nearest);
+        float d_nearest = (*qdis[q])(nearest);
 
-        // greedy descent upper levels
         for (int level = max_level; level >= 1; level--) {
-            greedy_update_nearest(
-                *this, qdis, level, nearest, d_nearest);
+            stats.combine(greedy_update_nearest(
+                    *this, *qdis[q], level, nearest, d_nearest));
         }
 
-        cache.candidates.clear();
-        cache.candidates.push(nearest, d_nearest);
-        cache.vt.set(nearest);
+        int k = extract_k_from_ResultHandler(*res[q]);
+        candidates.emplace_back(std::max(tp.efSearch, k));
+        candidates[q].push(nearest, d_nearest);
+    }
 
-        cache.initialized = true;
+    with_termination_policy(tp, [&](auto& term) {
+        search_interleaved_tpl(
+                *this, nq, qdis, res, vt, candidates, stats, sel, term);
+    });
+
+    for (int q = 0; q < nq; q++) {
+        vt[q]->advance();
     }
 
+    return stats;
+}
+
+namespace {
+
+template <class VisitedSet, class Termination>
+void search_resume_tpl(
+        const HNSW& hnsw,
+        DistanceComputer& qdis,
+        ResultHandler& res,
+        HNSWSearchCache& cache,
+        VisitedSet& visited,
+        HNSWStats& stats,
+        const IDSelector* sel,
+        Termination& term) {
     int nstep = 0;
+    size_t ndis = 0;
+    bool improved = false;
 
-    while (cache.candidates.size() > 0) {
+    // the patience counts the non-improving steps of the previous calls
+    if constexpr (std::is_same_v<Termination, TerminationPatience>) {
+        term.nstep_no_improvement = cache.nstep_no_improvement;
+    } else if constexpr (std::is_same_v<Termination, TerminationCustom>) {
+        term.progress.nstep_no_improvement = cache.nstep_no_improvement;
+    }
+
+    auto add_to_heap = [&](storage_idx_t v1, float dis) {
+        if (!sel || sel->is_member(v1)) {
+            if (dis < res.threshold) {
+                improved |= res.add_result(dis, v1);
+            }
+        }
+        cache.candidates.push(v1, dis);
+    };
 
+    while (cache.candidates.size() > 0) {
         float d0;
         storage_idx_t v0 = cache.candidates.pop_min(&d0);
 
-        if (term_method == "ef_search") {
-            int n_dis_below = cache.candidates.count_below(d0);
-            if (n_dis_below >= ef) {
-                // Put the unexpanded node back into the cache so it can be resumed later
-                cache.candidates.push(v0, d0);
-                break;
-            }
+        if (term.stop_before_expand(
+                    d0, cache.candidates, nstep, ndis, res.threshold)) {
+            // Put the unexpanded node back into the cache so it can be
+            // resumed later
+            cache.candidates.push(v0, d0);
+            break;
         }
 
         size_t begin, end;
-        neighbor_range(v0, 0, &begin, &end);
+        hnsw.neighbor_range(v0, 0, &begin, &end);
 
+        // same batching by 4 as search_from_candidates_tpl
+        improved = false;
+        int counter = 0;
+        storage_idx_t saved_j[4];
         for (size_t j = begin; j < end; j++) {
+            storage_idx_t v1 = hnsw.neighbors[j];
+            if (v1 < 0) {
+                break;
+            }
+            if (visited.get(v1)) {
+                continue;
+            }
+            visited.set(v1);
+            saved_j[counter++] = v1;
 
-            storage_idx_t v1 = neighbors[j];
-            if (v1 < 0) break;
+            if (counter == 4) {
+                float dis[4];
+                qdis.distances_batch_4(
+                        saved_j[0],
+                        saved_j[1],
+                        saved_j[2],
+                        saved_j[3],
+                        dis[0],
+                        dis[1],
+                        dis[2],
+                        dis[3]);
+                for (int id4 = 0; id4 < 4; id4++) {
+                    add_to_heap(saved_j[id4], dis[id4]);
+                }
+                ndis += 4;
+                counter = 0;
+            }
+        }
 
-            if (cache.vt.get(v1))
-                continue;
+        for (int icnt = 0; icnt < counter; icnt++) {
+            add_to_heap(saved_j[icnt], qdis(saved_j[icnt]));
+            ndis++;
+        }
 
-            cache.vt.set(v1);
+        nstep++;
+        cache.nstep++;
+        cache.nstep_no_improvement =
+                improved ? 0 : cache.nstep_no_improvement + 1;
+
+        if (term.stop_after_expand(
+                    d0,
+                    cache.candidates,
+                    nstep,
+                    ndis,
+                    res.threshold,
+                    improved)) {
+            break;
+        }
+    }
 
-            float dis = qdis(v1);
+    stats.ndis += ndis;
+    stats.nhops += nstep;
+}
 
-            if (dis < res.threshold) {
-                res.add_result(dis, v1);
+} // anonymous namespace
+
+/**************************************************************
+ * HNSWSearchTrace
+ **************************************************************/
+
+namespace {
+
+// 0 is the id of no trace in the thread caches
+std::atomic<uint64_t> next_trace_id{1};
+
+} // anonymous namespace
+
+HNSWSearchTrace::HNSWSearchTrace(
+        size_t capacity,
+        idx_t sample_period,
+        int nthread)
+        : capacity(capacity),
+          sample_period(sample_period),
+          trace_id(next_trace_id++) {
+    FAISS_THROW_IF_NOT(capacity > 0);
+    FAISS_THROW_IF_NOT(sample_period > 0);
+    if (nthread <= 0) {
+        nthread = omp_get_max_threads();
+    }
+    for (int i = 0; i < nthread; i++) {
+        buffers.emplace_back(new ThreadBuffer());
+        buffers.back()->records.resize(capacity);
+    }
+}
+
+void HNSWSearchTrace::begin_query(idx_t query) {
+    ThreadCache& cache = thread_cache();
+    if (cache.trace_id != trace_id) {
+        // first query of this thread since it used another trace
+        std::lock_guard<std::mutex> lock(mutex);
+        ThreadBuffer*& buf = thread_buffers[std::this_thread::get_id()];
+        if (!buf) {
+            if (thread_buffers.size() > buffers.size()) {
+                buffers.emplace_back(new ThreadBuffer());
+                buffers.back()->records.resize(capacity);
             }
+            buf = buffers[thread_buffers.size() - 1].get();
+        }
+        cache.trace_id = trace_id;
+        cache.buffer = buf;
+    }
+    // sample on the order in which the queries begin, not on their number
+    // in the batch, so that the rate is the same for small batches
+    idx_t rank = nquery++;
+    cache.buffer->query = rank % sample_period == 0 ? query : -1;
+}
 
-            cache.candidates.push(v1, dis);
+size_t HNSWSearchTrace::nrecords() const {
+    std::lock_guard<std::mutex> lock(mutex);
+    size_t n = 0;
+    for (const auto& buf : buffers) {
+        n += std::min(buf->nwritten, capacity);
+    }
+    return n;
+}
+
+size_t HNSWSearchTrace::noverwritten() const {
+    std::lock_guard<std::mutex> lock(mutex);
+    size_t n = 0;
+    for (const auto& buf : buffers) {
+        n += buf->nwritten - std::min(buf->nwritten, capacity);
+    }
+    return n;
+}
+
+void HNSWSearchTrace::get_records(
+        idx_t* query,
+        int32_t* nstep,
+        int32_t* ncandidates,
+        int64_t* ndis,
+        float* threshold) const {
+    std::lock_guard<std::mutex> lock(mutex);
+    size_t ofs = 0;
+    for (const auto& buf : buffers) {
+        size_t n = std::min(buf->nwritten, capacity);
+        size_t begin = buf->nwritten - n;
+        for (size_t i = begin; i < buf->nwritten; i++) {
+            const Record& rec = buf->records[i % capacity];
+            query[ofs] = rec.query;
+            nstep[ofs] = rec.nstep;
+            ncandidates[ofs] = rec.ncandidates;
+            ndis[ofs] = rec.ndis;
+            threshold[ofs] = rec.threshold;
+            ofs++;
         }
+    }
+}
 
-        stats.nhops++;
-        nstep++;
+void HNSWSearchTrace::reset() {
+    std::lock_guard<std::mutex> lock(mutex);
+    for (auto& buf : buffers) {
+        buf->nwritten = 0;
+        buf->query = -1;
+    }
+    nquery = 0;
+}
 
-        if (term_method == "hardlimit") {
-            if (hardlimit_nodes > 0 && nstep >= hardlimit_nodes) {
-                break;
-            }
+/**************************************************************
+ * Conformal termination
+ **************************************************************/
+
+float HNSWConformalTermination::score(float dist_k, bool found, size_t step)
+        const {
+    // unfound neighbors have the maximum uncertainty
+    float norm_score = 1.0f;
+    if (found && std::isfinite(dist_k)) {
+        norm_score = std::min(dist_k / max_dist, 1.0f);
+    }
+    float raw_score = (1.0f - norm_score) +
+            gamma * std::max(0.0f, float(step) - float(c_reg));
+    return raw_score / max_reg_val;
+}
+
+HNSWStats HNSW::search_resume(
+        DistanceComputer& qdis,
+        ResultHandler& res,
+        HNSWSearchCache& cache,
+        int ef,
+        const SearchParameters* params) const {
+    HNSWStats stats;
+
+    TerminationParams tp;
+    const IDSelector* sel;
+    extract_search_params(*this, params, tp, sel);
+    // the resumable search always uses the bounded stopping rule with the
+    // ef given by the caller
+    tp.efSearch = ef;
+    tp.do_dis_check = true;
+
+    if (!cache.initialized) {
+        if (cache.visited_type == HNSW_VISITED_HASHSET) {
+            cache.visited_hash.advance();
+        } else {
+            cache.vt.advance();
+        }
+
+        // greedy upper layer descent
+        storage_idx_t nearest = entry_point;
+        float d_nearest = qdis(nearest);
+
+        for (int level = max_level; level >= 1; level--) {
+            stats.combine(
+                    greedy_update_nearest(*this, qdis, level, nearest, d_nearest));
         }
+
+        cache.candidates.clear();
+        cache.candidates.push(nearest, d_nearest);
+        cache.nstep = 0;
+        cache.nstep_no_improvement = 0;
+        if ((!sel || sel->is_member(nearest)) && d_nearest < res.threshold) {
+            res.add_result(d_nearest, nearest);
+        }
+        if (cache.visited_type == HNSW_VISITED_HASHSET) {
+            cache.visited_hash.set(nearest);
+        } else {
+            cache.vt.set(nearest);
+        }
+
+        cache.initialized = true;
     }
 
+    with_termination_policy(tp, [&](auto& term) {
+        if (cache.visited_type == HNSW_VISITED_HASHSET) {
+            search_resume_tpl(
+                    *this,
+                    qdis,
+                    res,
+                    cache,
+                    cache.visited_hash,
+                    stats,
+                    sel,
+                    term);
+        } else {
+            search_resume_tpl(
+                    *this, qdis, res, cache, cache.vt, stats, sel, term);
+        }
+    });
+
     return stats;
 }
 
@@ -1574,6 +2322,318 @@ void HNSW::permute_entries(const idx_t* map) {
     std::swap(levels, new_levels);
     std::swap(offsets, new_offsets);
     neighbors = std::move(new_neighbors);
+    if (!deleted.empty()) {
+        deleted.resize(ntotal);
+        std::vector<uint8_t> new_deleted(ntotal);
+        for (int i = 0; i < ntotal; i++) {
+            new_deleted[i] = deleted[map[i]];
+        }
+        std::swap(deleted, new_deleted);
+    }
+}
+
+/**************************************************************
+ * Deletion
+ **************************************************************/
+
+bool HNSW::mark_deleted(storage_idx_t id) {
+    FAISS_THROW_IF_NOT(id >= 0 && size_t(id) < levels.size());
+    if (deleted.size() < levels.size()) {
+        deleted.resize(levels.size());
+    }
+    if (deleted[id]) {
+        return false;
+    }
+    deleted[id] = 1;
+    ndeleted_linked++;
+    return true;
+}
+
+bool HNSW::repair_neighbors(
+        DistanceComputer& qdis,
+        storage_idx_t pt_id,
+        int level,
+        bool keep_max_size_level0) {
+    size_t begin, end;
+    neighbor_range(pt_id, level, &begin, &end);
+
+    bool has_deleted = false;
+    for (size_t j = begin; j < end && neighbors[j] >= 0; j++) {
+        if (is_deleted(neighbors[j])) {
+            has_deleted = true;
+            break;
+        }
+    }
+    if (!has_deleted) {
+        return false;
+    }
+
+    // candidates: the live neighbors and the live neighbors of the deleted
+    // neighbors (that are still linked, so their lists are intact)
+    std::unordered_set<storage_idx_t> seen = {pt_id};
+    std::priority_queue<NodeDistCloser> candidates;
+    auto add_candidate = [&](storage_idx_t v) {
+        if (!is_deleted(v) && seen.insert(v).second) {
+            candidates.emplace(qdis.symmetric_dis(pt_id, v), v);
+        }
+    };
+    for (size_t j = begin; j < end && neighbors[j] >= 0; j++) {
+        storage_idx_t v = neighbors[j];
+        if (!is_deleted(v)) {
+            add_candidate(v);
+            continue;
+        }
+        size_t begin2, end2;
+        neighbor_range(v, level, &begin2, &end2);
+        for (size_t j2 = begin2; j2 < end2 && neighbors[j2] >= 0; j2++) {
+            add_candidate(neighbors[j2]);
+        }
+    }
+
+    ::faiss::shrink_neighbor_list(
+            qdis, candidates, end - begin, keep_max_size_level0);
+
+    size_t i = begin;
+    while (!candidates.empty()) {
+        neighbors[i++] = candidates.top().id;
+        candidates.pop();
+    }
+    while (i < end) {
+        neighbors[i++] = -1;
+    }
+    return true;
+}
+
+void HNSW::unlink_deleted() {
+    storage_idx_t ntotal = levels.size();
+    for (size_t i = 0; i < deleted.size(); i++) {
+        if (!deleted[i]) {
+            continue;
+        }
+        for (size_t j = offsets[i]; j < offsets[i + 1]; j++) {
+            neighbors[j] = -1;
+        }
+    }
+    if (entry_point >= 0 && is_deleted(entry_point)) {
+        entry_point = -1;
+        max_level = -1;
+        for (storage_idx_t i = 0; i < ntotal; i++) {
+            if (!is_deleted(i) && levels[i] - 1 > max_level) {
+                max_level = levels[i] - 1;
+                entry_point = i;
+            }
+        }
+    }
+    ndeleted_linked = 0;
+}
+
+namespace {
+
+/// level-0 adjacency of the graph in CSR format
+struct Level0Graph {
+    std::vector<size_t> lims;
+    std::vector<storage_idx_t> adj;
+
+    size_t degree(storage_idx_t i) const {
+        return lims[i + 1] - lims[i];
+    }
+};
+
+Level0Graph get_level0_graph(const HNSW& hnsw) {
+    size_t ntotal = hnsw.levels.size();
+    Level0Graph g;
+    g.lims.resize(ntotal + 1);
+    for (size_t i = 0; i < ntotal; i++) {
+        size_t begin, end;
+        hnsw.neighbor_range(i, 0, &begin, &end);
+        for (size_t j = begin; j < end && hnsw.neighbors[j] >= 0; j++) {
+            g.adj.push_back(hnsw.neighbors[j]);
+        }
+        g.lims[i + 1] = g.adj.size();
+    }
+    return g;
+}
+
+Level0Graph transpose_graph(const Level0Graph& g) {
+    size_t ntotal = g.lims.size() - 1;
+    Level0Graph gt;
+    gt.lims.resize(ntotal + 1);
+    for (storage_idx_t u : g.adj) {
+        gt.lims[u + 1]++;
+    }
+    for (size_t i = 0; i < ntotal; i++) {
+        gt.lims[i + 1] += gt.lims[i];
+    }
+    gt.adj.resize(g.adj.size());
+    std::vector<size_t> wp(gt.lims.begin(), gt.lims.end() - 1);
+    for (size_t i = 0; i < ntotal; i++) {
+        for (size_t j = g.lims[i]; j < g.lims[i + 1]; j++) {
+            gt.adj[wp[g.adj[j]]++] = i;
+        }
+    }
+    return gt;
+}
+
+/** BFS from the nodes of starts, in that order, until all nodes are
+ * placed. If by_degree, the neighbors are visited by increasing degree */
+void bfs_order(
+        const Level0Graph& g,
+        const std::vector<storage_idx_t>& starts,
+        bool by_degree,
+        std::vector<storage_idx_t>& order) {
+    size_t ntotal = g.lims.size() - 1;
+    std::vector<bool> placed(ntotal);
+    std::vector<storage_idx_t> neigh;
+    order.clear();
+    order.reserve(ntotal);
+    size_t head = 0;
+    for (storage_idx_t start : starts) {
+        if (placed[start]) {
+            continue;
+        }
+        placed[start] = true;
+        order.push_back(start);
+        while (head < order.size()) {
+            storage_idx_t v = order[head++];
+            neigh.assign(g.adj.begin() + g.lims[v], g.adj.begin() + g.lims[v + 1]);
+            if (by_degree) {
+                std::stable_sort(
+                        neigh.begin(),
+                        neigh.end(),
+                        [&](storage_idx_t a, storage_idx_t b) {
+                            return g.degree(a) < g.degree(b);
+                        });
+            }
+            for (storage_idx_t u : neigh) {
+                if (!placed[u]) {
+                    placed[u] = true;
+                    order.push_back(u);
+                }
+            }
+        }
+    }
+}
+
+/** Gorder (Wei et al., "Speedup Graph Processing by Graph Ordering",
+ * SIGMOD'16) with a lazy max-heap instead of the unit heap. The score of a
+ * candidate is the nb of edges plus the nb of common in-neighbors it has
+ * with the last `window` placed nodes. */
+void gorder_order(
+        const Level0Graph& g,
+        storage_idx_t start,
+        int window,
+        std::vector<storage_idx_t>& order) {
+    size_t ntotal = g.lims.size() - 1;
+    Level0Graph gt = transpose_graph(g);
+    std::vector<int> score(ntotal);
+    std::vector<bool> placed(ntotal);
+    std::priority_queue<std::pair<int, storage_idx_t>> heap;
+
+    auto update = [&](storage_idx_t u, int delta) {
+        if (placed[u]) {
+            return;
+        }
+        score[u] += delta;
+        if (score[u] > 0) {
+            heap.emplace(score[u], u);
+        }
+    };
+
+    // add or remove node v from the window
+    auto update_window = [&](storage_idx_t v, int delta) {
+        for (size_t j = g.lims[v]; j < g.lims[v + 1]; j++) {
+            update(g.adj[j], delta);
+        }
+        for (size_t j = gt.lims[v]; j < gt.lims[v + 1]; j++) {
+            storage_idx_t x = gt.adj[j];
+            update(x, delta);
+            for (size_t l = g.lims[x]; l < g.lims[x + 1]; l++) {
+                if (g.adj[l] != v) {
+                    update(g.adj[l], delta);
+                }
+            }
+        }
+    };
+
+    order.clear();
+    order.reserve(ntotal);
+    size_t next_unplaced = 0;
+    for (size_t i = 0; i < ntotal; i++) {
+        storage_idx_t v = -1;
+        if (i == 0) {
+            v = start;
+        }
+        while (v < 0 && !heap.empty()) {
+            auto top = heap.top();
+            heap.pop();
+            // skip outdated entries
+            if (!placed[top.second] && score[top.second] == top.first) {
+                v = top.second;
+            }
+        }
+        if (v < 0) {
+            // no node related to the window: take the next one in id order
+            while (placed[next_unplaced]) {
+                next_unplaced++;
+            }
+            v = next_unplaced;
+        }
+        placed[v] = true;
+        order.push_back(v);
+        update_window(v, 1);
+        if (order.size() > size_t(window)) {
+            update_window(order[order.size() - 1 - window], -1);
+        }
+    }
+}
+
+} // anonymous namespace
+
+void HNSW::reorder_permutation(
+        HNSWReorderMethod method,
+        idx_t* perm,
+        int gorder_window) const {
+    size_t ntotal = levels.size();
+    if (ntotal == 0) {
+        return;
+    }
+    Level0Graph g = get_level0_graph(*this);
+    storage_idx_t start = entry_point >= 0 ? entry_point : 0;
+    std::vector<storage_idx_t> order;
+
+    switch (method) {
+        case HNSW_REORDER_BFS: {
+            std::vector<storage_idx_t> starts(ntotal + 1);
+            starts[0] = start;
+            std::iota(starts.begin() + 1, starts.end(), 0);
+            bfs_order(g, starts, false, order);
+            break;
+        }
+        case HNSW_REORDER_RCM: {
+            std::vector<storage_idx_t> starts(ntotal);
+            std::iota(starts.begin(), starts.end(), 0);
+            std::stable_sort(
+                    starts.begin(),
+                    starts.end(),
+                    [&](storage_idx_t a, storage_idx_t b) {
+                        return g.degree(a) < g.degree(b);
+                    });
+            bfs_order(g, starts, true, order);
+            std::reverse(order.begin(), order.end());
+            break;
+        }
+        case HNSW_REORDER_GORDER:
+            FAISS_THROW_IF_NOT(gorder_window > 0);
+            gorder_order(g, start, gorder_window, order);
+            break;
+        default:
+            FAISS_THROW_FMT("unknown reorder method %d", int(method));
+    }
+
+    FAISS_ASSERT(order.size() == ntotal);
+    for (size_t i = 0; i < ntotal; i++) {
+        perm[i] = order[i];
+    }
 }
 
 /**************************************************************
@@ -1829,4 +2889,132 @@ int HNSW::MinimaxHeap::count_below(float thresh) {
     return n_below;
 }
 
-} // namespace faiss
\ No newline at end of file
+/**************************************************************
+ * HNSWSearchCachePool
+ **************************************************************/
+
+HNSWSearchCachePool::HNSWSearchCachePool(
+        size_t max_memory,
+        int max_candidates,
+        HNSWVisitedSetType visited_type)
+        : max_memory(max_memory),
+          max_candidates(max_candidates),
+          visited_type(visited_type) {
+    FAISS_THROW_IF_NOT(max_candidates > 0);
+}
+
+HNSWSearchCache* HNSWSearchCachePool::acquire(idx_t session_id) {
+    std::lock_guard<std::mutex> lock(mutex);
+    auto it = entries.find(session_id);
+    if (it != entries.end()) {
+        Entry& e = it->second;
+        FAISS_THROW_IF_NOT_FMT(
+                !e.in_use,
+                "session %" PRId64 " is already in use",
+                int64_t(session_id));
+        e.in_use = true;
+        lru.splice(lru.begin(), lru, e.lru_pos);
+        nhit++;
+        return e.cache.get();
+    }
+    Entry& e = entries[session_id];
+    e.cache.reset(new HNSWSearchCache(max_candidates, visited_type));
+    e.memory = e.cache->memory_usage();
+    e.in_use = true;
+    lru.push_front(session_id);
+    e.lru_pos = lru.begin();
+    total_memory += e.memory;
+    nmiss++;
+    return e.cache.get();
+}
+
+void HNSWSearchCachePool::release(idx_t session_id) {
+    std::lock_guard<std::mutex> lock(mutex);
+    auto it = entries.find(session_id);
+    FAISS_THROW_IF_NOT_FMT(
+            it != entries.end() && it->second.in_use,
+            "session %" PRId64 " is not in use",
+            int64_t(session_id));
+    Entry& e = it->second;
+    e.in_use = false;
+    total_memory -= e.memory;
+    e.memory = e.cache->memory_usage();
+    total_memory += e.memory;
+    evict();
+}
+
+void HNSWSearchCachePool::evict() {
+    if (max_memory == 0) {
+        return;
+    }
+    auto pos = lru.end();
+    while (total_memory > max_memory && pos != lru.begin()) {
+        --pos;
+        auto it = entries.find(*pos);
+        if (it->second.in_use) {
+            continue;
+        }
+        total_memory -= it->second.memory;
+        entries.erase(it);
+        pos = lru.erase(pos);
+        nevict++;
+    }
+}
+
+bool HNSWSearchCachePool::remove(idx_t session_id) {
+    std::lock_guard<std::mutex> lock(mutex);
+    auto it = entries.find(session_id);
+    if (it == entries.end()) {
+        return false;
+    }
+    FAISS_THROW_IF_NOT_FMT(
+            !it->second.in_use,
+            "session %" PRId64 " is in use",
+            int64_t(session_id));
+    total_memory -= it->second.memory;
+    lru.erase(it->second.lru_pos);
+    entries.erase(it);
+    return true;
+}
+
+bool HNSWSearchCachePool::contains(idx_t session_id) const {
+    std::lock_guard<std::mutex> lock(mutex);
+    return entries.count(session_id) > 0;
+}
+
+size_t HNSWSearchCachePool::size() const {
+    std::lock_guard<std::mutex> lock(mutex);
+    return entries.size();
+}
+
+size_t HNSWSearchCachePool::memory_usage() const {
+    std::lock_guard<std::mutex> lock(mutex);
+    return total_memory;
+}
+
+double HNSWSearchCachePool::hit_rate() const {
+    std::lock_guard<std::mutex> lock(mutex);
+    size_t nacquire = nhit + nmiss;
+    return nacquire == 0 ? 0.0 : double(nhit) / nacquire;
+}
+
+void HNSWSearchCachePool::reset_stats() {
+    std::lock_guard<std::mutex> lock(mutex);
+    nhit = nmiss = nevict = 0;
+}
+
+void HNSWSearchCachePool::clear() {
+    std::lock_guard<std::mutex> lock(mutex);
+    for (auto pos = lru.begin(); pos != lru.end();) {
+        auto it = entries.find(*pos);
+        if (it->second.in_use) {
+            ++pos;
+            continue;
+        }
+        total_memory -= it->second.memory;
+        entries.erase(it);
+        pos = lru.erase(pos);
+    }
+}
+
+} // namespace faiss
@@ -7,7 +7,13 @@
 
 #pragma once
 
+#include <atomic>
+#include <list>
+#include <memory>
+#include <mutex>
 #include <queue>
+#include <thread>
+#include <unordered_map>
 #include <vector>
 
 #include <omp.h>
@@ -44,16 +50,267 @@ struct IndexHNSWFlatPanorama;
  */
 
 struct VisitedTable;
+struct VisitedHashSet;
 struct DistanceComputer; // from AuxIndexStructures
 struct HNSWStats;
 
 struct HNSWSearchCache;
 
+/// stopping rule applied by the level-0 beam search
+enum HNSWTerminationMethod {
+    /// standard rule: stop when efSearch candidates are closer than the
+    /// next one to expand (or after efSearch hops without distance check)
+    HNSW_TERMINATION_EF_SEARCH = 0,
+    /// stop after `patience` consecutive hops that did not improve the
+    /// result set
+    HNSW_TERMINATION_PATIENCE = 1,
+    /// stop after expanding `hardlimit_max_nodes` nodes
+    HNSW_TERMINATION_HARDLIMIT = 2,
+    /// stop when the next candidate is farther than `radiuslimit_radius`
+    HNSW_TERMINATION_RADIUSLIMIT = 3,
+    /// delegate the decision to a user-provided HNSWTerminationCallback
+    HNSW_TERMINATION_CUSTOM = 4,
+    /// calibrated per-query early termination, see HNSWConformalTermination
+    HNSW_TERMINATION_CONFORMAL = 5,
+};
+
+/// state of a level-0 beam search, passed to custom termination callbacks
+struct HNSWSearchProgress {
+    /// distance of the candidate about to be expanded (before_expand) or
+    /// that was just expanded (after_expand)
+    float d0 = 0;
+    /// current worst distance of the result handler (k-th distance)
+    float threshold = 0;
+    /// number of nodes expanded so far
+    int nstep = 0;
+    /// number of distances computed so far
+    size_t ndis = 0;
+    /// number of valid entries in the candidate queue
+    int ncandidates = 0;
+    /// number of consecutive hops that did not improve the result set
+    int nstep_no_improvement = 0;
+    /// true in the call made after a node is expanded
+    bool after_expand = false;
+};
+
+/** User-defined termination rule for HNSW search.
+ *
+ * should_stop is called once before and once after each node expansion on
+ * level 0. It is called concurrently from several threads, so it should
+ * not modify shared state: all per-query state is in the progress object.
+ */
+struct HNSWTerminationCallback {
+    virtual bool should_stop(const HNSWSearchProgress& progress) const = 0;
+    virtual ~HNSWTerminationCallback() {}
+};
+
+/** Calibrated parameters of the conformal (ConANN-style) early termination.
+ *
+ * The search of each query is resumed through the `schedule` of efforts
+ * (interpreted with `schedule_method`, as in
+ * IndexHNSW::search_checkpoints). After each checkpoint, the regularized
+ * non-conformity score of the current k-th neighbor is computed, and the
+ * search stops as soon as it exceeds lambda_hat. The parameters are
+ * obtained with calibrate_termination (Python), so that the expected
+ * false negative rate on queries from the calibration distribution is
+ * bounded by the target alpha.
+ */
+struct HNSWConformalTermination {
+    /// how the schedule values are interpreted (not CUSTOM or CONFORMAL)
+    HNSWTerminationMethod schedule_method = HNSW_TERMINATION_EF_SEARCH;
+    /// non-decreasing efforts
+    std::vector<float> schedule;
+
+    /// calibrated threshold on the regularized score
+    float lambda_hat = 1;
+    /// penalty per checkpoint beyond c_reg
+    float gamma = 0.01;
+    int c_reg = 2;
+    /// normalization of the k-th distance
+    float max_dist = 1;
+    /// normalization of the regularized score
+    float max_reg_val = 1;
+
+    /** regularized non-conformity score after checkpoint `step`
+     *
+     * @param dist_k  distance of the k-th result
+     * @param found   whether k results were found
+     */
+    float score(float dist_k, bool found, size_t step) const;
+};
+
+/** Opt-in trace of the level-0 beam search, to sample convergence traces.
+ *
+ * One record is written per expanded node. Each thread writes to its own
+ * preallocated ring buffer, so that recording does not allocate, lock or
+ * do I/O. When a buffer is full, its oldest records are overwritten.
+ * The buffers are assigned to the calling threads when they begin their
+ * first query, so the trace can be shared by searches that run in
+ * different threads, with or without OpenMP.
+ */
+struct HNSWSearchTrace {
+    struct Record {
+        idx_t query;         ///< query number
+        int32_t nstep;       ///< nb of nodes expanded so far
+        int32_t ncandidates; ///< nb of entries in the candidate queue
+        int64_t ndis;        ///< nb of distances computed so far
+        float threshold;     ///< current k-th distance
+    };
+
+    size_t capacity;     ///< nb of records per thread
+    idx_t sample_period; ///< trace one query out of sample_period
+
+    /** @param capacity       nb of records per thread
+     *  @param sample_period  trace one query out of sample_period, counted
+     *                        over all the searches that use the trace
+     *  @param nthread        nb of thread buffers allocated upfront
+     *                        (default: omp max), the buffers of additional
+     *                        threads are allocated at their first query */
+    explicit HNSWSearchTrace(
+            size_t capacity = 1 << 16,
+            idx_t sample_period = 1,
+            int nthread = 0);
+
+    /// start recording query #query in the calling thread (if sampled)
+    void begin_query(idx_t query);
+
+    /// record one step of the query of the calling thread
+    void add(int nstep, int ncandidates, size_t ndis, float threshold) {
+        ThreadBuffer* buf = current_buffer();
+        if (buf && buf->query >= 0) {
+            buf->records[buf->nwritten % capacity] = {
+                    buf->query, nstep, ncandidates, int64_t(ndis), threshold};
+            buf->nwritten++;
+        }
+    }
+
+    /// nb of records currently stored
+    size_t nrecords() const;
+
+    /// nb of records that were overwritten
+    size_t noverwritten() const;
+
+    /** copy the stored records, thread by thread, oldest first.
+     * Each array should have size nrecords(). */
+    void get_records(
+            idx_t* query,
+            int32_t* nstep,
+            int32_t* ncandidates,
+            int64_t* ndis,
+            float* threshold) const;
+
+    /// forget all records and restart the sampling
+    void reset();
+
+#ifndef SWIG
+   private:
+    // aligned to avoid false sharing between the threads' write pointers
+    struct alignas(64) ThreadBuffer {
+        std::vector<Record> records;
+        size_t nwritten = 0;
+        idx_t query = -1; ///< query being recorded, -1 if not sampled
+    };
+    // the addresses stay valid when buffers are added
+    std::vector<std::unique_ptr<ThreadBuffer>> buffers;
+    /// buffer of each thread that began a query
+    std::unordered_map<std::thread::id, ThreadBuffer*> thread_buffers;
+    /// protects buffers and thread_buffers
+    mutable std::mutex mutex;
+    /// nb of queries begun, for the sampling
+    std::atomic<idx_t> nquery{0};
+    /// unique id of the trace, so that the buffer cached by a thread is not
+    /// used by another trace allocated at the same address
+    uint64_t trace_id;
+
+    /// last trace used by the calling thread and its buffer in that trace
+    struct ThreadCache {
+        uint64_t trace_id = 0;
+        ThreadBuffer* buffer = nullptr;
+    };
+
+    static ThreadCache& thread_cache() {
+        static thread_local ThreadCache cache;
+        return cache;
+    }
+
+    /// buffer of the calling thread, nullptr if it did not begin a query
+    ThreadBuffer* current_buffer() const {
+        const ThreadCache& cache = thread_cache();
+        return cache.trace_id == trace_id ? cache.buffer : nullptr;
+    }
+#endif
+};
+
+/// node orderings for HNSW::reorder_permutation
+enum HNSWReorderMethod {
+    /// breadth-first traversal of level 0 from the entry point
+    HNSW_REORDER_BFS = 0,
+    /// reverse Cuthill-McKee: BFS from low-degree nodes, visiting the
+    /// neighbors by increasing degree, then reversed
+    HNSW_REORDER_RCM = 1,
+    /// Gorder: greedily place the node that shares the most edges and
+    /// common in-neighbors with the last placed nodes (sliding window)
+    HNSW_REORDER_GORDER = 2,
+};
+
+/** Fixed-size table of spinlocks that protect the neighbor lists during a
+ * parallel add, an alternative to one omp_lock_t per vertex.
+ *
+ * Vertex i is protected by lock i % nlock, so the memory does not grow with
+ * the index size and the locks stay in cache. HNSW::add_with_striped_locks
+ * holds at most one lock at a time, so vertices that share a lock cannot
+ * deadlock.
+ */
+struct HNSWStripedLocks {
+    /// nlock is rounded up to a power of 2
+    explicit HNSWStripedLocks(size_t nlock = 1 << 16);
+
+    size_t nlock() const {
+        return mask + 1;
+    }
+
+    void lock(idx_t i);
+    void unlock(idx_t i);
+
+#ifndef SWIG
+   private:
+    /// one lock per cache line to avoid false sharing
+    struct alignas(64) Stripe {
+        std::atomic<bool> locked{false};
+    };
+    std::unique_ptr<Stripe[]> stripes;
+    size_t mask;
+#endif
+};
+
 struct SearchParametersHNSW : SearchParameters {
     int efSearch = 16;
     bool check_relative_distance = true;
     bool bounded_queue = true;
 
+    /// termination rule, the parameters below are used depending on it
+    HNSWTerminationMethod termination_method = HNSW_TERMINATION_EF_SEARCH;
+    /// HNSW_TERMINATION_PATIENCE: nb of hops without improvement
+    int patience = 20;
+    /// HNSW_TERMINATION_HARDLIMIT: max nb of expanded nodes (0 = no limit)
+    int hardlimit_max_nodes = 0;
+    /// HNSW_TERMINATION_RADIUSLIMIT: max distance of an expanded node
+    float radiuslimit_radius = 0;
+    /// HNSW_TERMINATION_CUSTOM: not owned
+    const HNSWTerminationCallback* termination_callback = nullptr;
+    /// HNSW_TERMINATION_CONFORMAL: not owned, only supported by search()
+    const HNSWConformalTermination* conformal = nullptr;
+    /// if set, record the level-0 search steps (not owned)
+    HNSWSearchTrace* trace = nullptr;
+    /// if > 1, nb of queries that each thread searches in lockstep
+    /// (IndexHNSW::search only, see HNSW::search_interleaved). Not
+    /// compatible with trace.
+    int n_interleave = 1;
+    /// relative margin of the distance estimates of IndexHNSW::prefilter:
+    /// a neighbor is computed exactly if its estimate is below
+    /// threshold + prefilter_margin * |threshold|
+    float prefilter_margin = 0.1;
+
     ~SearchParametersHNSW() {}
 };
 
@@ -154,6 +411,14 @@ struct HNSW {
     /// use Panorama progressive pruning in search
     bool is_panorama = false;
 
+    /// tombstones: deleted[i] != 0 if vertex i was removed, empty if no
+    /// vertex was ever removed. Not serialized.
+    std::vector<uint8_t> deleted;
+
+    /// nb of deleted vertices that are still linked in the graph, ie. that
+    /// were removed after the last unlink_deleted()
+    size_t ndeleted_linked = 0;
+
     // methods that initialize the tree sizes
 
     /// initialize the assign_probas and cum_nneighbor_per_level to
@@ -204,17 +469,52 @@ struct HNSW {
             VisitedTable& vt,
             bool keep_max_size_level0 = false);
 
+    /** same as add_with_locks, but the neighbor lists are protected by a
+     * table of striped locks that are held only while a list is modified,
+     * not during the search for the neighbors of pt_id. */
+    void add_with_striped_locks(
+            DistanceComputer& ptdis,
+            int pt_level,
+            int pt_id,
+            HNSWStripedLocks& locks,
+            VisitedTable& vt,
+            bool keep_max_size_level0 = false);
+
     /// Search interface for 1 point, single thread
     ///
     /// NOTE: We pass a reference to the index itself to allow for additional
     /// state information to be passed (used for Panorama progressive pruning).
     /// The alternative would be to override both HNSW::search and
     /// HNSWIndex::search, which would be a nuisance of code duplication.
+    ///
+    /// If approx_dis is set (same query as qdis), the level-0 neighbors whose
+    /// estimated distance exceeds the result threshold by more than
+    /// SearchParametersHNSW::prefilter_margin are not computed exactly, they
+    /// are queued as candidates with the estimate. Not supported with
+    /// Panorama or an unbounded queue.
     HNSWStats search(
             DistanceComputer& qdis,
             const IndexHNSW* index,
             ResultHandler& res,
             VisitedTable& vt,
+            const SearchParameters* params = nullptr,
+            DistanceComputer* approx_dis = nullptr) const;
+
+    /** Search for nq points in lockstep, single thread.
+     *
+     * At each step, one node is expanded for every query that is still
+     * active. The neighbor lists and then the vectors of the unvisited
+     * neighbors of all queries are prefetched before any distance is
+     * computed, which hides part of the memory latency on large graphs.
+     * Only the bounded queue search is supported.
+     *
+     * qdis, res and vt are arrays of size nq with the per-query states.
+     */
+    HNSWStats search_interleaved(
+            int nq,
+            DistanceComputer** qdis,
+            ResultHandler** res,
+            VisitedTable** vt,
             const SearchParameters* params = nullptr) const;
 
     /// search only in level 0 from a given vertex
@@ -229,6 +529,10 @@ struct HNSW {
             VisitedTable& vt,
             const SearchParameters* params = nullptr) const;
 
+    /** search on level 0 that continues from the state of cache, until
+     * the termination criterion of params with the given ef. The results
+     * are restricted to params->sel, which should not change from one call
+     * to the next. */
     HNSWStats search_resume(
         DistanceComputer& qdis,
         ResultHandler& res,
@@ -252,22 +556,185 @@ struct HNSW {
             bool keep_max_size_level0 = false);
 
     void permute_entries(const idx_t* map);
+
+    /** Compute an ordering of the nodes such that nodes that are traversed
+     * together on level 0 get close ids, to improve memory locality.
+     *
+     * @param perm          output permutation in the format of
+     *                      permute_entries (perm[new id] = old id), size
+     *                      levels.size()
+     * @param gorder_window size of the sliding window for Gorder
+     */
+    void reorder_permutation(
+            HNSWReorderMethod method,
+            idx_t* perm,
+            int gorder_window = 5) const;
+
+    /** mark vertex id as deleted. It is still traversed by the searches but
+     * not returned. Returns false if it was already deleted. */
+    bool mark_deleted(storage_idx_t id);
+
+    bool is_deleted(storage_idx_t id) const {
+        return size_t(id) < deleted.size() && deleted[id];
+    }
+
+    /** replace the deleted neighbors of pt_id at a level by live vertices
+     * taken from the neighbors of pt_id and of its deleted neighbors,
+     * pruned with shrink_neighbor_list. Lists of different vertices can be
+     * repaired in parallel.
+     *
+     * @param qdis  used only for symmetric_dis
+     * @return      whether the list contained deleted vertices
+     */
+    bool repair_neighbors(
+            DistanceComputer& qdis,
+            storage_idx_t pt_id,
+            int level,
+            bool keep_max_size_level0 = false);
+
+    /** clear the neighbor lists of the deleted vertices and move the entry
+     * point to a live vertex. To be called once all the lists of the live
+     * vertices were repaired, then the deleted vertices are unreachable. */
+    void unlink_deleted();
 };
 
+/// data structure used to track visited nodes in a HNSWSearchCache
+enum HNSWVisitedSetType {
+    /// one byte per vector of the index (VisitedTable), fastest
+    HNSW_VISITED_DENSE = 0,
+    /// hash set sized to the nb of visited nodes (VisitedHashSet), for
+    /// many concurrent resumable searches on large indexes
+    HNSW_VISITED_HASHSET = 1,
+};
+
+/** State of a resumable search for one query, see HNSW::search_resume.
+ */
 struct HNSWSearchCache {
-    HNSW::MinimaxHeap candidates;    // Add HNSW:: prefix
+    HNSW::MinimaxHeap candidates;
+    HNSWVisitedSetType visited_type;
+    /// visited nodes, for HNSW_VISITED_DENSE
     VisitedTable vt;
+    /// visited nodes, for HNSW_VISITED_HASHSET
+    VisitedHashSet visited_hash;
     bool initialized = false;
+    /// nb of nodes expanded on level 0 since the search started
+    int nstep = 0;
+    /// nb of expansions since the top-k last improved, so that
+    /// HNSW_TERMINATION_PATIENCE counts across resumed calls
+    int nstep_no_improvement = 0;
 
     std::vector<float> topk_distances;
     std::vector<idx_t> topk_labels;
 
-    explicit HNSWSearchCache(int max_candidates)
-        : candidates(max_candidates),
-          vt(0),
-          initialized(false) {}
+    explicit HNSWSearchCache(
+            int max_candidates,
+            HNSWVisitedSetType visited_type = HNSW_VISITED_DENSE)
+            : candidates(max_candidates),
+              visited_type(visited_type),
+              vt(0),
+              visited_hash(visited_type == HNSW_VISITED_HASHSET
+                                   ? max_candidates
+                                   : 0),
+              initialized(false) {}
+
+    /// make the visited set usable for an index of size ntotal
+    void resize_visited(size_t ntotal) {
+        if (visited_type == HNSW_VISITED_DENSE && vt.visited.size() < ntotal) {
+            vt.visited.resize(ntotal, 0);
+        }
+    }
+
+    /// nb of nodes marked as visited (only for HNSW_VISITED_HASHSET, the
+    /// dense table does not keep a count)
+    size_t visited_count() const {
+        return visited_hash.count;
+    }
+
+    /// memory used by the cache in bytes
+    size_t memory_usage() const {
+        return sizeof(*this) +
+                candidates.ids.capacity() * sizeof(candidates.ids[0]) +
+                candidates.dis.capacity() * sizeof(candidates.dis[0]) +
+                vt.visited.capacity() * sizeof(vt.visited[0]) +
+                visited_hash.memory_usage() +
+                topk_distances.capacity() * sizeof(topk_distances[0]) +
+                topk_labels.capacity() * sizeof(topk_labels[0]);
+    }
 };
 
+/** Pool of resumable search states keyed by a session id (eg. one per
+ * "load more results" pagination session), see
+ * IndexHNSW::search_sessions. The total memory of the caches is bounded by
+ * max_memory: when it is exceeded, the least recently used sessions are
+ * evicted and their next search starts from scratch.
+ *
+ * The pool can be shared between threads, but a session can be used by one
+ * search at a time.
+ */
+struct HNSWSearchCachePool {
+    /// memory budget in bytes (0 = unbounded)
+    size_t max_memory;
+    /// size of the candidate queue of the new caches
+    int max_candidates;
+    /// visited set of the new caches, the hash set is much more compact
+    HNSWVisitedSetType visited_type;
+
+    size_t nhit = 0;   ///< nb of acquired sessions that were in the pool
+    size_t nmiss = 0;  ///< nb of acquired sessions that were created
+    size_t nevict = 0; ///< nb of sessions evicted to fit in the budget
+
+    explicit HNSWSearchCachePool(
+            size_t max_memory,
+            int max_candidates = 64,
+            HNSWVisitedSetType visited_type = HNSW_VISITED_HASHSET);
+
+    /** return the cache of a session, a new one if it is not in the pool,
+     * and mark it as in use (it cannot be evicted until released). */
+    HNSWSearchCache* acquire(idx_t session_id);
+
+    /** end the use of a session: update its memory usage and evict the
+     * least recently used sessions that exceed the budget */
+    void release(idx_t session_id);
+
+    /// forget a session (eg. when it is closed), returns whether it existed
+    bool remove(idx_t session_id);
+
+    /// whether the session is in the pool
+    bool contains(idx_t session_id) const;
+
+    /// nb of sessions in the pool
+    size_t size() const;
+
+    /// memory used by the sessions, as of their last release
+    size_t memory_usage() const;
+
+    /// fraction of the acquired sessions that were found in the pool
+    double hit_rate() const;
+
+    void reset_stats();
+
+    /// remove all sessions that are not in use
+    void clear();
+
+#ifndef SWIG
+   private:
+    struct Entry {
+        std::unique_ptr<HNSWSearchCache> cache;
+        size_t memory = 0;
+        bool in_use = false;
+        std::list<idx_t>::iterator lru_pos;
+    };
+
+    /// evict unused sessions from the LRU end until the budget is met
+    void evict();
+
+    std::unordered_map<idx_t, Entry> entries;
+    /// session ids, most recently used first
+    std::list<idx_t> lru;
+    size_t total_memory = 0;
+    mutable std::mutex mutex;
+#endif
+};
 
 struct HNSWStats {
     size_t n1 = 0; /// number of vectors searched
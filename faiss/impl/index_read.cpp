@@ -10,8 +10,11 @@
 
 #include <faiss/impl/io_macros.h>
 
+#include <algorithm>
 #include <cstdio>
 #include <cstdlib>
+#include <limits>
+#include <memory>
 #include <optional>
 
 #include <faiss/impl/FaissAssert.h>
@@ -552,6 +555,86 @@ static void read_HNSW(HNSW* hnsw, IOReader* f) {
     READ1_DUMMY(int)
 }
 
+HNSWSearchCache* read_HNSWSearchCache(IOReader* f) {
+    uint32_t h;
+    READ1(h);
+    FAISS_THROW_IF_NOT_FMT(
+            h == fourcc("HNsc"),
+            "input is not a HNSWSearchCache (fourcc %s)",
+            fourcc_inv_printable(h).c_str());
+    int visited_type, max_candidates;
+    READ1(visited_type);
+    FAISS_THROW_IF_NOT(
+            visited_type == HNSW_VISITED_DENSE ||
+            visited_type == HNSW_VISITED_HASHSET);
+    READ1(max_candidates);
+    FAISS_THROW_IF_NOT(max_candidates > 0);
+
+    auto cache = std::make_unique<HNSWSearchCache>(
+            max_candidates, HNSWVisitedSetType(visited_type));
+    READ1(cache->initialized);
+    READ1(cache->nstep);
+    READ1(cache->nstep_no_improvement);
+
+    HNSW::MinimaxHeap& candidates = cache->candidates;
+    READ1(candidates.nvalid);
+    std::vector<HNSW::storage_idx_t> cand_ids;
+    std::vector<float> cand_dis;
+    READVECTOR(cand_ids);
+    READVECTOR(cand_dis);
+    FAISS_THROW_IF_NOT(
+            cand_ids.size() == cand_dis.size() &&
+            cand_ids.size() <= size_t(max_candidates) &&
+            candidates.nvalid >= 0 &&
+            candidates.nvalid <= int(cand_ids.size()));
+    candidates.k = cand_ids.size();
+    std::copy(cand_ids.begin(), cand_ids.end(), candidates.ids.begin());
+    std::copy(cand_dis.begin(), cand_dis.end(), candidates.dis.begin());
+    READVECTOR(cache->topk_distances);
+    READVECTOR(cache->topk_labels);
+    FAISS_THROW_IF_NOT(
+            cache->topk_distances.size() == cache->topk_labels.size());
+
+    size_t nvisited;
+    READ1(nvisited);
+    std::vector<uint8_t> visited_codes;
+    READVECTOR(visited_codes);
+    std::vector<HNSW::storage_idx_t> visited(nvisited);
+    size_t ofs = 0;
+    HNSW::storage_idx_t prev = 0;
+    for (size_t i = 0; i < nvisited; i++) {
+        uint32_t delta = 0;
+        for (int shift = 0;; shift += 7) {
+            FAISS_THROW_IF_NOT_MSG(
+                    ofs < visited_codes.size() && shift < 32,
+                    "corrupted visited set");
+            uint8_t c = visited_codes[ofs++];
+            delta |= uint32_t(c & 0x7f) << shift;
+            if (!(c & 0x80)) {
+                break;
+            }
+        }
+        int64_t id = int64_t(prev) + delta;
+        FAISS_THROW_IF_NOT_MSG(
+                id <= std::numeric_limits<int32_t>::max(),
+                "corrupted visited set");
+        prev = id;
+        visited[i] = prev;
+    }
+    if (cache->visited_type == HNSW_VISITED_HASHSET) {
+        for (HNSW::storage_idx_t id : visited) {
+            cache->visited_hash.set(id);
+        }
+    } else {
+        // the table is extended to the index size on the next search
+        cache->resize_visited(nvisited == 0 ? 0 : visited.back() + 1);
+        for (HNSW::storage_idx_t id : visited) {
+            cache->vt.set(id);
+        }
+    }
+    return cache.release();
+}
+
 static void read_NSG(NSG* nsg, IOReader* f) {
     READ1(nsg->ntotal);
     READ1(nsg->R);
@@ -1175,6 +1258,16 @@ Index* read_index(IOReader* f, int io_flags) {
         READ1(idxp->code_size);
         read_vector(idxp->codes, f);
         idx = idxp;
+    } else if (h == fourcc("IHlm")) {
+        std::vector<idx_t> label_map;
+        READVECTOR(label_map);
+        std::unique_ptr<Index> sub_index(read_index(f, io_flags));
+        IndexHNSW* idxhnsw = dynamic_cast<IndexHNSW*>(sub_index.get());
+        FAISS_THROW_IF_NOT_MSG(
+                idxhnsw && label_map.size() == size_t(idxhnsw->ntotal),
+                "invalid HNSW label map");
+        idxhnsw->label_map = std::move(label_map);
+        idx = sub_index.release();
     } else if (
             h == fourcc("IHNf") || h == fourcc("IHNp") || h == fourcc("IHNs") ||
             h == fourcc("IHN2") || h == fourcc("IHNc") || h == fourcc("IHc2") ||
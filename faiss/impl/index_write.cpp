@@ -10,6 +10,7 @@
 #include <faiss/impl/io.h>
 #include <faiss/impl/io_macros.h>
 
+#include <algorithm>
 #include <cstdio>
 #include <cstdlib>
 
@@ -337,6 +338,9 @@ void write_ProductQuantizer(const ProductQuantizer* pq, const char* fname) {
 }
 
 static void write_HNSW(const HNSW* hnsw, IOWriter* f) {
+    FAISS_THROW_IF_NOT_MSG(
+            hnsw->ndeleted_linked == 0,
+            "deleted vertices are not serialized, call compact() first");
     WRITEVECTOR(hnsw->assign_probas);
     WRITEVECTOR(hnsw->cum_nneighbor_per_level);
     WRITEVECTOR(hnsw->levels);
@@ -354,6 +358,62 @@ static void write_HNSW(const HNSW* hnsw, IOWriter* f) {
     WRITE1(tmp_upper_beam);
 }
 
+void write_HNSWSearchCache(const HNSWSearchCache* cache, IOWriter* f) {
+    uint32_t h = fourcc("HNsc");
+    WRITE1(h);
+    int visited_type = cache->visited_type;
+    WRITE1(visited_type);
+    WRITE1(cache->candidates.n);
+    WRITE1(cache->initialized);
+    WRITE1(cache->nstep);
+    WRITE1(cache->nstep_no_improvement);
+
+    // the used part of the candidate heap, as is: the popped entries (id
+    // -1) still count in its size
+    const HNSW::MinimaxHeap& candidates = cache->candidates;
+    WRITE1(candidates.nvalid);
+    std::vector<HNSW::storage_idx_t> cand_ids(
+            candidates.ids.begin(), candidates.ids.begin() + candidates.k);
+    std::vector<float> cand_dis(
+            candidates.dis.begin(), candidates.dis.begin() + candidates.k);
+    WRITEVECTOR(cand_ids);
+    WRITEVECTOR(cand_dis);
+    WRITEVECTOR(cache->topk_distances);
+    WRITEVECTOR(cache->topk_labels);
+
+    std::vector<HNSW::storage_idx_t> visited;
+    if (cache->visited_type == HNSW_VISITED_HASHSET) {
+        for (int32_t id : cache->visited_hash.slots) {
+            if (id >= 0) {
+                visited.push_back(id);
+            }
+        }
+        std::sort(visited.begin(), visited.end());
+    } else {
+        const VisitedTable& vt = cache->vt;
+        for (size_t i = 0; i < vt.visited.size(); i++) {
+            if (vt.visited[i] == vt.visno) {
+                visited.push_back(i);
+            }
+        }
+    }
+    // LEB128 encoding of the gaps between the sorted ids
+    std::vector<uint8_t> visited_codes;
+    HNSW::storage_idx_t prev = 0;
+    for (HNSW::storage_idx_t id : visited) {
+        uint32_t delta = id - prev;
+        prev = id;
+        while (delta >= 0x80) {
+            visited_codes.push_back(uint8_t(delta | 0x80));
+            delta >>= 7;
+        }
+        visited_codes.push_back(uint8_t(delta));
+    }
+    size_t nvisited = visited.size();
+    WRITE1(nvisited);
+    WRITEVECTOR(visited_codes);
+}
+
 static void write_NSG(const NSG* nsg, IOWriter* f) {
     WRITE1(nsg->ntotal);
     WRITE1(nsg->R);
@@ -833,6 +893,13 @@ void write_index(const Index* idx, IOWriter* f, int io_flags) {
         write_index(idxmap->index, f);
         WRITEVECTOR(idxmap->id_map);
     } else if (const IndexHNSW* idxhnsw = dynamic_cast<const IndexHNSW*>(idx)) {
+        if (!idxhnsw->label_map.empty()) {
+            // written before the index, so that the indexes without label
+            // map keep their format
+            uint32_t hl = fourcc("IHlm");
+            WRITE1(hl);
+            WRITEVECTOR(idxhnsw->label_map);
+        }
         uint32_t h = dynamic_cast<const IndexHNSWFlatPanorama*>(idx)
                 ? fourcc("IHfP")
                 : dynamic_cast<const IndexHNSWFlat*>(idx)   ? fourcc("IHNf")
@@ -26,6 +26,7 @@ struct Index;
 struct IndexBinary;
 struct VectorTransform;
 struct ProductQuantizer;
+struct HNSWSearchCache;
 struct IOReader;
 struct IOWriter;
 struct InvertedLists;
@@ -84,6 +85,14 @@ ProductQuantizer* read_ProductQuantizer(IOReader* reader);
 void write_ProductQuantizer(const ProductQuantizer* pq, const char* fname);
 void write_ProductQuantizer(const ProductQuantizer* pq, IOWriter* f);
 
+/** Resumable HNSW search state (see IndexHNSW::search_resume), eg. to
+ * continue a search on another replica of the index. The visited set is
+ * stored as delta-encoded sorted ids, so the size is proportional to the
+ * nb of visited nodes even for HNSW_VISITED_DENSE caches. The query vector
+ * is not stored. */
+void write_HNSWSearchCache(const HNSWSearchCache* cache, IOWriter* f);
+HNSWSearchCache* read_HNSWSearchCache(IOReader* f);
+
 void write_InvertedLists(const InvertedLists* ils, IOWriter* f);
 InvertedLists* read_InvertedLists(IOReader* reader, int io_flags = 0);
 
@@ -24,7 +24,7 @@ from faiss.extra_wrappers import kmin, kmax, pairwise_distances, rand, randint,
     lrand, randn, rand_smooth_vectors, eval_intersection, normalize_L2, \
     ResultHeap, knn, Kmeans, checksum, matrix_bucket_sort_inplace, bucket_sort, \
     merge_knn_results, MapInt64ToInt64, knn_hamming, \
-    pack_bitstrings, unpack_bitstrings
+    pack_bitstrings, unpack_bitstrings, ConcurrentResultHeap, RangeResultMerger
 
 
 __version__ = "%d.%d.%d" % (FAISS_VERSION_MAJOR,
@@ -46,6 +46,7 @@ class_wrappers.handle_IDSelectorSubset(IDSelectorBatch, class_owns=True)
 class_wrappers.handle_IDSelectorSubset(IDSelectorArray, class_owns=False)
 class_wrappers.handle_IDSelectorSubset(IDSelectorBitmap, class_owns=False, force_int64=False)
 class_wrappers.handle_CodeSet(CodeSet)
+class_wrappers.handle_HNSWSearchTrace(HNSWSearchTrace)
 
 class_wrappers.handle_Tensor2D(Tensor2D)
 class_wrappers.handle_Tensor2D(Int32Tensor2D)
@@ -348,6 +349,19 @@ def deserialize_index_binary(data):
     return read_index_binary(reader)
 
 
+def serialize_hnsw_search_cache(cache):
+    """ convert the state of a resumable HNSW search to bytes """
+    writer = VectorIOWriter()
+    write_HNSWSearchCache(cache, writer)
+    return vector_to_array(writer.data).tobytes()
+
+
+def deserialize_hnsw_search_cache(data):
+    reader = VectorIOReader()
+    copy_array_to_vector(np.frombuffer(data, dtype='uint8'), reader.data)
+    return read_HNSWSearchCache(reader)
+
+
 class TimeoutGuard:
     def __init__(self, timeout_in_seconds: float):
         self.timeout = timeout_in_seconds
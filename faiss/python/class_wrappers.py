@@ -844,6 +844,144 @@ def handle_Index(the_class):
         perm = np.ascontiguousarray(perm, dtype='int64')
         self.permute_entries_c(faiss.swig_ptr(perm))
 
+    def replacement_reorder_graph(self, method):
+        """Reorder the vectors of an HNSW index for memory locality. The
+        search results keep the same labels (see IndexHNSW.label_map).
+
+        Parameters
+        ----------
+        method : int
+            HNSW_REORDER_BFS, HNSW_REORDER_RCM or HNSW_REORDER_GORDER
+
+        Returns
+        -------
+        perm : array_like
+            map from new storage positions to old ones, shape (ntotal,)
+        """
+        perm = np.empty(self.ntotal, dtype='int64')
+        self.reorder_graph_c(method, swig_ptr(perm))
+        return perm
+
+    def replacement_search_checkpoints(self, x, k, schedule, *, params=None):
+        """Search with a schedule of increasing efforts (HNSW only).
+
+        Parameters
+        ----------
+        x : array_like
+            Query vectors, shape (n, d), `dtype` must be float32.
+        k : int
+            Number of nearest neighbors.
+        schedule : array_like
+            Non-decreasing effort values (efSearch by default, see
+            SearchParametersHNSW.termination_method), shape (n_checkpoints,)
+        params : SearchParametersHNSW
+            Search parameters of the current search
+
+        Returns
+        -------
+        D : array_like
+            Distances of the nearest neighbors at each checkpoint,
+            shape (n, n_checkpoints, k)
+        I : array_like
+            Labels of the nearest neighbors at each checkpoint,
+            shape (n, n_checkpoints, k)
+        """
+        n, d = x.shape
+        x = np.ascontiguousarray(x, dtype='float32')
+        assert d == self.d
+        assert k > 0
+        schedule = np.ascontiguousarray(schedule, dtype='float32')
+        nc, = schedule.shape
+        D = np.empty((n, nc, k), dtype=np.float32)
+        I = np.empty((n, nc, k), dtype=np.int64)
+        self.search_checkpoints_c(
+            n, swig_ptr(x), k, nc, swig_ptr(schedule),
+            swig_ptr(D), swig_ptr(I), params
+        )
+        return D, I
+
+    def replacement_search_resume(self, x, k, caches, *, params=None):
+        """Continue the searches kept in caches (HNSW only).
+
+        Parameters
+        ----------
+        x : array_like
+            Query vectors, shape (n, d), `dtype` must be float32.
+        k : int
+            Number of nearest neighbors.
+        caches : list of HNSWSearchCache
+            Search state of each query, updated in place
+        params : SearchParametersHNSW
+            Search parameters of the current search
+
+        Returns
+        -------
+        D : array_like
+            Distances of the nearest neighbors found so far, shape (n, k)
+        I : array_like
+            Labels of the nearest neighbors found so far, shape (n, k)
+
+        Notes
+        -----
+        With METRIC_INNER_PRODUCT, the distances are the inner products, as
+        returned by search. Earlier versions returned them negated: callers
+        that flipped the sign themselves should not do it anymore.
+        Panorama indexes are not supported.
+        """
+        n, d = x.shape
+        x = np.ascontiguousarray(x, dtype='float32')
+        assert d == self.d
+        assert k > 0
+        assert len(caches) == n
+        cache_ptrs = faiss.HNSWSearchCachePtrVector()
+        for cache in caches:
+            cache_ptrs.push_back(cache)
+        D = np.empty((n, k), dtype=np.float32)
+        I = np.empty((n, k), dtype=np.int64)
+        self.search_resume_c(
+            n, swig_ptr(x), k, swig_ptr(D), swig_ptr(I), cache_ptrs, params
+        )
+        return D, I
+
+    def replacement_search_sessions(self, x, k, session_ids, pool, *,
+                                    params=None):
+        """Resume the searches of sessions kept in a pool (HNSW only).
+
+        Parameters
+        ----------
+        x : array_like
+            Query vectors, shape (n, d), `dtype` must be float32.
+        k : int
+            Number of nearest neighbors.
+        session_ids : array_like
+            Session of each query, shape (n,). A session that is not in the
+            pool (new or evicted) starts its search from scratch.
+        pool : HNSWSearchCachePool
+            Search states of the sessions
+        params : SearchParametersHNSW
+            Search parameters of the current search
+
+        Returns
+        -------
+        D : array_like
+            Distances of the nearest neighbors found so far, shape (n, k)
+        I : array_like
+            Labels of the nearest neighbors found so far, shape (n, k)
+        """
+        n, d = x.shape
+        x = np.ascontiguousarray(x, dtype='float32')
+        assert d == self.d
+        assert k > 0
+        session_ids = np.ascontiguousarray(session_ids, dtype='int64')
+        assert session_ids.shape == (n,)
+        D = np.empty((n, k), dtype=np.float32)
+        I = np.empty((n, k), dtype=np.int64)
+        self.search_sessions_c(
+            n, swig_ptr(x), k, swig_ptr(session_ids), pool,
+            swig_ptr(D), swig_ptr(I), params
+        )
+        return D, I
+
     replace_method(the_class, 'add', replacement_add)
     replace_method(the_class, 'add_with_ids', replacement_add_with_ids)
     replace_method(the_class, 'assign', replacement_assign)
@@ -872,6 +1010,14 @@ def handle_Index(the_class):
     replace_method(the_class, 'add_sa_codes', replacement_add_sa_codes)
     replace_method(the_class, 'permute_entries', replacement_permute_entries,
                    ignore_missing=True)
+    replace_method(the_class, 'search_checkpoints',
+                   replacement_search_checkpoints, ignore_missing=True)
+    replace_method(the_class, 'reorder_graph', replacement_reorder_graph,
+                   ignore_missing=True)
+    replace_method(the_class, 'search_resume', replacement_search_resume,
+                   ignore_missing=True)
+    replace_method(the_class, 'search_sessions', replacement_search_sessions,
+                   ignore_missing=True)
 
     # Store the original __setattr__ method
     original_setattr = (the_class.__setattr__ if
@@ -1313,6 +1459,30 @@ def handle_CodeSet(the_class):
 
     replace_method(the_class, 'insert', replacement_insert)
 
+
+def handle_HNSWSearchTrace(the_class):
+
+    def replacement_get_records(self):
+        """ returns the recorded search steps as a dict of arrays with
+        fields query, nstep, ncandidates, ndis and threshold. The records
+        are ordered by thread, oldest first """
+        n = self.nrecords()
+        records = {
+            'query': np.empty(n, dtype='int64'),
+            'nstep': np.empty(n, dtype='int32'),
+            'ncandidates': np.empty(n, dtype='int32'),
+            'ndis': np.empty(n, dtype='int64'),
+            'threshold': np.empty(n, dtype='float32'),
+        }
+        self.get_records_c(
+            swig_ptr(records['query']), swig_ptr(records['nstep']),
+            swig_ptr(records['ncandidates']), swig_ptr(records['ndis']),
+            swig_ptr(records['threshold'])
+        )
+        return records
+
+    replace_method(the_class, 'get_records', replacement_get_records)
+
 ######################################################
 # Syntactic sugar for NeuralNet classes
 ######################################################
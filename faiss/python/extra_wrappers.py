@@ -15,6 +15,8 @@ from faiss.loader import *
 import faiss
 
 import collections.abc
+import itertools
+import threading
 
 
 ###########################################
@@ -280,6 +282,125 @@ class ResultHeap:
         self.heaps.reorder()
 
 
+class ConcurrentResultHeap:
+    """Same as ResultHeap, but results can be added from several threads
+    concurrently, for example when the results of many shards arrive in
+    parallel. The heaps are partitioned in blocks of block_size queries with
+    one lock each, so that threads that update different blocks do not wait
+    for each other (the heap updates run without the GIL).
+
+    The results are written directly to D and I, that can be provided by
+    the caller (C-contiguous float32 / int64 arrays of size (nq, k)).
+    """
+
+    def __init__(self, nq, k, keep_max=False, D=None, I=None,
+                 block_size=1024):
+        if D is None:
+            D = np.empty((nq, k), dtype='float32')
+        if I is None:
+            I = np.empty((nq, k), dtype='int64')
+        assert D.shape == (nq, k) and D.dtype == 'float32'
+        assert I.shape == (nq, k) and I.dtype == 'int64'
+        assert D.flags.c_contiguous and I.flags.c_contiguous
+        self.D, self.I = D, I
+        self.nq, self.k = nq, k
+        if keep_max:
+            heaps = float_minheap_array_t()
+        else:
+            heaps = float_maxheap_array_t()
+        heaps.k = k
+        heaps.nh = nq
+        heaps.val = swig_ptr(self.D)
+        heaps.ids = swig_ptr(self.I)
+        heaps.heapify()
+        self.heaps = heaps
+        self.block_size = block_size
+        self.locks = [
+            threading.Lock() for _ in range(0, max(nq, 1), block_size)]
+        self.next_block = itertools.count()
+
+    def add_result(self, D, I, i0=0):
+        """
+        Add results for queries i0:i0 + len(D)
+        D, I should be of size (n, nres), in any order
+        """
+        n, kd = D.shape
+        D = np.ascontiguousarray(D, dtype='float32')
+        I = np.ascontiguousarray(I, dtype='int64')
+        assert I.shape == (n, kd)
+        assert 0 <= i0 and i0 + n <= self.nq
+        if n == 0:
+            return
+        bs = self.block_size
+        b0, b1 = i0 // bs, (i0 + n - 1) // bs + 1
+        # the threads start at different blocks to avoid convoys
+        start = next(self.next_block)
+        for j in range(b1 - b0):
+            b = b0 + (start + j) % (b1 - b0)
+            j0, j1 = max(i0, b * bs), min(i0 + n, (b + 1) * bs)
+            with self.locks[b]:
+                self.heaps.addn_with_ids(
+                    kd, swig_ptr(D[j0 - i0:j1 - i0]),
+                    swig_ptr(I[j0 - i0:j1 - i0]), kd, j0, j1 - j0)
+
+    def finalize(self):
+        self.heaps.reorder()
+
+
+class RangeResultMerger:
+    """Merge range search results (lims, D, I) of several shards, that can
+    be added from several threads concurrently. The results of each query
+    are concatenated by increasing rank of the parts, so that the output
+    does not depend on the order in which the threads finish (parts with the
+    same rank are kept in the order in which they were added).
+    """
+
+    def __init__(self, nq):
+        self.nq = nq
+        self.lock = threading.Lock()
+        self.parts = []
+
+    def add_result(self, lims, D, I, i0=0, rank=0):
+        """
+        Add results for queries i0:i0 + len(lims) - 1: the results of query
+        i0 + i are in D[lims[i]:lims[i + 1]], I[lims[i]:lims[i + 1]].
+        rank is the position of the part in the output, eg. the shard number
+        """
+        lims = np.asarray(lims, dtype='int64')
+        n = len(lims) - 1
+        assert 0 <= i0 and i0 + n <= self.nq
+        assert len(D) == len(I) == lims[-1] - lims[0]
+        with self.lock:
+            self.parts.append((rank, len(self.parts), i0, lims, D, I))
+
+    def finalize(self):
+        """ returns the merged lims, D, I """
+        nq = self.nq
+        sizes = np.zeros(nq, dtype='int64')
+        self.parts.sort(key=lambda part: part[:2])
+        for _, _, i0, lims, _, _ in self.parts:
+            sizes[i0:i0 + len(lims) - 1] += np.diff(lims)
+        lims_out = np.zeros(nq + 1, dtype='int64')
+        np.cumsum(sizes, out=lims_out[1:])
+        ntot = int(lims_out[-1])
+        dtype = self.parts[0][4].dtype if self.parts else 'float32'
+        D = np.empty(ntot, dtype=dtype)
+        I = np.empty(ntot, dtype='int64')
+        # write pointer of each query
+        wp = lims_out[:-1].copy()
+        for _, _, i0, lims, Di, Ii in self.parts:
+            n = len(lims) - 1
+            counts = np.diff(lims)
+            # destination of each result of the part
+            dst = np.repeat(wp[i0:i0 + n] - (lims[:-1] - lims[0]), counts)
+            dst += np.arange(len(dst))
+            D[dst] = Di
+            I[dst] = Ii
+            wp[i0:i0 + n] += counts
+        self.parts = []
+        return lims_out, D, I
+
+
 def merge_knn_results(Dall, Iall, keep_max=False):
     """
     Merge a set of sorted knn-results obtained from different shards in a dataset
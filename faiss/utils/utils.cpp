@@ -391,6 +391,38 @@ size_t ranklist_intersection_size(
     return count;
 }
 
+void ranklist_intersection_sizes(
+        size_t n,
+        size_t k1,
+        const int64_t* v1,
+        size_t k2,
+        const int64_t* v2,
+        int64_t* inter) {
+#pragma omp parallel if (n * (k1 + k2) > 10000)
+    {
+        std::vector<int64_t> row1, row2;
+#pragma omp for
+        for (int64_t i = 0; i < n; i++) {
+            row1.clear();
+            row2.clear();
+            for (size_t j = 0; j < k1; j++) {
+                if (v1[i * k1 + j] >= 0) {
+                    row1.push_back(v1[i * k1 + j]);
+                }
+            }
+            for (size_t j = 0; j < k2; j++) {
+                if (v2[i * k2 + j] >= 0) {
+                    row2.push_back(v2[i * k2 + j]);
+                }
+            }
+            inter[i] = row1.empty() || row2.empty()
+                    ? 0
+                    : ranklist_intersection_size(
+                              row1.size(), row1.data(), row2.size(), row2.data());
+        }
+    }
+}
+
 double imbalance_factor(int k, const int64_t* hist) {
     double tot = 0, uf = 0;
 
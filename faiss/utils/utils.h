@@ -72,6 +72,19 @@ size_t ranklist_intersection_size(
         size_t k2,
         const int64_t* v2);
 
+/** ranklist_intersection_size for the rows of two result tables, in
+ * parallel: inter[i] = size of the intersection of v1[i * k1:(i + 1) * k1]
+ * and v2[i * k2:(i + 1) * k2]. Negative entries (missing results) are
+ * ignored.
+ */
+void ranklist_intersection_sizes(
+        size_t n,
+        size_t k1,
+        const int64_t* v1,
+        size_t k2,
+        const int64_t* v2,
+        int64_t* inter);
+
 /** merge a result table into another one
  *
  * @param I0, D0       first result table, size (n, k)
@@ -19,6 +19,12 @@ from faiss.contrib.datasets import (  # @manual=//faiss/contrib:faiss_contrib
 
 US_IN_S = 1_000_000
 
+REORDER_METHODS = {
+    "bfs": faiss.HNSW_REORDER_BFS,
+    "rcm": faiss.HNSW_REORDER_RCM,
+    "gorder": faiss.HNSW_REORDER_GORDER,
+}
+
 
 @dataclass
 class PerfCounters:
@@ -62,6 +68,9 @@ def run_on_dataset(
     efSearch: int = 16,
     efConstruction: int = 40,
     search_bounded_queue: bool = True,
+    n_interleave: int = 1,
+    reorder: str = "none",
+    add_lock_stripes: int = 0,
 ) -> Dict[str, int]:
     xq = ds.get_queries()
     xb = ds.get_database()
@@ -74,6 +83,7 @@ def run_on_dataset(
     faiss.omp_set_num_threads(num_threads)
     index = faiss.IndexHNSWFlat(d, M)
     index.hnsw.efConstruction = efConstruction  # default
+    index.add_lock_stripes = add_lock_stripes
     with timed_execution() as t:
         for _ in range(num_add_iterations):
             index.add(xb)
@@ -81,18 +91,37 @@ def run_on_dataset(
     accumulate_perf_counter("add", t, counters)
     counters["nb"] = nb
     counters["num_add_iterations"] = num_add_iterations
+    counters["num_threads"] = num_threads
+    counters["add_lock_stripes"] = add_lock_stripes
 
     index.hnsw.efSearch = efSearch
     index.hnsw.search_bounded_queue = search_bounded_queue
+    params = None
+    if n_interleave > 1:
+        params = faiss.SearchParametersHNSW(
+            efSearch=efSearch,
+            bounded_queue=search_bounded_queue,
+            n_interleave=n_interleave,
+        )
     with timed_execution() as t:
         for _ in range(num_search_iterations):
-            D, I = index.search(xq, k)
+            D, I = index.search(xq, k, params=params)
     accumulate_perf_counter("search", t, counters)
+
+    if reorder != "none":
+        with timed_execution() as t:
+            index.reorder_graph(REORDER_METHODS[reorder])
+        accumulate_perf_counter("reorder", t, counters)
+        with timed_execution() as t:
+            for _ in range(num_search_iterations):
+                D, I = index.search(xq, k, params=params)
+        accumulate_perf_counter("search_reordered", t, counters)
     counters["nq"] = nq
     counters["efSearch"] = efSearch
     counters["efConstruction"] = efConstruction
     counters["M"] = M
     counters["d"] = d
+    counters["n_interleave"] = n_interleave
     counters["num_search_iterations"] = num_search_iterations
 
     return counters
@@ -109,6 +138,9 @@ def run(
     efSearch: int = 16,
     efConstruction: int = 40,
     search_bounded_queue: bool = True,
+    n_interleave: int = 1,
+    reorder: str = "none",
+    add_lock_stripes: int = 0,
 ) -> Dict[str, int]:
     ds = SyntheticDataset(d=d, nb=nb, nt=0, nq=nq, metric="L2", seed=1338)
     return run_on_dataset(
@@ -120,6 +152,9 @@ def run(
         efSearch=efSearch,
         efConstruction=efConstruction,
         search_bounded_queue=search_bounded_queue,
+        n_interleave=n_interleave,
+        reorder=reorder,
+        add_lock_stripes=add_lock_stripes,
     )
 
 
@@ -139,6 +174,39 @@ def _accumulate_counters(
         return accu
 
 
+def thread_sweep(args):
+    """ scaling of add() with the number of threads, for the two locking
+    schemes """
+    ds = SyntheticDataset(
+        d=args.d, nb=args.nb, nt=0, nq=args.nq, metric="L2", seed=1338)
+    stripes = args.add_lock_stripes or 1 << 16
+    print(
+        f"add scaling on dataset(nb={args.nb}, d={args.d}), M={args.M}, "
+        f"efConstruction={args.ef_construction}, "
+        f"num_repetitions={args.num_repetitions}"
+    )
+    print("%8s %16s %16s %8s" % (
+        "threads", "per-vector (s)", f"{stripes} stripes", "ratio"))
+    for num_threads in [1, 2, 4, 8, 16, 32, 64]:
+        times = []
+        for lock_stripes in 0, stripes:
+            t = []
+            for _ in range(args.num_repetitions):
+                counters = run_on_dataset(
+                    ds,
+                    M=args.M,
+                    num_threads=num_threads,
+                    num_add_iterations=1,
+                    num_search_iterations=0,
+                    efConstruction=args.ef_construction,
+                    add_lock_stripes=lock_stripes,
+                )
+                t.append(counters["add_wall_time_us"] / US_IN_S)
+            times.append(np.median(t))
+        print("%8d %16.3f %16.3f %8.2f" % (
+            num_threads, times[0], times[1], times[0] / times[1]))
+
+
 def main():
     parser = argparse.ArgumentParser(description="Benchmark HNSW")
     parser.add_argument("--M", type=int, default=32)
@@ -150,12 +218,35 @@ def main():
     parser.add_argument("--ef-search", type=int, default=16)
     parser.add_argument("--ef-construction", type=int, default=40)
     parser.add_argument("--search-bounded-queue", action="store_true")
+    parser.add_argument(
+        "--n-interleave", type=int, default=1,
+        help="nb of queries searched in lockstep per thread"
+    )
+    parser.add_argument(
+        "--reorder", default="none",
+        choices=["none"] + list(REORDER_METHODS),
+        help="reorder the graph after adding, the search is timed "
+        "before and after"
+    )
+    parser.add_argument(
+        "--add-lock-stripes", type=int, default=0,
+        help="nb of striped locks used by add (0 = one lock per vector)"
+    )
+    parser.add_argument(
+        "--thread-sweep", action="store_true",
+        help="time add with 1, 2, 4, ... 64 threads, with per-vector "
+        "and striped locks"
+    )
 
     parser.add_argument("--nb", type=int, default=5000)
     parser.add_argument("--nq", type=int, default=500)
     parser.add_argument("--d", type=int, default=128)
     args = parser.parse_args()
 
+    if args.thread_sweep:
+        thread_sweep(args)
+        return
+
     if args.warm_up_iterations > 0:
         print(f"Warming up for {args.warm_up_iterations} iterations...")
         # warm-up
@@ -170,11 +261,15 @@ def main():
             efSearch=args.ef_search,
             efConstruction=args.ef_construction,
             search_bounded_queue=args.search_bounded_queue,
+            n_interleave=args.n_interleave,
+            reorder=args.reorder,
+            add_lock_stripes=args.add_lock_stripes,
         )
     print(
         f"Running benchmark with dataset(nb={args.nb}, nq={args.nq}, "
         f"d={args.d}), M={args.M}, num_threads={args.num_threads}, "
-        f"efSearch={args.ef_search}, efConstruction={args.ef_construction}"
+        f"efSearch={args.ef_search}, efConstruction={args.ef_construction}, "
+        f"n_interleave={args.n_interleave}, reorder={args.reorder}"
     )
     result = None
     for _ in range(args.num_repetitions):
@@ -189,6 +284,9 @@ def main():
             efSearch=args.ef_search,
             efConstruction=args.ef_construction,
             search_bounded_queue=args.search_bounded_queue,
+            n_interleave=args.n_interleave,
+            reorder=args.reorder,
+            add_lock_stripes=args.add_lock_stripes,
         )
         result = _accumulate_counters(counters, result)
     assert result is not None
@@ -57,11 +57,8 @@ def run_cpp_experiment():
         "--exp_name", f"{EXP_CONFIG['exp_name']}"
     ]
 
-    my_env = os.environ.copy()
-    my_env["HNSW_ENABLE_LOGGING"] = "1"
-    
     print(f"🚀 Running: {' '.join(cmd)}")
-    subprocess.check_call(cmd, env=my_env)
+    subprocess.check_call(cmd)
 def plot_results():
     print("\n📊 Generating Plots...")
     log_files = sorted([f for f in os.listdir(PATHS["results_dir"]) if f.endswith(".csv")])
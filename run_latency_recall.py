@@ -1,147 +1,150 @@
+import argparse
+import json
 import os
-import subprocess
+import time
+
+import faiss
 import numpy as np
-import json
-import shutil
+from faiss.contrib.evaluation import knn_recall
+from faiss.contrib.vecs_io import fvecs_read, ivecs_read
 
-PAT = 6
 # ================= CONFIGURATION =================
+PAT = 6
 CONFIG = {
     # Experiment Settings
     "exp_name": f"naiveES-{PAT}",          # Name for this run (output filename)
-    "use_naive_es": True,               # Enable your C++ modification?
-    "patience": PAT,                    # How many steps to wait
-    "enable_logging": False,            # Write per-step CSVs? (Slows down search!)
 
-    # Binary & Data Paths
-    "binary_path": "experiments/build/latency_recall",  # Path to compiled C++ binary
-    "ground_truth_path": "sift1M/sift_groundtruth.ivecs",
+    # Data Paths
+    "data_dir": "sift1M",
+    "index_cache": "{data_dir}/hnsw_M{M}_efc{efConstruction}.index",
     "results_dir": "results/latency_recall",
-    
+
     # HNSW Parameters
     "M": 32,
     "efConstruction": 40,
-    "efSearch_list": "4,8,16,32,64,128",
     "k": 10,
-    "n_queries": 10000
+    "n_queries": 10000,
+    "n_runs": 3,                        # timing = best of n_runs
+
+    # Sweep: one search per (efSearch, termination setting)
+    "efSearch_list": [4, 8, 16, 32, 64, 128],
+    "terminations": [
+        {"termination_method": "patience", "patience": PAT},
+    ],
 }
 # =================================================
 
-def read_ivecs(fname):
-    """Parses standard .ivecs file format"""
-    if not os.path.exists(fname):
-        print(f"Error: GT file {fname} not found.")
-        exit(1)
-    a = np.fromfile(fname, dtype='int32')
-    d = a[0]
-    return a.reshape(-1, d + 1)[:, 1:].copy()
-
-def compute_recall(results_bin_path, gt_indices, k, n_queries):
-    """Reads binary output from C++ and compares with Ground Truth"""
-    if not os.path.exists(results_bin_path):
-        print(f"Warning: Result file {results_bin_path} missing!")
-        return 0.0
-        
-    with open(results_bin_path, "rb") as f:
-        data = f.read()
-        indices = np.frombuffer(data, dtype=np.int64) # faiss::idx_t is int64
-        indices = indices.reshape(n_queries, k)
-    
-    recall_sum = 0
-    GT = gt_indices[:, :k]
-    I = indices[:, :k]
-    
-    for i in range(n_queries):
-        recall_sum += len(set(GT[i]).intersection(set(I[i])))
-        
-    return recall_sum / (n_queries * k)
+TERMINATION_METHODS = {
+    "ef_search": faiss.HNSW_TERMINATION_EF_SEARCH,
+    "patience": faiss.HNSW_TERMINATION_PATIENCE,
+    "hardlimit": faiss.HNSW_TERMINATION_HARDLIMIT,
+    "radiuslimit": faiss.HNSW_TERMINATION_RADIUSLIMIT,
+}
+
+
+def load_data(cfg):
+    data_dir = cfg["data_dir"]
+    xq = fvecs_read(os.path.join(data_dir, "sift_query.fvecs"))
+    gt = ivecs_read(os.path.join(data_dir, "sift_groundtruth.ivecs"))
+    nq = cfg["n_queries"]
+    return xq[:nq], gt[:nq, :cfg["k"]]
+
+
+def build_or_load_index(cfg):
+    """ the index is built once and cached on disk, later runs map its
+    storage from the file """
+    cache = cfg["index_cache"].format(**cfg)
+    if os.path.exists(cache):
+        print(f"Loading cached index {cache}")
+        return faiss.read_index(cache, faiss.IO_FLAG_MMAP_IFC)
+    xb = fvecs_read(
+        os.path.join(cfg["data_dir"], "sift_base.fvecs"), nt=os.cpu_count())
+    index = faiss.IndexHNSWFlat(xb.shape[1], cfg["M"])
+    index.hnsw.efConstruction = cfg["efConstruction"]
+    print(f"Building index on {xb.shape}...")
+    t0 = time.time()
+    index.add(xb)
+    print(f"   built in {time.time() - t0:.1f} s, writing {cache}")
+    faiss.write_index(index, cache)
+    return index
+
+
+def sweep_settings(cfg):
+    for term in cfg["terminations"]:
+        for ef in cfg["efSearch_list"]:
+            yield dict(term, efSearch=ef)
+
+
+def make_params(setting):
+    params = faiss.SearchParametersHNSW()
+    params.efSearch = setting["efSearch"]
+    params.termination_method = TERMINATION_METHODS[
+        setting.get("termination_method", "ef_search")]
+    for key in "patience", "hardlimit_max_nodes", "radiuslimit_radius":
+        if key in setting:
+            setattr(params, key, setting[key])
+    return params
+
+
+def run_setting(index, xq, gt, k, setting, n_runs):
+    params = make_params(setting)
+    best = float("inf")
+    for _ in range(n_runs):
+        t0 = time.perf_counter()
+        _, I = index.search(xq, k, params=params)
+        best = min(best, time.perf_counter() - t0)
+    return {
+        **setting,
+        "latency_ms": best * 1000 / len(xq),
+        "recall": float(knn_recall(I, gt).mean()),
+        "k": k,
+    }
+
+
+def pareto_frontier(results):
+    """ flag the results that no other result beats on both latency and
+    recall """
+    for r in results:
+        r["frontier"] = not any(
+            o["latency_ms"] <= r["latency_ms"] and o["recall"] >= r["recall"]
+            and (o["latency_ms"], o["recall"]) != (r["latency_ms"], r["recall"])
+            for o in results)
+    return results
+
 
 def main():
-    # 1. Setup Directories
-    os.makedirs(CONFIG["results_dir"], exist_ok=True)
-    
-    # Output file: results/latency_recall/naiveES-200.json
-    output_json = os.path.join(CONFIG["results_dir"], f"{CONFIG['exp_name']}.json")
-
-    # 2. Load Ground Truth
-    print(f"Loading Ground Truth from {CONFIG['ground_truth_path']}...")
-    gt_indices = read_ivecs(CONFIG['ground_truth_path'])
-
-    # 3. Prepare Command
-    cmd = [
-        CONFIG["binary_path"],
-        "--data", "sift1M",
-        "--M", str(CONFIG["M"]),
-        "--efConstruction", str(CONFIG["efConstruction"]),
-        "--k", str(CONFIG["k"]),
-        "--n_queries", str(CONFIG["n_queries"]),
-        "--efSearch", CONFIG["efSearch_list"],
-        "--result_dir", CONFIG["results_dir"], # Save bins directly here temporarily
-        "--exp_name", CONFIG["exp_name"]
-    ]
-
-    # 4. Prepare Environment Variables
-    env_vars = os.environ.copy()
-    env_vars["HNSW_NAIVE_ES"] = "1" if CONFIG["use_naive_es"] else "0"
-    env_vars["HNSW_PATIENCE"] = str(CONFIG["patience"])
-    env_vars["HNSW_ENABLE_LOGGING"] = "1" if CONFIG["enable_logging"] else "0"
-
-    print(f"\n🚀 Running Sweep: {CONFIG['exp_name']}")
-    print(f"   - Naive ES: {CONFIG['use_naive_es']} (Patience: {CONFIG['patience']})")
-    print(f"   - Command: {' '.join(cmd)}\n")
-
-    # 5. Run Process
-    process = subprocess.Popen(
-        cmd, 
-        stdout=subprocess.PIPE, 
-        text=True, 
-        env=env_vars 
-    )
-    
-    results_log = []
-
-    # 6. Parse C++ Output
-    while True:
-        line = process.stdout.readline()
-        if not line and process.poll() is not None:
-            break
-        if line:
-            # print(line.strip()) # Uncomment to see raw C++ output
-            
-            # Expected C++ Output format: 
-            # RESULT: efSearch=16 TIME_MS=123.4 FILE=results/...
-            if line.startswith("RESULT:"):
-                try:
-                    parts = line.split()
-                    ef = int(parts[1].split("=")[1])
-                    time_ms = float(parts[2].split("=")[1])
-                    bin_file = parts[3].split("=")[1]
-                    
-                    recall = compute_recall(bin_file, gt_indices, CONFIG["k"], CONFIG["n_queries"])
-                    latency = time_ms / CONFIG["n_queries"]
-                    
-                    print(f"   -> efSearch={ef:<4} | Latency={latency:.5f}ms | Recall={recall:.5f}")
-
-                    # EXACT JSON STRUCTURE REQUESTED
-                    results_log.append({
-                        "efSearch": ef,
-                        "latency_ms": latency,
-                        "recall": recall,
-                        "k": CONFIG["k"]
-                    })
-                    
-                    # Optional: Cleanup the temporary .bin file to save space
-                    # if os.path.exists(bin_file):
-                    #     os.remove(bin_file)
-
-                except Exception as e:
-                    print(f"   [Error Parsing Line]: {e}")
-
-    # 7. Save Final JSON
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exp-name", default=CONFIG["exp_name"])
+    parser.add_argument("--data-dir", default=CONFIG["data_dir"])
+    parser.add_argument("--n-queries", type=int, default=CONFIG["n_queries"])
+    parser.add_argument("--n-runs", type=int, default=CONFIG["n_runs"])
+    parser.add_argument("--efSearch", type=str, default=None,
+                        help="comma-separated list, overrides the config")
+    args = parser.parse_args()
+    cfg = dict(CONFIG, exp_name=args.exp_name, data_dir=args.data_dir,
+               n_queries=args.n_queries, n_runs=args.n_runs)
+    if args.efSearch:
+        cfg["efSearch_list"] = [int(x) for x in args.efSearch.split(",")]
+
+    os.makedirs(cfg["results_dir"], exist_ok=True)
+    output_json = os.path.join(cfg["results_dir"], f"{cfg['exp_name']}.json")
+
+    xq, gt = load_data(cfg)
+    index = build_or_load_index(cfg)
+
+    print(f"\nRunning sweep: {cfg['exp_name']}")
+    results = []
+    for setting in sweep_settings(cfg):
+        r = run_setting(index, xq, gt, cfg["k"], setting, cfg["n_runs"])
+        print(f"   -> {setting} | Latency={r['latency_ms']:.5f}ms "
+              f"| Recall={r['recall']:.5f}")
+        results.append(r)
+
     with open(output_json, "w") as f:
-        json.dump(results_log, f, indent=4)
+        json.dump(pareto_frontier(results), f, indent=4)
+
+    print(f"\nExperiment complete. Data saved to {output_json}")
 
-    print(f"\n✅ Experiment Complete. Data saved to {output_json}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
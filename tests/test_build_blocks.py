@@ -9,6 +9,7 @@ import numpy as np
 
 import faiss
 import unittest
+from multiprocessing.pool import ThreadPool
 
 from common_faiss_tests import get_dataset_2
 
@@ -412,6 +413,77 @@ class TestResultHeap(unittest.TestCase):
         np.testing.assert_equal(all_rh[1].I, all_rh[3].I)
 
 
+class TestConcurrentResultHeap(unittest.TestCase):
+
+    def test_threads(self):
+        nq, nb, nshard, k = 1000, 100, 8, 10
+        restab = faiss.rand((nshard, nq, nb), 123)
+        ids = faiss.randint((nshard, nq, nb), 1324, 10000)
+        rh = faiss.ResultHeap(nq, k)
+        for s in range(nshard):
+            rh.add_result(restab[s], ids[s])
+        rh.finalize()
+
+        D = np.empty((nq, k), dtype='float32')
+        I = np.empty((nq, k), dtype='int64')
+        crh = faiss.ConcurrentResultHeap(nq, k, D=D, I=I, block_size=64)
+
+        def add_shard(s):
+            # blocks of queries that overlap several heap blocks
+            for i0 in range(0, nq, 137):
+                crh.add_result(
+                    restab[s, i0:i0 + 137], ids[s, i0:i0 + 137], i0)
+
+        with ThreadPool(nshard) as pool:
+            pool.map(add_shard, range(nshard))
+        crh.finalize()
+        np.testing.assert_equal(D, rh.D)
+        np.testing.assert_equal(I, rh.I)
+
+    def test_range(self):
+        nq = 50
+        rs = np.random.RandomState(123)
+        ref = [[] for _ in range(nq)]
+        merger = faiss.RangeResultMerger(nq)
+        for _ in range(5):
+            i0 = rs.randint(10)
+            n = rs.randint(30, 40)
+            lims = np.zeros(n + 1, dtype='int64')
+            lims[1:] = np.cumsum(rs.randint(4, size=n))
+            D = rs.rand(lims[-1]).astype('float32')
+            I = rs.randint(1000, size=lims[-1])
+            for i in range(n):
+                ref[i0 + i].extend(I[lims[i]:lims[i + 1]])
+            merger.add_result(lims, D, I, i0)
+        lims, D, I = merger.finalize()
+        for i in range(nq):
+            self.assertEqual(list(I[lims[i]:lims[i + 1]]), ref[i])
+
+    def test_range_rank(self):
+        # the output follows the ranks, not the order of the additions
+        nq = 20
+        rs = np.random.RandomState(123)
+        parts = []
+        for rank in range(4):
+            lims = np.zeros(nq + 1, dtype='int64')
+            lims[1:] = np.cumsum(rs.randint(4, size=nq))
+            D = rs.rand(lims[-1]).astype('float32')
+            I = rs.randint(1000, size=lims[-1])
+            parts.append((lims, D, I))
+        res = []
+        for order in [0, 1, 2, 3], [3, 1, 0, 2]:
+            merger = faiss.RangeResultMerger(nq)
+            for rank in order:
+                merger.add_result(*parts[rank], rank=rank)
+            res.append(merger.finalize())
+        for a, b in zip(*res):
+            np.testing.assert_array_equal(a, b)
+        lims, D, I = res[0]
+        for i in range(nq):
+            ref = np.hstack([Ii[li[i]:li[i + 1]] for li, _, Ii in parts])
+            np.testing.assert_array_equal(I[lims[i]:lims[i + 1]], ref)
+
+
 class TestReconstructBatch(unittest.TestCase):
 
     def test_indexflat(self):
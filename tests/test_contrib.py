@@ -3,10 +3,17 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import asyncio
+import io
 import os
+import pickle
 import platform
 import shutil
+import socket
+import struct
 import tempfile
+import threading
+import time
 import unittest
 from contextlib import contextmanager
 
@@ -21,8 +28,12 @@ from faiss.contrib import (
     clustering,
     datasets,
     evaluation,
+    hnsw_tools,
     inspect_tools,
     ivf_tools,
+    client_server,
+    rpc,
+    vecs_io,
 )
 from faiss.contrib.exhaustive_search import (
     exponential_query_iterator,
@@ -69,6 +80,80 @@ class TestComputeGT(unittest.TestCase):
     def test_compute_GT_ip_gpu(self):
         self.do_test_compute_GT(faiss.METRIC_INNER_PRODUCT, ngpu=-1)
 
+    def test_compute_GT_resume(self):
+        d = 32
+        xt, xb, xq = get_dataset_2(d, 0, 5000, 100)
+        Dref, Iref = knn_ground_truth(xq, [xb], 10, ngpu=0)
+
+        def matrix_iterator(xb, bs, crash_at=None):
+            for i0 in range(0, xb.shape[0], bs):
+                if i0 == crash_at:
+                    raise ZeroDivisionError
+                yield xb[i0:i0 + bs]
+
+        checkpoint = tempfile.mktemp()
+        try:
+            # interrupted computation, checkpoints after each block
+            with self.assertRaises(ZeroDivisionError):
+                knn_ground_truth(
+                    xq, matrix_iterator(xb, 500, crash_at=3000), 10,
+                    ngpu=0, prefetch=2,
+                    checkpoint=checkpoint, checkpoint_freq=0)
+            Dnew, Inew = knn_ground_truth(
+                xq, matrix_iterator(xb, 500), 10, ngpu=0,
+                checkpoint=checkpoint, checkpoint_freq=0)
+            np.testing.assert_array_equal(Iref, Inew)
+            np.testing.assert_almost_equal(Dref, Dnew, decimal=4)
+        finally:
+            if os.path.exists(checkpoint):
+                os.unlink(checkpoint)
+
+        # resume from a function that skips the processed blocks
+        checkpoint = tempfile.mktemp()
+        try:
+            with self.assertRaises(ZeroDivisionError):
+                knn_ground_truth(
+                    xq, matrix_iterator(xb, 500, crash_at=3000), 10,
+                    ngpu=0, checkpoint=checkpoint, checkpoint_freq=0)
+            b0s = []
+
+            def block_iterator(b0):
+                b0s.append(b0)
+                return matrix_iterator(xb[b0 * 500:], 500)
+
+            Dnew, Inew = knn_ground_truth(
+                xq, block_iterator, 10, ngpu=0, prefetch=2,
+                checkpoint=checkpoint, checkpoint_freq=0)
+            self.assertEqual(b0s, [6])
+            np.testing.assert_array_equal(Iref, Inew)
+            np.testing.assert_almost_equal(Dref, Dnew, decimal=4)
+        finally:
+            if os.path.exists(checkpoint):
+                os.unlink(checkpoint)
+
+        # the blocks are distributed over 3 ranks
+        res = [knn_ground_truth(xq, matrix_iterator(xb, 500), 10, ngpu=0,
+                                rank=rank, nrank=3)
+               for rank in range(3)]
+        Dnew, Inew = faiss.merge_knn_results(
+            np.stack([D for D, _ in res]), np.stack([I for _, I in res]))
+        np.testing.assert_array_equal(Iref, Inew)
+        np.testing.assert_almost_equal(Dref, Dnew, decimal=4)
+
+
+    def test_prefetch_stop(self):
+        # the reader thread must not stay blocked when the consumer stops
+        prefetch_iterator = faiss.contrib.exhaustive_search._prefetch_iterator
+        it = prefetch_iterator(iter(range(100)), 2)
+        self.assertEqual(next(it), 0)
+        nthread = threading.active_count()
+        it.close()
+        for _ in range(50):
+            if threading.active_count() < nthread:
+                break
+            time.sleep(0.1)
+        self.assertLess(threading.active_count(), nthread)
+
 
 class TestDatasets(unittest.TestCase):
     """here we test only the synthetic dataset. Datasets that require
@@ -313,6 +398,29 @@ class TestRangeEval(unittest.TestCase):
             np.testing.assert_array_almost_equal(ref_recalls, recalls)
 
 
+class TestKnnEval(unittest.TestCase):
+
+    def test_recall(self):
+        rs = np.random.RandomState(123)
+        nq, k, k_gt = 200, 20, 10
+        I = rs.randint(50, size=(nq, k))
+        I[:10, 5:] = -1
+        gt = np.array([rs.permutation(50)[:k_gt] for _ in range(nq)])
+        inter = evaluation.knn_intersection_sizes(I, gt)
+        ref = [len(set(I[i]) & set(gt[i])) for i in range(nq)]
+        np.testing.assert_array_equal(inter, ref)
+
+        recall = evaluation.knn_recall(I, gt)
+        ref = [len(set(I[i, :k_gt]) & set(gt[i])) / k_gt for i in range(nq)]
+        np.testing.assert_array_almost_equal(recall, ref)
+        np.testing.assert_array_almost_equal(
+            evaluation.knn_fnr(I, gt, 5),
+            1 - evaluation.knn_intersection_sizes(I[:, :5], gt[:, :5]) / 5)
+        self.assertAlmostEqual(
+            recall.mean(),
+            evaluation.knn_intersection_measure(I[:, :k_gt], gt))
+
+
 class TestPreassigned(unittest.TestCase):
 
     def test_index_pretransformed(self):
@@ -587,6 +695,39 @@ class TestClustering(unittest.TestCase):
         self.assertLess(ndiff.item(), 57)
 
 
+class TestVecsIO(unittest.TestCase):
+
+    def test_roundtrip(self):
+        rs = np.random.RandomState(123)
+        x = rs.rand(1000, 17)
+        xi = rs.randint(1 << 30, size=(1000, 5)).astype('int32')
+        xb = rs.randint(256, size=(300, 12)).astype('uint8')
+        fname = tempfile.mktemp()
+        try:
+            for nt in 1, 3:
+                vecs_io.fvecs_write(fname, x, nt=nt, chunk_size=77)
+                x2 = vecs_io.fvecs_read(fname, nt=nt, chunk_size=50)
+                np.testing.assert_array_equal(x2, x.astype('float32'))
+                np.testing.assert_array_equal(
+                    vecs_io.fvecs_read(fname, 100, 250, nt=nt), x2[100:250])
+                np.testing.assert_array_equal(vecs_io.fvecs_mmap(fname), x2)
+                vecs_io.ivecs_write(fname, xi, nt=nt, chunk_size=77)
+                np.testing.assert_array_equal(vecs_io.ivecs_read(fname), xi)
+                vecs_io.bvecs_write(fname, xb, nt=nt)
+                np.testing.assert_array_equal(
+                    vecs_io.bvecs_read(fname, 5, 7), xb[5:7])
+                np.testing.assert_array_equal(vecs_io.bvecs_mmap(fname), xb)
+
+            with vecs_io.VecsWriter(fname, 'int32') as writer:
+                for i0 in range(0, 1000, 300):
+                    writer.write(xi[i0:i0 + 300])
+            np.testing.assert_array_equal(
+                np.vstack(list(vecs_io.ivecs_iter(fname, 256))), xi)
+        finally:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+
 class TestBigBatchSearch(unittest.TestCase):
 
     def do_test(self, factory_string, metric=faiss.METRIC_L2):
@@ -655,9 +796,31 @@ class TestBigBatchSearch(unittest.TestCase):
             )
             self.assertLess((Inew != Iref).sum() / Iref.size, 1e-4)
             np.testing.assert_almost_equal(Dnew, Dref, decimal=4)
+            # all lists are completed in the checkpoint
+            Dnew2, Inew2 = big_batch_search.big_batch_search(
+                index, ds.get_queries(),
+                k, method="knn_function",
+                threaded=2,
+                checkpoint=checkpoint, checkpoint_freq=5
+            )
+            np.testing.assert_equal(Inew2, Inew)
+            np.testing.assert_equal(Dnew2, Dnew)
+            # the heap files are damaged: start from scratch
+            os.unlink(checkpoint + ".D")
+            with open(checkpoint + ".I", "r+b") as f:
+                f.truncate(100)
+            Dnew3, Inew3 = big_batch_search.big_batch_search(
+                index, ds.get_queries(),
+                k, method="knn_function",
+                threaded=2,
+                checkpoint=checkpoint, checkpoint_freq=5
+            )
+            self.assertLess((Inew3 != Iref).sum() / Iref.size, 1e-4)
+            np.testing.assert_almost_equal(Dnew3, Dref, decimal=4)
         finally:
-            if os.path.exists(checkpoint):
-                os.unlink(checkpoint)
+            for suffix in "", ".D", ".I":
+                if os.path.exists(checkpoint + suffix):
+                    os.unlink(checkpoint + suffix)
 
 
 class TestInvlistSort(unittest.TestCase):
@@ -698,6 +861,53 @@ class TestInvlistSort(unittest.TestCase):
         np.testing.assert_equal(Inew_remap, Iref)
 
 
+class TestHNSWCalibration(unittest.TestCase):
+
+    def test_calibrate_termination(self):
+        ds = datasets.SyntheticDataset(32, 0, 2000, 400)
+        index = faiss.IndexHNSWFlat(ds.d, 16)
+        index.add(ds.get_database())
+        k = 10
+        gt = ds.get_groundtruth(k)
+        xq_calib, gt_calib = ds.get_queries()[:200], gt[:200]
+        xq_test, gt_test = ds.get_queries()[200:], gt[200:]
+
+        alpha = 0.1
+        conformal = hnsw_tools.calibrate_termination(
+            index, xq_calib, gt_calib, alpha)
+        self.assertEqual(conformal.schedule.size(), 9)
+
+        params = faiss.SearchParametersHNSW(
+            termination_method=faiss.HNSW_TERMINATION_CONFORMAL,
+            conformal=conformal)
+        stats = faiss.cvar.hnsw_stats
+        stats.reset()
+        D, I = index.search(xq_test, k, params=params)
+        ndis_conformal = stats.ndis
+
+        # the guarantee is in expectation, leave some slack
+        fnr = hnsw_tools.knn_fnr(I, gt_test).mean()
+        self.assertLess(fnr, 2 * alpha)
+
+        # the adaptive search is cheaper than the full schedule
+        stats.reset()
+        index.search(
+            xq_test, k, params=faiss.SearchParametersHNSW(efSearch=1024))
+        self.assertLess(ndis_conformal, stats.ndis)
+
+    def test_params_unchanged(self):
+        ds = datasets.SyntheticDataset(32, 0, 1000, 50)
+        index = faiss.IndexHNSWFlat(ds.d, 16)
+        index.add(ds.get_database())
+        params = faiss.SearchParametersHNSW(
+            termination_method=faiss.HNSW_TERMINATION_PATIENCE)
+        hnsw_tools.calibrate_termination(
+            index, ds.get_queries(), ds.get_groundtruth(10), 0.1,
+            schedule=[8, 16, 32], params=params)
+        self.assertEqual(
+            params.termination_method, faiss.HNSW_TERMINATION_PATIENCE)
+
+
 class TestCodeSet(unittest.TestCase):
 
     def test_code_set(self):
@@ -774,3 +984,322 @@ class TestMerge(unittest.TestCase):
     def test_ondisk_merge_with_shift_ids(self):
         # verified that recall is same for test_ondisk_merge and
         self.do_test_ondisk_merge(True)
+
+
+class TestRPC(unittest.TestCase):
+
+    def test_message(self):
+        rs = np.random.RandomState(123)
+        msg = (
+            "search",
+            (rs.rand(1000, 64).astype('float32'), 10),
+            {
+                "I": rs.randint(1000, size=(10, 5)),
+                "strided": np.arange(20)[::3],
+                "scalar": np.array(3.5),
+                "empty": np.zeros((0, 4), dtype='uint8'),
+                "other": [None, "x", 1.5],
+            }
+        )
+        s0, s1 = socket.socketpair()
+        # the message is larger than the socket buffer
+        t = threading.Thread(target=rpc.send_message, args=(s0, msg))
+        t.start()
+        msg2 = rpc.recv_message(s1)
+        t.join()
+        self.assertEqual(msg2[0], msg[0])
+        np.testing.assert_array_equal(msg2[1][0], msg[1][0])
+        self.assertEqual(msg2[1][1], 10)
+        for key, v in msg[2].items():
+            if isinstance(v, np.ndarray):
+                self.assertEqual(msg2[2][key].dtype, v.dtype)
+                np.testing.assert_array_equal(msg2[2][key], v)
+            else:
+                self.assertEqual(msg2[2][key], v)
+        s0.close()
+        self.assertRaises(EOFError, rpc.recv_message, s1)
+        s1.close()
+
+    def test_message_limits(self):
+        def recv_raw(descr, skeleton=b'', **kwargs):
+            s0, s1 = socket.socketpair()
+            s0.sendall(rpc.HEADER.pack(len(descr), len(skeleton), 1) +
+                       descr + skeleton)
+            try:
+                return rpc.recv_message(s1, **kwargs)
+            finally:
+                s0.close()
+                s1.close()
+
+        def descr(dt, shape):
+            return (struct.pack('<BB', len(dt), len(shape)) + dt +
+                    struct.pack('<%dq' % len(shape), *shape))
+
+        # object arrays are not received out of the pickle
+        self.assertRaises(
+            pickle.UnpicklingError, recv_raw, descr(b'|O', (10, )))
+        # the peer cannot make the receiver allocate a huge array
+        self.assertRaises(
+            pickle.UnpicklingError, recv_raw, descr(b'<f4', (1 << 40, 4)))
+        self.assertRaises(
+            pickle.UnpicklingError, recv_raw, descr(b'<f4', (-1, )))
+        self.assertRaises(
+            pickle.UnpicklingError, recv_raw, descr(b'<f4', (1000, 1000)),
+            max_size=1 << 20)
+
+    def test_server(self):
+
+        class TestServer(rpc.Server):
+
+            def add(self, a, b):
+                return a + b
+
+        s0, s1 = socket.socketpair()
+        server = TestServer(s1, logf=io.StringIO())
+        t = threading.Thread(target=server.exec_loop)
+        t.start()
+        a = np.arange(12).reshape(3, 4)
+        rpc.send_message(s0, (12, "add", (a, 1)))
+        rid, st, ret = rpc.recv_message(s0)
+        self.assertEqual(rid, 12)
+        self.assertIsNone(st)
+        np.testing.assert_array_equal(ret, a + 1)
+        rpc.send_message(s0, (13, "nonexistent", ()))
+        rid, st, ret = rpc.recv_message(s0)
+        self.assertEqual(rid, 13)
+        self.assertIsNotNone(st)
+        s0.close()
+        t.join()
+        s1.close()
+
+    def test_pipelined_client(self):
+
+        class SleepServer(rpc.Server):
+
+            def sleep(self, t, x):
+                time.sleep(t)
+                return x
+
+        # find a free port
+        s = socket.socket()
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+        s.close()
+        threading.Thread(
+            target=rpc.run_server,
+            args=(lambda s: SleepServer(s, logf=io.StringIO()), port),
+            kwargs=dict(max_workers=4),
+            daemon=True
+        ).start()
+        for _ in range(100):
+            try:
+                client = rpc.Client("localhost", port)
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+
+        # the replies arrive out of order
+        futures = [client.submit("sleep", t, i)
+                   for i, t in enumerate([0.3, 0.2, 0.1, 0])]
+        t0 = time.time()
+        self.assertEqual([f.result() for f in futures], [0, 1, 2, 3])
+        self.assertLess(time.time() - t0, 0.55)
+        self.assertEqual(client.sleep(0, "x"), "x")
+        self.assertRaises(rpc.ServerException, client.nonexistent)
+        client.close()
+        self.assertRaises(rpc.ClientExit, client.submit, "sleep", 0, 0)
+
+    def test_client_pool(self):
+
+        class DropServer(rpc.Server):
+            ndrop = 0
+
+            def call(self, x):
+                if DropServer.ndrop > 0:
+                    # simulates a server restart during the call
+                    DropServer.ndrop -= 1
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                return x
+
+        s = socket.socket()
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+        s.close()
+        threading.Thread(
+            target=rpc.run_server,
+            args=(lambda s: DropServer(s, logf=io.StringIO()), port),
+            daemon=True
+        ).start()
+        connections = []
+        for _ in range(100):
+            try:
+                pool = rpc.ClientPool(
+                    "localhost", port, nconn=3, min_backoff=0.01,
+                    health_check_interval=None,
+                    on_connect=connections.append)
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        self.assertEqual(len(connections), 3)
+        self.assertEqual(pool.nconn_alive(), 3)
+
+        # the call is re-sent on another connection
+        DropServer.ndrop = 1
+        self.assertEqual(pool.call(1), 1)
+        self.assertEqual([pool.call(i) for i in range(6)], list(range(6)))
+        self.assertEqual(pool.nconn_alive(), 3)
+        self.assertEqual(len(connections), 4)
+
+        # no retries left
+        DropServer.ndrop = 3
+        self.assertRaises(rpc.ClientExit, pool.call, 2)
+
+        # the health check re-opens the broken connections
+        time.sleep(0.1)
+        pool.check_health()
+        self.assertEqual(pool.nconn_alive(), 3)
+        self.assertEqual(pool.call(3), 3)
+        pool.close()
+
+
+class TestAsyncClientIndex(unittest.TestCase):
+
+    class ShardServer(rpc.Server):
+        """ returns fixed results after a delay """
+
+        def __init__(self, s, D, I, delay):
+            rpc.Server.__init__(self, s, logf=io.StringIO())
+            self.D, self.I, self.delay = D, I, delay
+
+        def search(self, x, k):
+            time.sleep(self.delay)
+            return self.D[:len(x), :k], self.I[:len(x), :k]
+
+    def start_server(self, D, I, delay):
+        s = socket.socket()
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+        s.close()
+        threading.Thread(
+            target=rpc.run_server,
+            args=(lambda s: self.ShardServer(s, D, I, delay), port),
+            kwargs=dict(max_workers=2),
+            daemon=True
+        ).start()
+        for _ in range(100):
+            try:
+                rpc.Client("localhost", port).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        return ("localhost", port)
+
+    def test_hedge_and_partial(self):
+        nq, k = 10, 5
+        rs = np.random.RandomState(123)
+        Ds = [np.sort(rs.rand(nq, k).astype('float32'), axis=1)
+              for _ in range(3)]
+        Is = [rs.randint(1000, size=(nq, k)) + 1000 * i for i in range(3)]
+        shards = [
+            # fast
+            [self.start_server(Ds[0], Is[0], 0)],
+            # slow first replica, fast second replica
+            [self.start_server(Ds[1], Is[1], 5),
+             self.start_server(Ds[1], Is[1], 0)],
+            # too slow
+            [self.start_server(Ds[2], Is[2], 5)],
+        ]
+        index = client_server.AsyncClientIndex(
+            shards, timeout=1, hedge_delay=0.1)
+        xq = np.zeros((nq, 4), dtype='float32')
+        t0 = time.time()
+        D, I, failed = asyncio.run(index.search(xq, k))
+        self.assertLess(time.time() - t0, 3)
+        self.assertEqual(failed, [2])
+
+        Dref, Iref = faiss.merge_knn_results(
+            np.stack(Ds[:2]), np.stack(Is[:2]))
+        np.testing.assert_array_equal(D, Dref)
+        np.testing.assert_array_equal(I, Iref)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(index.search(xq, k, allow_partial=False))
+        index.close()
+
+    def test_error_cancels_shards(self):
+        nq, k = 10, 5
+        D = np.zeros((nq, k), dtype='float32')
+        I = np.zeros((nq, k), dtype='int64')
+        shards = [
+            # fails immediately
+            [self.start_server(None, None, 0)],
+            # does not answer before the end of the test
+            [self.start_server(D, I, 5), self.start_server(D, I, 5)],
+        ]
+        index = client_server.AsyncClientIndex(shards, hedge_delay=0.1)
+        xq = np.zeros((nq, 4), dtype='float32')
+
+        async def search_and_check():
+            with self.assertRaises(rpc.ServerException):
+                await index.search(xq, k, allow_partial=False)
+            # only the current task is left
+            return len(asyncio.all_tasks())
+
+        t0 = time.time()
+        self.assertEqual(asyncio.run(search_and_check()), 1)
+        self.assertLess(time.time() - t0, 3)
+        index.close()
+
+
+class TestSearchBatcher(unittest.TestCase):
+
+    class CountingIndex:
+        """ records the batch sizes that reach the index """
+
+        def __init__(self, index):
+            self.index = index
+            self.batch_sizes = []
+
+        def search(self, x, k):
+            self.batch_sizes.append(len(x))
+            time.sleep(0.01)
+            return self.index.search(x, k)
+
+    def test_batching(self):
+        ds = datasets.SyntheticDataset(32, 0, 1000, 64)
+        index_ref = faiss.IndexFlatL2(ds.d)
+        index_ref.add(ds.get_database())
+        Dref, Iref = index_ref.search(ds.get_queries(), 10)
+
+        index = self.CountingIndex(index_ref)
+        batcher = client_server.SearchBatcher(
+            index, max_batch_size=16, max_delay=0.05)
+        xq = ds.get_queries()
+        # requests of 1 to 4 queries with different k
+        bounds = [0, 1, 3, 7, 8, 12, 16, 20, 24, 27, 31, 32, 36, 40, 48, 64]
+        ks = [10, 5, 1] * 5
+        res = [None] * (len(bounds) - 1)
+
+        def search(i):
+            res[i] = batcher.search(xq[bounds[i]:bounds[i + 1]], ks[i])
+
+        threads = [threading.Thread(target=search, args=(i, ))
+                   for i in range(len(res))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for i, (D, I) in enumerate(res):
+            i0, i1, k = bounds[i], bounds[i + 1], ks[i]
+            np.testing.assert_array_equal(I, Iref[i0:i1, :k])
+            np.testing.assert_allclose(D, Dref[i0:i1, :k], rtol=1e-5)
+
+        self.assertLessEqual(max(index.batch_sizes), 16)
+        stats = batcher.get_stats()
+        self.assertEqual(stats["nrequest"], len(res))
+        self.assertEqual(stats["nquery"], 64)
+        self.assertEqual(stats["nbatch"], len(index.batch_sizes))
+        self.assertLess(stats["nbatch"], len(res))
+        self.assertGreater(stats["fill_rate"], 0)
+        self.assertLessEqual(stats["fill_rate"], 1)
@@ -38,6 +38,63 @@ class TestHNSW(unittest.TestCase):
 
         self.io_and_retest(index, Dhnsw, Ihnsw)
 
+    def test_add_striped_locks(self):
+        d = self.xq.shape[1]
+
+        for nstripe in 1, 16, 1 << 16:
+            index = faiss.IndexHNSWFlat(d, 16)
+            index.add_lock_stripes = nstripe
+            index.add(self.xb)
+            Dhnsw, Ihnsw = index.search(self.xq, 1)
+
+            self.assertGreaterEqual((self.Iref == Ihnsw).sum(), 460)
+
+    def test_remove_ids(self):
+        d = self.xq.shape[1]
+        index = faiss.IndexHNSWFlat(d, 16)
+        index.add(self.xb)
+        nb = index.ntotal
+        removed = np.arange(0, nb, 4)
+        self.assertEqual(index.remove_ids(removed), len(removed))
+        self.assertEqual(index.ntotal, nb)
+
+        index_ref = faiss.IndexFlatL2(d)
+        index_ref.add(self.xb)
+        sel_removed = faiss.IDSelectorBatch(removed)
+        sel = faiss.IDSelectorNot(sel_removed)
+        _, Iref = index_ref.search(
+            self.xq, 1, params=faiss.SearchParameters(sel=sel))
+
+        _, I = index.search(self.xq, 1)
+        self.assertFalse(np.isin(I, removed).any())
+        self.assertGreaterEqual((I == Iref).sum(), 440)
+
+        self.assertGreater(index.compact(), 0)
+        _, I = index.search(self.xq, 1)
+        self.assertFalse(np.isin(I, removed).any())
+        self.assertGreaterEqual((I == Iref).sum(), 440)
+
+    def test_prefilter(self):
+        d = self.xq.shape[1]
+        index = faiss.IndexHNSWFlat(d, 16)
+        prefilter = faiss.IndexScalarQuantizer(
+            d, faiss.ScalarQuantizer.QT_4bit)
+        index.prefilter = prefilter
+        index.train(self.xb)
+        index.add(self.xb)
+        self.assertEqual(prefilter.ntotal, index.ntotal)
+
+        params = faiss.SearchParametersHNSW(efSearch=32)
+        faiss.cvar.hnsw_stats.reset()
+        Dhnsw, Ihnsw = index.search(self.xq, 1, params=params)
+        ndis = faiss.cvar.hnsw_stats.ndis
+        self.assertGreaterEqual((self.Iref == Ihnsw).sum(), 440)
+
+        index.prefilter = None
+        faiss.cvar.hnsw_stats.reset()
+        index.search(self.xq, 1, params=params)
+        self.assertLess(ndis, faiss.cvar.hnsw_stats.ndis)
+
     def test_range_search(self):
         index_flat = faiss.IndexFlat(self.xb.shape[1])
         index_flat.add(self.xb)
@@ -215,6 +272,165 @@ class TestHNSW(unittest.TestCase):
         self.assertEqual(index_flat.ntotal, 0)
         self.assertEqual(index_hnsw.ntotal, 0)
 
+    def test_termination_methods(self):
+        d = self.xq.shape[1]
+        index = faiss.IndexHNSWFlat(d, 16)
+        index.add(self.xb)
+        stats = faiss.cvar.hnsw_stats
+
+        def search_ndis(**kwargs):
+            params = faiss.SearchParametersHNSW(**kwargs)
+            stats.reset()
+            D, I = index.search(self.xq, 10, params=params)
+            return stats.ndis, I
+
+        ndis_ef, I_ef = search_ndis(efSearch=64)
+        ndis_patience, _ = search_ndis(
+            efSearch=1000, patience=2,
+            termination_method=faiss.HNSW_TERMINATION_PATIENCE)
+        ndis_hardlimit, I_hardlimit = search_ndis(
+            efSearch=1000, hardlimit_max_nodes=3,
+            termination_method=faiss.HNSW_TERMINATION_HARDLIMIT)
+        self.assertLess(ndis_patience, ndis_ef)
+        self.assertLess(ndis_hardlimit, ndis_ef)
+
+        # the recall should degrade gracefully with the budget
+        recall_ef = (I_ef[:, :1] == self.Iref).sum()
+        recall_hardlimit = (I_hardlimit[:, :1] == self.Iref).sum()
+        self.assertGreaterEqual(recall_ef, recall_hardlimit)
+
+        # a radius smaller than all distances: only the entry point
+        # neighborhood is scored
+        ndis_radius, _ = search_ndis(
+            efSearch=1000, radiuslimit_radius=-1.0,
+            termination_method=faiss.HNSW_TERMINATION_RADIUSLIMIT)
+        self.assertLess(ndis_radius, ndis_hardlimit)
+
+    def test_reorder_graph(self):
+        d = self.xq.shape[1]
+        for method in (faiss.HNSW_REORDER_BFS, faiss.HNSW_REORDER_RCM,
+                       faiss.HNSW_REORDER_GORDER):
+            index = faiss.IndexHNSWFlat(d, 16)
+            index.add(self.xb)
+            Dref, Iref = index.search(self.xq, 10)
+            perm = index.reorder_graph(method)
+            np.testing.assert_array_equal(
+                np.sort(perm), np.arange(index.ntotal))
+            # the labels do not change
+            D, I = index.search(self.xq, 10)
+            np.testing.assert_array_equal(I, Iref)
+            np.testing.assert_array_equal(D, Dref)
+            index2 = faiss.deserialize_index(faiss.serialize_index(index))
+            D, I = index2.search(self.xq, 10)
+            np.testing.assert_array_equal(I, Iref)
+
+    def test_search_interleaved(self):
+        d = self.xq.shape[1]
+        index = faiss.IndexHNSWFlat(d, 16)
+        index.add(self.xb)
+        Dref, Iref = index.search(
+            self.xq, 10, params=faiss.SearchParametersHNSW(efSearch=32))
+        for n_interleave in 2, 7, 16:
+            D, I = index.search(self.xq, 10, params=faiss.SearchParametersHNSW(
+                efSearch=32, n_interleave=n_interleave))
+            np.testing.assert_array_equal(I, Iref)
+            np.testing.assert_array_equal(D, Dref)
+
+    def test_search_trace(self):
+        d = self.xq.shape[1]
+        index = faiss.IndexHNSWFlat(d, 16)
+        index.add(self.xb)
+        trace = faiss.HNSWSearchTrace(10000, 3)
+        params = faiss.SearchParametersHNSW(efSearch=32, trace=trace)
+        D, I = index.search(self.xq, 10, params=params)
+
+        records = trace.get_records()
+        self.assertEqual(records['query'].size, trace.nrecords())
+        # one query out of 3 is recorded
+        self.assertEqual(
+            len(np.unique(records['query'])), (len(self.xq) + 2) // 3)
+        # per query, the k-th distance decreases with the effort
+        for q in np.unique(records['query']):
+            th = records['threshold'][records['query'] == q]
+            self.assertTrue(np.all(th[1:] <= th[:-1]))
+            self.assertEqual(th[-1], D[q, -1])
+
+    def test_search_checkpoints(self):
+        d = self.xq.shape[1]
+        index = faiss.IndexHNSWFlat(d, 16)
+        index.add(self.xb)
+        schedule = [4, 16, 64]
+        Dc, Ic = index.search_checkpoints(self.xq, 10, schedule)
+        self.assertEqual(Ic.shape, (self.xq.shape[0], len(schedule), 10))
+        # results are sorted at every checkpoint
+        self.assertTrue(np.all(Dc[:, :, 1:] >= Dc[:, :, :-1]))
+
+        # more effort should not hurt the recall
+        recalls = [(Ic[:, c, :1] == self.Iref).sum()
+                   for c in range(len(schedule))]
+        self.assertEqual(recalls, sorted(recalls))
+
+    def test_search_sessions(self):
+        d = self.xq.shape[1]
+        index = faiss.IndexHNSWFlat(d, 16)
+        index.add(self.xb)
+        nq = self.xq.shape[0]
+        pool = faiss.HNSWSearchCachePool(0, 64)
+        session_ids = np.arange(nq) + 1000
+        params = faiss.SearchParametersHNSW()
+        recalls = []
+        for ef in 4, 16, 64:
+            params.efSearch = ef
+            D, I = index.search_sessions(
+                self.xq, 10, session_ids, pool, params=params)
+            recalls.append((I[:, :1] == self.Iref).sum())
+        self.assertEqual(recalls, sorted(recalls))
+        self.assertEqual(pool.nmiss, nq)
+        self.assertEqual(pool.nhit, 2 * nq)
+
+        # with a small budget, the sessions are evicted
+        pool.max_memory = pool.memory_usage() // 4
+        index.search_sessions(self.xq, 10, session_ids, pool, params=params)
+        self.assertLessEqual(pool.memory_usage(), pool.max_memory)
+        self.assertGreater(pool.nevict, 0)
+
+    def test_search_cache_serialization(self):
+        d = self.xq.shape[1]
+        index = faiss.IndexHNSWFlat(d, 16)
+        index.add(self.xb)
+        xq = self.xq[:20]
+        caches = [faiss.HNSWSearchCache(64, faiss.HNSW_VISITED_HASHSET)
+                  for _ in range(len(xq))]
+        params = faiss.SearchParametersHNSW(efSearch=16)
+        index.search_resume(xq, 10, caches, params=params)
+
+        # resume from the serialized states, as another replica would
+        tokens = [faiss.serialize_hnsw_search_cache(c) for c in caches]
+        self.assertTrue(all(isinstance(t, bytes) for t in tokens))
+        copies = [faiss.deserialize_hnsw_search_cache(t) for t in tokens]
+        params.efSearch = 64
+        D, I = index.search_resume(xq, 10, caches, params=params)
+        D2, I2 = index.search_resume(xq, 10, copies, params=params)
+        np.testing.assert_array_equal(I, I2)
+        np.testing.assert_array_equal(D, D2)
+
+    def test_search_resume_ip(self):
+        # the distances have the same sign as the ones of search
+        d = self.xq.shape[1]
+        index = faiss.IndexHNSWFlat(d, 16, faiss.METRIC_INNER_PRODUCT)
+        index.add(self.xb)
+        params = faiss.SearchParametersHNSW(efSearch=64)
+        Dref, Iref = index.search(self.xq, 10, params=params)
+        caches = [faiss.HNSWSearchCache(64, faiss.HNSW_VISITED_HASHSET)
+                  for _ in range(len(self.xq))]
+        D, I = index.search_resume(self.xq, 10, caches, params=params)
+        self.assertTrue(np.all(D[:, 1:] <= D[:, :-1]))
+        np.testing.assert_allclose(
+            D, np.einsum('qd,qkd->qk', self.xq, self.xb[I]), rtol=1e-5)
+        self.assertGreater((I == Iref).sum(), 0.9 * I.size)
+        mask = I == Iref
+        np.testing.assert_allclose(D[mask], Dref[mask], rtol=1e-5)
+
 
 class Issue3684(unittest.TestCase):
 
@@ -7,15 +7,24 @@
 
 #include <gtest/gtest.h>
 
+#include <omp.h>
+
 #include <cstddef>
 #include <limits>
 #include <random>
+#include <thread>
 #include <unordered_set>
 #include <vector>
 
+#include <faiss/IndexFlat.h>
 #include <faiss/IndexHNSW.h>
+#include <faiss/IndexScalarQuantizer.h>
+#include <faiss/index_io.h>
 #include <faiss/impl/HNSW.h>
+#include <faiss/impl/IDSelector.h>
 #include <faiss/impl/ResultHandler.h>
+#include <faiss/impl/io.h>
+#include <faiss/utils/distances.h>
 #include <faiss/utils/random.h>
 
 int reference_pop_min(faiss::HNSW::MinimaxHeap& heap, float* vmin_out) {
@@ -660,3 +669,941 @@ TEST_F(HNSWTest, TEST_search_level_0) {
     EXPECT_GT(stats1.n1, stats2.n1);
     EXPECT_GT(stats1.n2, stats2.n2);
 }
+
+namespace {
+
+/// stops after a fixed number of expanded nodes, like the hardlimit rule
+struct MaxStepsTermination : faiss::HNSWTerminationCallback {
+    int max_steps;
+    explicit MaxStepsTermination(int max_steps) : max_steps(max_steps) {}
+    bool should_stop(const faiss::HNSWSearchProgress& p) const override {
+        return p.after_expand && p.nstep >= max_steps;
+    }
+};
+
+} // namespace
+
+TEST_F(HNSWTest, TEST_termination_methods) {
+    omp_set_num_threads(1);
+    std::vector<faiss::idx_t> I(k * nq), I_ref(k * nq);
+    std::vector<float> D(k * nq), D_ref(k * nq);
+
+    // default parameters are the ef_search termination
+    faiss::SearchParametersHNSW params;
+    params.efSearch = 32;
+    index->hnsw.efSearch = 32;
+    index->search(nq, xq->data(), k, D_ref.data(), I_ref.data());
+    index->search(nq, xq->data(), k, D.data(), I.data(), &params);
+    EXPECT_EQ(I, I_ref);
+
+    // hard limit on the number of expanded nodes
+    params.efSearch = 1000;
+    params.termination_method = faiss::HNSW_TERMINATION_HARDLIMIT;
+    params.hardlimit_max_nodes = 5;
+    faiss::hnsw_stats.reset();
+    index->search(nq, xq->data(), k, D_ref.data(), I_ref.data(), &params);
+    faiss::HNSWStats stats_hardlimit = faiss::hnsw_stats;
+    EXPECT_EQ(stats_hardlimit.n1, nq);
+
+    // same rule through a custom callback
+    MaxStepsTermination callback(5);
+    params.termination_method = faiss::HNSW_TERMINATION_CUSTOM;
+    params.termination_callback = &callback;
+    faiss::hnsw_stats.reset();
+    index->search(nq, xq->data(), k, D.data(), I.data(), &params);
+    EXPECT_EQ(I, I_ref);
+    EXPECT_EQ(faiss::hnsw_stats.nhops, stats_hardlimit.nhops);
+    EXPECT_EQ(faiss::hnsw_stats.ndis, stats_hardlimit.ndis);
+
+    // custom without callback is an error
+    params.termination_callback = nullptr;
+    EXPECT_THROW(
+            index->search(nq, xq->data(), k, D.data(), I.data(), &params),
+            faiss::FaissException);
+
+    // a radius below all distances stops before any expansion
+    params.termination_method = faiss::HNSW_TERMINATION_RADIUSLIMIT;
+    params.radiuslimit_radius = -1;
+    faiss::hnsw_stats.reset();
+    index->search(nq, xq->data(), k, D.data(), I.data(), &params);
+    faiss::HNSWStats stats_radius = faiss::hnsw_stats;
+
+    // patience stops earlier than a large ef_search
+    params.termination_method = faiss::HNSW_TERMINATION_PATIENCE;
+    params.patience = 2;
+    faiss::hnsw_stats.reset();
+    index->search(nq, xq->data(), k, D.data(), I.data(), &params);
+    faiss::HNSWStats stats_patience = faiss::hnsw_stats;
+
+    params.termination_method = faiss::HNSW_TERMINATION_EF_SEARCH;
+    faiss::hnsw_stats.reset();
+    index->search(nq, xq->data(), k, D.data(), I.data(), &params);
+    EXPECT_LT(stats_radius.ndis, stats_patience.ndis);
+    EXPECT_LT(stats_patience.ndis, faiss::hnsw_stats.ndis);
+}
+
+TEST(HNSW, Test_VisitedHashSet) {
+    faiss::VisitedHashSet vs(4);
+    std::unordered_set<int> ref;
+    std::default_random_engine rng(123);
+    std::uniform_int_distribution<int> distrib(0, 1000000);
+    for (int i = 0; i < 1000; i++) {
+        int v = distrib(rng);
+        vs.set(v);
+        ref.insert(v);
+    }
+    EXPECT_EQ(vs.count, ref.size());
+    for (int i = 0; i < 10000; i++) {
+        int v = distrib(rng);
+        EXPECT_EQ(vs.get(v), ref.count(v) > 0);
+    }
+    for (int v : ref) {
+        EXPECT_TRUE(vs.get(v));
+    }
+    vs.advance();
+    EXPECT_EQ(vs.count, 0);
+    for (int v : ref) {
+        EXPECT_FALSE(vs.get(v));
+    }
+}
+
+TEST_F(HNSWTest, TEST_search_resume_hashset) {
+    std::vector<faiss::HNSWSearchCache> caches_dense, caches_hash;
+    for (int i = 0; i < nq; i++) {
+        caches_dense.emplace_back(64);
+        caches_hash.emplace_back(64, faiss::HNSW_VISITED_HASHSET);
+    }
+    std::vector<faiss::HNSWSearchCache*> ptr_dense(nq), ptr_hash(nq);
+    for (int i = 0; i < nq; i++) {
+        ptr_dense[i] = &caches_dense[i];
+        ptr_hash[i] = &caches_hash[i];
+    }
+
+    std::vector<faiss::idx_t> I1(k * nq), I2(k * nq);
+    std::vector<float> D1(k * nq), D2(k * nq);
+    faiss::SearchParametersHNSW params;
+
+    // resume several times with increasing efforts
+    for (int ef : {8, 16, 64}) {
+        params.efSearch = ef;
+        index->search_resume(
+                nq, xq->data(), k, D1.data(), I1.data(), ptr_dense, &params);
+        index->search_resume(
+                nq, xq->data(), k, D2.data(), I2.data(), ptr_hash, &params);
+        EXPECT_EQ(I1, I2);
+        EXPECT_EQ(D1, D2);
+    }
+
+    for (int i = 0; i < nq; i++) {
+        EXPECT_GT(caches_hash[i].visited_count(), 0);
+        EXPECT_LT(caches_hash[i].visited_count(), nb);
+        // memory is proportional to the nb of visited nodes, not to nb
+        EXPECT_EQ(caches_hash[i].vt.visited.size(), 0);
+        size_t nvisited = std::max(caches_hash[i].visited_count(), size_t(64));
+        EXPECT_LE(
+                caches_hash[i].visited_hash.memory_usage(),
+                4 * sizeof(int32_t) * nvisited);
+    }
+}
+
+TEST_F(HNSWTest, TEST_search_sessions) {
+    std::vector<faiss::HNSWSearchCache> caches;
+    for (int i = 0; i < nq; i++) {
+        caches.emplace_back(64, faiss::HNSW_VISITED_HASHSET);
+    }
+    std::vector<faiss::HNSWSearchCache*> cache_ptrs(nq);
+    for (int i = 0; i < nq; i++) {
+        cache_ptrs[i] = &caches[i];
+    }
+    std::vector<faiss::idx_t> session_ids(nq);
+    for (int i = 0; i < nq; i++) {
+        session_ids[i] = 1000 + 7 * i;
+    }
+
+    faiss::HNSWSearchCachePool pool(0, 64);
+    std::vector<faiss::idx_t> I1(k * nq), I2(k * nq);
+    std::vector<float> D1(k * nq), D2(k * nq);
+    faiss::SearchParametersHNSW params;
+
+    // an unbounded pool behaves like caller-managed caches
+    for (int ef : {8, 16, 64}) {
+        params.efSearch = ef;
+        index->search_resume(
+                nq, xq->data(), k, D1.data(), I1.data(), cache_ptrs, &params);
+        index->search_sessions(
+                nq,
+                xq->data(),
+                k,
+                session_ids.data(),
+                pool,
+                D2.data(),
+                I2.data(),
+                &params);
+        EXPECT_EQ(I1, I2);
+        EXPECT_EQ(D1, D2);
+    }
+    EXPECT_EQ(pool.nmiss, nq);
+    EXPECT_EQ(pool.nhit, 2 * nq);
+    EXPECT_EQ(pool.nevict, 0);
+    EXPECT_EQ(pool.size(), nq);
+    EXPECT_GT(pool.memory_usage(), 0);
+
+    // with a budget for half of the sessions, the least recently used ones
+    // are evicted
+    size_t budget = pool.memory_usage() / 2;
+    pool.max_memory = budget;
+    pool.reset_stats();
+    params.efSearch = 16;
+    index->search_sessions(
+            1,
+            xq->data(),
+            k,
+            session_ids.data(),
+            pool,
+            D2.data(),
+            I2.data(),
+            &params);
+    EXPECT_LE(pool.memory_usage(), budget);
+    EXPECT_GT(pool.nevict, 0);
+    EXPECT_EQ(pool.size(), nq - pool.nevict);
+    EXPECT_TRUE(pool.contains(session_ids[0]));
+    EXPECT_FALSE(pool.contains(session_ids[1]));
+
+    // an evicted session restarts from scratch
+    faiss::HNSWSearchCache fresh(64, faiss::HNSW_VISITED_HASHSET);
+    std::vector<faiss::HNSWSearchCache*> fresh_ptr = {&fresh};
+    index->search_resume(
+            1, xq->data() + d, k, D1.data(), I1.data(), fresh_ptr, &params);
+    index->search_sessions(
+            1,
+            xq->data() + d,
+            k,
+            session_ids.data() + 1,
+            pool,
+            D2.data(),
+            I2.data(),
+            &params);
+    EXPECT_EQ(pool.nmiss, 1);
+    for (int j = 0; j < k; j++) {
+        EXPECT_EQ(I1[j], I2[j]);
+        EXPECT_EQ(D1[j], D2[j]);
+    }
+
+    // a session cannot be searched twice in the same call
+    std::vector<faiss::idx_t> dup = {session_ids[0], session_ids[0]};
+    EXPECT_THROW(
+            index->search_sessions(
+                    2,
+                    xq->data(),
+                    k,
+                    dup.data(),
+                    pool,
+                    D2.data(),
+                    I2.data(),
+                    &params),
+            faiss::FaissException);
+    EXPECT_TRUE(pool.remove(session_ids[0]));
+    EXPECT_FALSE(pool.remove(session_ids[0]));
+    pool.clear();
+    EXPECT_EQ(pool.size(), 0);
+    EXPECT_EQ(pool.memory_usage(), 0);
+}
+
+TEST_F(HNSWTest, TEST_search_cache_serialization) {
+    for (faiss::HNSWVisitedSetType visited_type :
+         {faiss::HNSW_VISITED_DENSE, faiss::HNSW_VISITED_HASHSET}) {
+        std::vector<faiss::HNSWSearchCache> caches;
+        for (int i = 0; i < nq; i++) {
+            caches.emplace_back(64, visited_type);
+        }
+        std::vector<faiss::HNSWSearchCache*> cache_ptrs(nq);
+        for (int i = 0; i < nq; i++) {
+            cache_ptrs[i] = &caches[i];
+        }
+        std::vector<faiss::idx_t> I1(k * nq), I2(k * nq);
+        std::vector<float> D1(k * nq), D2(k * nq);
+        faiss::SearchParametersHNSW params;
+        params.efSearch = 16;
+        index->search_resume(
+                nq, xq->data(), k, D1.data(), I1.data(), cache_ptrs, &params);
+
+        // continue the search from a copy of the state
+        std::vector<std::unique_ptr<faiss::HNSWSearchCache>> copies;
+        std::vector<faiss::HNSWSearchCache*> copy_ptrs(nq);
+        for (int i = 0; i < nq; i++) {
+            faiss::VectorIOWriter writer;
+            faiss::write_HNSWSearchCache(&caches[i], &writer);
+            // much smaller than a dense visited table
+            EXPECT_LT(writer.data.size(), nb / 2);
+            faiss::VectorIOReader reader;
+            reader.data = writer.data;
+            copies.emplace_back(faiss::read_HNSWSearchCache(&reader));
+            copy_ptrs[i] = copies.back().get();
+            EXPECT_EQ(copies[i]->nstep, caches[i].nstep);
+            EXPECT_EQ(copies[i]->candidates.size(), caches[i].candidates.size());
+        }
+
+        params.efSearch = 64;
+        index->search_resume(
+                nq, xq->data(), k, D1.data(), I1.data(), cache_ptrs, &params);
+        index->search_resume(
+                nq, xq->data(), k, D2.data(), I2.data(), copy_ptrs, &params);
+        EXPECT_EQ(I1, I2);
+        EXPECT_EQ(D1, D2);
+    }
+
+    faiss::VectorIOReader reader;
+    reader.data.resize(64, 0);
+    EXPECT_THROW(faiss::read_HNSWSearchCache(&reader), faiss::FaissException);
+}
+
+TEST_F(HNSWTest, TEST_search_checkpoints) {
+    std::vector<float> schedule = {8, 16, 64};
+    size_t nc = schedule.size();
+    std::vector<faiss::idx_t> I(nq * nc * k);
+    std::vector<float> D(nq * nc * k);
+    index->search_checkpoints(
+            nq, xq->data(), k, nc, schedule.data(), D.data(), I.data());
+
+    // reference: successive calls to search_resume
+    std::vector<faiss::HNSWSearchCache> caches;
+    for (int i = 0; i < nq; i++) {
+        caches.emplace_back(64);
+    }
+    std::vector<faiss::HNSWSearchCache*> cache_ptrs(nq);
+    for (int i = 0; i < nq; i++) {
+        cache_ptrs[i] = &caches[i];
+    }
+    std::vector<faiss::idx_t> I_ref(k * nq);
+    std::vector<float> D_ref(k * nq);
+    faiss::SearchParametersHNSW params;
+    for (size_t c = 0; c < nc; c++) {
+        params.efSearch = schedule[c];
+        index->search_resume(
+                nq,
+                xq->data(),
+                k,
+                D_ref.data(),
+                I_ref.data(),
+                cache_ptrs,
+                &params);
+        for (int i = 0; i < nq; i++) {
+            for (int j = 0; j < k; j++) {
+                EXPECT_EQ(I[(i * nc + c) * k + j], I_ref[i * k + j]);
+                EXPECT_EQ(D[(i * nc + c) * k + j], D_ref[i * k + j]);
+            }
+        }
+    }
+
+    // a cumulative hard limit of 0 expansions returns nothing
+    params.termination_method = faiss::HNSW_TERMINATION_HARDLIMIT;
+    params.efSearch = 64;
+    std::vector<float> budgets = {0, 5, 50};
+    index->search_checkpoints(
+            nq, xq->data(), k, nc, budgets.data(), D.data(), I.data(), &params);
+    for (int i = 0; i < nq; i++) {
+        EXPECT_EQ(I[i * nc * k], -1);
+        // more effort, better k-th result
+        EXPECT_LE(D[(i * nc + 2) * k + k - 1], D[(i * nc + 1) * k + k - 1]);
+    }
+
+    std::vector<float> bad_schedule = {16, 8, 64};
+    EXPECT_THROW(
+            index->search_checkpoints(
+                    nq,
+                    xq->data(),
+                    k,
+                    nc,
+                    bad_schedule.data(),
+                    D.data(),
+                    I.data()),
+            faiss::FaissException);
+}
+
+TEST_F(HNSWTest, TEST_search_checkpoints_patience) {
+    std::vector<float> schedule = {2, 4, 8};
+    size_t nc = schedule.size();
+    faiss::SearchParametersHNSW params;
+    params.efSearch = 32;
+    params.termination_method = faiss::HNSW_TERMINATION_PATIENCE;
+    std::vector<faiss::idx_t> I(nq * nc * k);
+    std::vector<float> D(nq * nc * k);
+    index->search_checkpoints(
+            nq, xq->data(), k, nc, schedule.data(), D.data(), I.data(), &params);
+
+    // each checkpoint is the result of a single search with its patience
+    for (size_t c = 0; c < nc; c++) {
+        params.patience = schedule[c];
+        std::vector<faiss::HNSWSearchCache> caches;
+        for (int i = 0; i < nq; i++) {
+            caches.emplace_back(params.efSearch);
+        }
+        std::vector<faiss::HNSWSearchCache*> cache_ptrs(nq);
+        for (int i = 0; i < nq; i++) {
+            cache_ptrs[i] = &caches[i];
+        }
+        std::vector<faiss::idx_t> I_ref(k * nq), I_search(k * nq);
+        std::vector<float> D_ref(k * nq), D_search(k * nq);
+        index->search_resume(
+                nq,
+                xq->data(),
+                k,
+                D_ref.data(),
+                I_ref.data(),
+                cache_ptrs,
+                &params);
+        index->search(
+                nq, xq->data(), k, D_search.data(), I_search.data(), &params);
+        for (int i = 0; i < nq; i++) {
+            for (int j = 0; j < k; j++) {
+                EXPECT_EQ(I[(i * nc + c) * k + j], I_ref[i * k + j]);
+                EXPECT_EQ(D[(i * nc + c) * k + j], D_ref[i * k + j]);
+                EXPECT_EQ(I_search[i * k + j], I_ref[i * k + j]);
+            }
+        }
+    }
+}
+
+TEST_F(HNSWTest, TEST_conformal_termination) {
+    faiss::HNSWConformalTermination conformal;
+    conformal.schedule = {8, 16, 64};
+    size_t nc = conformal.schedule.size();
+    std::vector<faiss::idx_t> I_ckpt(nq * nc * k);
+    std::vector<float> D_ckpt(nq * nc * k);
+    index->search_checkpoints(
+            nq,
+            xq->data(),
+            k,
+            nc,
+            conformal.schedule.data(),
+            D_ckpt.data(),
+            I_ckpt.data());
+
+    faiss::SearchParametersHNSW params;
+    params.termination_method = faiss::HNSW_TERMINATION_CONFORMAL;
+    params.conformal = &conformal;
+    std::vector<faiss::idx_t> I(nq * k);
+    std::vector<float> D(nq * k);
+
+    // scores are in [0, 1]: a negative threshold stops after the first
+    // checkpoint, a threshold of 1 never stops early
+    for (size_t c : {size_t(0), nc - 1}) {
+        conformal.lambda_hat = c == 0 ? -1 : 1;
+        index->search(nq, xq->data(), k, D.data(), I.data(), &params);
+        for (int i = 0; i < nq; i++) {
+            for (int j = 0; j < k; j++) {
+                EXPECT_EQ(I[i * k + j], I_ckpt[(i * nc + c) * k + j]);
+                EXPECT_EQ(D[i * k + j], D_ckpt[(i * nc + c) * k + j]);
+            }
+        }
+    }
+
+    faiss::RangeSearchResult rres(nq);
+    EXPECT_THROW(
+            index->range_search(nq, xq->data(), 1.0, &rres, &params),
+            faiss::FaissException);
+    params.conformal = nullptr;
+    EXPECT_THROW(
+            index->search(nq, xq->data(), k, D.data(), I.data(), &params),
+            faiss::FaissException);
+}
+
+TEST_F(HNSWTest, TEST_search_trace) {
+    std::vector<faiss::idx_t> I(nq * k);
+    std::vector<float> D(nq * k);
+    faiss::SearchParametersHNSW params;
+    params.efSearch = 32;
+    faiss::HNSWSearchTrace trace(1000, 2);
+    params.trace = &trace;
+    faiss::hnsw_stats.reset();
+    index->search(nq, xq->data(), k, D.data(), I.data(), &params);
+    size_t nhops = faiss::hnsw_stats.nhops;
+
+    size_t n = trace.nrecords();
+    ASSERT_GT(n, 0);
+    EXPECT_LT(n, nhops);
+    EXPECT_EQ(trace.noverwritten(), 0);
+    std::vector<faiss::idx_t> query(n);
+    std::vector<int32_t> nstep(n), ncandidates(n);
+    std::vector<int64_t> ndis(n);
+    std::vector<float> threshold(n);
+    trace.get_records(
+            query.data(),
+            nstep.data(),
+            ncandidates.data(),
+            ndis.data(),
+            threshold.data());
+    // one query out of 2 is recorded
+    EXPECT_EQ(
+            std::unordered_set<faiss::idx_t>(query.begin(), query.end())
+                    .size(),
+            size_t((nq + 1) / 2));
+    for (size_t i = 0; i < n; i++) {
+        EXPECT_GT(ndis[i], 0);
+        if (i > 0 && query[i] == query[i - 1]) {
+            EXPECT_EQ(nstep[i], nstep[i - 1] + 1);
+            EXPECT_GE(ndis[i], ndis[i - 1]);
+            EXPECT_LE(threshold[i], threshold[i - 1]);
+        }
+    }
+    // the final k-th distance is the last threshold of the query
+    EXPECT_EQ(threshold[n - 1], D[query[n - 1] * k + k - 1]);
+
+    // a small buffer keeps the last records
+    faiss::HNSWSearchTrace small_trace(5, 1);
+    params.trace = &small_trace;
+    index->search(nq, xq->data(), k, D.data(), I.data(), &params);
+    EXPECT_GE(small_trace.nrecords(), 5);
+    EXPECT_LE(small_trace.nrecords(), 5 * omp_get_max_threads());
+    EXPECT_GT(small_trace.noverwritten(), 0);
+
+    small_trace.reset();
+    EXPECT_EQ(small_trace.nrecords(), 0);
+}
+
+TEST_F(HNSWTest, TEST_search_trace_threads) {
+    // searches from threads that are not OpenMP threads share the trace
+    faiss::SearchParametersHNSW params;
+    params.efSearch = 32;
+    faiss::HNSWSearchTrace ref_trace(100000);
+    params.trace = &ref_trace;
+    std::vector<faiss::idx_t> I(nq * k);
+    std::vector<float> D(nq * k);
+    index->search(nq, xq->data(), k, D.data(), I.data(), &params);
+
+    int nt = 4;
+    faiss::HNSWSearchTrace trace(100000, 1, 1);
+    params.trace = &trace;
+    std::vector<std::thread> threads;
+    for (int t = 0; t < nt; t++) {
+        threads.emplace_back([&]() {
+            std::vector<faiss::idx_t> It(nq * k);
+            std::vector<float> Dt(nq * k);
+            index->search(nq, xq->data(), k, Dt.data(), It.data(), &params);
+        });
+    }
+    for (auto& th : threads) {
+        th.join();
+    }
+    EXPECT_EQ(trace.nrecords(), size_t(nt) * ref_trace.nrecords());
+    EXPECT_EQ(trace.noverwritten(), 0);
+}
+
+TEST_F(HNSWTest, TEST_search_trace_level_0) {
+    // search_level_0 records the queries as well
+    std::vector<faiss::HNSW::storage_idx_t> nearest(
+            nq, index->hnsw.entry_point);
+    std::vector<float> nearest_d(nq, 0);
+    std::vector<faiss::idx_t> I(nq * k);
+    std::vector<float> D(nq * k);
+    faiss::SearchParametersHNSW params;
+    params.efSearch = 32;
+    faiss::HNSWSearchTrace trace(100000);
+    params.trace = &trace;
+    index->search_level_0(
+            nq,
+            xq->data(),
+            k,
+            nearest.data(),
+            nearest_d.data(),
+            D.data(),
+            I.data(),
+            1,
+            1,
+            &params);
+    size_t n = trace.nrecords();
+    ASSERT_GT(n, 0);
+    std::vector<faiss::idx_t> query(n);
+    std::vector<int32_t> nstep(n), ncandidates(n);
+    std::vector<int64_t> ndis(n);
+    std::vector<float> threshold(n);
+    trace.get_records(
+            query.data(),
+            nstep.data(),
+            ncandidates.data(),
+            ndis.data(),
+            threshold.data());
+    EXPECT_EQ(
+            std::unordered_set<faiss::idx_t>(query.begin(), query.end())
+                    .size(),
+            size_t(nq));
+}
+
+TEST_F(HNSWTest, TEST_search_interleaved) {
+    std::vector<faiss::idx_t> I_ref(nq * k), I(nq * k);
+    std::vector<float> D_ref(nq * k), D(nq * k);
+    faiss::SearchParametersHNSW params;
+    params.efSearch = 32;
+
+    for (auto method :
+         {faiss::HNSW_TERMINATION_EF_SEARCH,
+          faiss::HNSW_TERMINATION_PATIENCE}) {
+        params.termination_method = method;
+        params.patience = 3;
+        params.n_interleave = 1;
+        faiss::hnsw_stats.reset();
+        index->search(nq, xq->data(), k, D_ref.data(), I_ref.data(), &params);
+        size_t ndis_ref = faiss::hnsw_stats.ndis;
+
+        // the traversal of each query does not depend on the group
+        params.n_interleave = 3;
+        faiss::hnsw_stats.reset();
+        index->search(nq, xq->data(), k, D.data(), I.data(), &params);
+        EXPECT_EQ(faiss::hnsw_stats.ndis, ndis_ref);
+        EXPECT_EQ(I, I_ref);
+        EXPECT_EQ(D, D_ref);
+    }
+
+    // the interleaved search does not record traces
+    faiss::HNSWSearchTrace trace(1024);
+    params.trace = &trace;
+    EXPECT_THROW(
+            index->search(nq, xq->data(), k, D.data(), I.data(), &params),
+            faiss::FaissException);
+    params.trace = nullptr;
+
+    // nor does it compute the Panorama distances
+    faiss::IndexHNSWFlatPanorama index_pano(d, M, 4);
+    index_pano.add(nb, xb->data());
+    EXPECT_THROW(
+            index_pano.search(nq, xq->data(), k, D.data(), I.data(), &params),
+            faiss::FaissException);
+
+    // neither does the resumed search
+    std::vector<faiss::HNSWSearchCache> caches;
+    for (int i = 0; i < nq; i++) {
+        caches.emplace_back(32);
+    }
+    std::vector<faiss::HNSWSearchCache*> cache_ptrs;
+    for (auto& cache : caches) {
+        cache_ptrs.push_back(&cache);
+    }
+    params.n_interleave = 1;
+    EXPECT_THROW(
+            index_pano.search_resume(
+                    nq, xq->data(), k, D.data(), I.data(), cache_ptrs, &params),
+            faiss::FaissException);
+    faiss::IndexHNSW& index_pano_base = index_pano;
+    EXPECT_THROW(
+            index_pano_base.search_resume(
+                    nq, xq->data(), k, D.data(), I.data(), cache_ptrs, &params),
+            faiss::FaissException);
+}
+
+namespace {
+
+/// average id gap between the nodes of level 0 and their neighbors
+double mean_level0_gap(const faiss::HNSW& hnsw) {
+    double sum = 0;
+    size_t n = 0;
+    for (size_t i = 0; i < hnsw.levels.size(); i++) {
+        size_t begin, end;
+        hnsw.neighbor_range(i, 0, &begin, &end);
+        for (size_t j = begin; j < end && hnsw.neighbors[j] >= 0; j++) {
+            sum += std::abs(double(hnsw.neighbors[j]) - double(i));
+            n++;
+        }
+    }
+    return sum / n;
+}
+
+} // namespace
+
+TEST_F(HNSWTest, TEST_reorder_graph) {
+    for (auto method :
+         {faiss::HNSW_REORDER_BFS,
+          faiss::HNSW_REORDER_RCM,
+          faiss::HNSW_REORDER_GORDER}) {
+        faiss::IndexHNSWFlat index2(d, M);
+        index2.add(nb, xb->data());
+        std::vector<faiss::idx_t> I_ref(nq * k), I(nq * k);
+        std::vector<float> D_ref(nq * k), D(nq * k);
+        index2.search(nq, xq->data(), k, D_ref.data(), I_ref.data());
+        double gap = mean_level0_gap(index2.hnsw);
+        faiss::RangeSearchResult res_ref(nq);
+        index2.range_search(nq, xq->data(), D_ref[k - 1], &res_ref);
+        std::vector<faiss::idx_t> range_labels_ref(
+                res_ref.labels, res_ref.labels + res_ref.lims[nq]);
+
+        std::vector<faiss::idx_t> perm(nb);
+        index2.reorder_graph(method, perm.data());
+        std::vector<faiss::idx_t> sorted_perm(perm);
+        std::sort(sorted_perm.begin(), sorted_perm.end());
+        for (int i = 0; i < nb; i++) {
+            ASSERT_EQ(sorted_perm[i], i);
+        }
+        EXPECT_LT(mean_level0_gap(index2.hnsw), gap);
+
+        // same graph, same traversal, same labels
+        index2.search(nq, xq->data(), k, D.data(), I.data());
+        EXPECT_EQ(I, I_ref);
+        EXPECT_EQ(D, D_ref);
+
+        // the selectors are in terms of labels
+        faiss::IDSelectorRange sel(0, nb / 2);
+        faiss::SearchParametersHNSW params;
+        params.sel = &sel;
+        index2.search(nq, xq->data(), k, D.data(), I.data(), &params);
+        for (int i = 0; i < nq * k; i++) {
+            EXPECT_LT(I[i], nb / 2);
+        }
+        EXPECT_EQ(params.sel, &sel);
+
+        faiss::RangeSearchResult res(nq);
+        index2.range_search(nq, xq->data(), D_ref[k - 1], &res);
+        std::vector<faiss::idx_t> range_labels(
+                res.labels, res.labels + res.lims[nq]);
+        EXPECT_EQ(range_labels, range_labels_ref);
+
+        // the label map is serialized
+        faiss::VectorIOWriter writer;
+        faiss::write_index(&index2, &writer);
+        faiss::VectorIOReader reader;
+        reader.data = writer.data;
+        std::unique_ptr<faiss::Index> index3(faiss::read_index(&reader));
+        index3->search(nq, xq->data(), k, D.data(), I.data());
+        EXPECT_EQ(I, I_ref);
+    }
+}
+
+TEST(HNSW, Test_add_striped_locks) {
+    int d = 32, nb = 5000, nq = 200, k = 1;
+    std::vector<float> xb(size_t(d) * nb);
+    faiss::float_rand(xb.data(), xb.size(), 123);
+
+    // few stripes so that the threads contend on the locks
+    for (int nstripe : {0, 4, 1 << 16}) {
+        faiss::IndexHNSWFlat index(d, 16);
+        index.add_lock_stripes = nstripe;
+        index.add(nb, xb.data());
+
+        const faiss::HNSW& hnsw = index.hnsw;
+        for (int i = 0; i < nb; i++) {
+            for (int level = 0; level < hnsw.levels[i]; level++) {
+                size_t begin, end;
+                hnsw.neighbor_range(i, level, &begin, &end);
+                std::unordered_set<int> seen;
+                for (size_t j = begin; j < end && hnsw.neighbors[j] >= 0;
+                     j++) {
+                    int v = hnsw.neighbors[j];
+                    ASSERT_LT(v, nb);
+                    ASSERT_GE(hnsw.levels[v], level + 1);
+                    ASSERT_TRUE(seen.insert(v).second);
+                }
+            }
+        }
+
+        // database vectors should find themselves
+        std::vector<float> D(nq * k);
+        std::vector<faiss::idx_t> I(nq * k);
+        index.search(nq, xb.data(), k, D.data(), I.data());
+        int nfound = 0;
+        for (int i = 0; i < nq; i++) {
+            nfound += I[i] == i;
+        }
+        EXPECT_GE(nfound, nq * 95 / 100);
+    }
+}
+
+TEST(HNSW, Test_remove_ids_compact) {
+    int d = 32, nb = 5000, nq = 200, k = 10;
+    std::vector<float> xb(size_t(d) * nb);
+    faiss::float_rand(xb.data(), xb.size(), 1234);
+    const float* xq = xb.data() + size_t(d) * (nb - nq);
+
+    faiss::IndexHNSWFlat index(d, 16);
+    index.add(nb, xb.data());
+
+    // remove one third of the vectors, including the entry point
+    std::vector<faiss::idx_t> to_remove;
+    for (int i = 0; i < nb; i++) {
+        if (i % 3 == 0 || i == index.hnsw.entry_point) {
+            to_remove.push_back(i);
+        }
+    }
+    faiss::IDSelectorBatch sel(to_remove.size(), to_remove.data());
+    EXPECT_EQ(index.remove_ids(sel), to_remove.size());
+    EXPECT_EQ(index.remove_ids(sel), 0);
+    EXPECT_EQ(index.ntotal, nb);
+
+    // reference: exact search among the remaining vectors
+    faiss::IndexFlatL2 index_ref(d);
+    index_ref.add(nb, xb.data());
+    faiss::IDSelectorNot not_removed(&sel);
+    faiss::SearchParameters params_ref;
+    params_ref.sel = &not_removed;
+    std::vector<float> Dref(nq * k);
+    std::vector<faiss::idx_t> Iref(nq * k);
+    index_ref.search(nq, xq, k, Dref.data(), Iref.data(), &params_ref);
+
+    auto recall = [&]() {
+        std::vector<float> D(nq * k);
+        std::vector<faiss::idx_t> I(nq * k);
+        index.search(nq, xq, k, D.data(), I.data());
+        int nfound = 0;
+        for (int q = 0; q < nq; q++) {
+            std::unordered_set<faiss::idx_t> gt(
+                    Iref.begin() + q * k, Iref.begin() + (q + 1) * k);
+            for (int j = 0; j < k; j++) {
+                EXPECT_FALSE(I[q * k + j] >= 0 && sel.is_member(I[q * k + j]));
+                nfound += gt.count(I[q * k + j]);
+            }
+        }
+        return nfound / double(nq * k);
+    };
+
+    double recall_before = recall();
+    EXPECT_GT(recall_before, 0.8);
+
+    EXPECT_GT(index.compact(), 0);
+    EXPECT_EQ(index.hnsw.ndeleted_linked, 0);
+    const faiss::HNSW& hnsw = index.hnsw;
+    EXPECT_FALSE(sel.is_member(hnsw.entry_point));
+    for (int i = 0; i < nb; i++) {
+        for (size_t j = hnsw.offsets[i]; j < hnsw.offsets[i + 1]; j++) {
+            int v = hnsw.neighbors[j];
+            if (sel.is_member(i)) {
+                ASSERT_EQ(v, -1);
+            } else if (v >= 0) {
+                ASSERT_FALSE(sel.is_member(v));
+            }
+        }
+    }
+    EXPECT_GT(recall(), recall_before - 0.05);
+
+    // the repaired graph can be extended
+    index.add(100, xb.data());
+    EXPECT_EQ(index.ntotal, nb + 100);
+    EXPECT_EQ(index.compact(), 0);
+}
+
+TEST(HNSW, Test_prefilter) {
+    int d = 32, nb = 5000, nq = 200, k = 10;
+    std::vector<float> xb(size_t(d) * nb), xq(size_t(d) * nq);
+    faiss::float_rand(xb.data(), xb.size(), 12);
+    faiss::float_rand(xq.data(), xq.size(), 34);
+
+    faiss::IndexHNSWFlat index(d, 16);
+    index.prefilter =
+            new faiss::IndexScalarQuantizer(d, faiss::ScalarQuantizer::QT_4bit);
+    index.own_prefilter = true;
+    index.train(nb, xb.data());
+    index.add(nb, xb.data());
+    EXPECT_EQ(index.prefilter->ntotal, nb);
+
+    faiss::IndexFlatL2 index_ref(d);
+    index_ref.add(nb, xb.data());
+    std::vector<float> Dref(nq * k);
+    std::vector<faiss::idx_t> Iref(nq * k);
+    index_ref.search(nq, xq.data(), k, Dref.data(), Iref.data());
+
+    auto search = [&](float margin, std::vector<faiss::idx_t>& I) {
+        faiss::SearchParametersHNSW params;
+        params.efSearch = 64;
+        params.prefilter_margin = margin;
+        std::vector<float> D(nq * k);
+        faiss::hnsw_stats.reset();
+        index.search(nq, xq.data(), k, D.data(), I.data(), &params);
+        int nfound = 0;
+        for (int q = 0; q < nq; q++) {
+            std::unordered_set<faiss::idx_t> gt(
+                    Iref.begin() + q * k, Iref.begin() + (q + 1) * k);
+            for (int j = 0; j < k; j++) {
+                nfound += gt.count(I[q * k + j]);
+            }
+        }
+        return nfound / double(nq * k);
+    };
+
+    // with an infinite margin, all the neighbors are computed exactly
+    std::vector<faiss::idx_t> I(nq * k), Inoprefilter(nq * k);
+    double recall_exact = search(INFINITY, I);
+    size_t ndis_exact = faiss::hnsw_stats.ndis;
+    faiss::Index* prefilter = index.prefilter;
+    index.prefilter = nullptr;
+    search(0.1, Inoprefilter);
+    EXPECT_EQ(I, Inoprefilter);
+    EXPECT_EQ(faiss::hnsw_stats.ndis, ndis_exact);
+    index.prefilter = prefilter;
+
+    double recall = search(0.1, I);
+    EXPECT_LT(faiss::hnsw_stats.ndis, ndis_exact);
+    EXPECT_GT(recall, recall_exact - 0.05);
+
+    // the interleaved search would ignore the prefilter
+    faiss::SearchParametersHNSW params;
+    params.n_interleave = 4;
+    std::vector<float> D(nq * k);
+    EXPECT_THROW(
+            index.search(nq, xq.data(), k, D.data(), I.data(), &params),
+            faiss::FaissException);
+}
+
+TEST(HNSW, Test_search_resume_variants) {
+    int d = 32, nb = 3000, nq = 50, k = 10;
+    std::vector<float> xb(size_t(d) * nb), xq(size_t(d) * nq);
+    faiss::float_rand(xb.data(), xb.size(), 56);
+    faiss::float_rand(xq.data(), xq.size(), 78);
+
+    faiss::IndexHNSWSQ index_sq(d, faiss::ScalarQuantizer::QT_8bit, 16);
+    faiss::IndexHNSWPQ index_pq(d, 8, 16, 6);
+    faiss::IndexHNSWFlat index_ip(d, 16, faiss::METRIC_INNER_PRODUCT);
+    faiss::IDSelectorRange sel(0, nb / 2);
+
+    for (faiss::IndexHNSW* index : std::vector<faiss::IndexHNSW*>{
+                 &index_sq, &index_pq, &index_ip}) {
+        index->train(nb, xb.data());
+        index->add(nb, xb.data());
+
+        for (bool filtered : {false, true}) {
+            faiss::SearchParametersHNSW params;
+            params.sel = filtered ? &sel : nullptr;
+
+            std::vector<faiss::HNSWSearchCache> caches;
+            for (int i = 0; i < nq; i++) {
+                caches.emplace_back(64, faiss::HNSW_VISITED_HASHSET);
+            }
+            std::vector<faiss::HNSWSearchCache*> cache_ptrs(nq);
+            for (int i = 0; i < nq; i++) {
+                cache_ptrs[i] = &caches[i];
+            }
+            std::vector<float> D(nq * k), Dref(nq * k);
+            std::vector<faiss::idx_t> I(nq * k), Iref(nq * k);
+            for (int ef : {16, 64}) {
+                params.efSearch = ef;
+                index->search_resume(
+                        nq, xq.data(), k, D.data(), I.data(), cache_ptrs,
+                        &params);
+            }
+            index->search(nq, xq.data(), k, Dref.data(), Iref.data(), &params);
+
+            int ncommon = 0;
+            for (int q = 0; q < nq; q++) {
+                std::unordered_set<faiss::idx_t> ref(
+                        Iref.begin() + q * k, Iref.begin() + (q + 1) * k);
+                for (int j = 0; j < k; j++) {
+                    faiss::idx_t id = I[q * k + j];
+                    ASSERT_GE(id, 0);
+                    if (filtered) {
+                        EXPECT_LT(id, nb / 2);
+                    }
+                    ncommon += ref.count(id);
+                    if (j > 0) {
+                        // sorted best first, with the sign of the metric
+                        if (index == &index_ip) {
+                            EXPECT_LE(D[q * k + j], D[q * k + j - 1]);
+                        } else {
+                            EXPECT_GE(D[q * k + j], D[q * k + j - 1]);
+                        }
+                    }
+                }
+                if (index == &index_ip) {
+                    float ip = faiss::fvec_inner_product(
+                            xq.data() + q * d, xb.data() + I[q * k] * d, d);
+                    EXPECT_NEAR(D[q * k], ip, 1e-4);
+                }
+            }
+            EXPECT_GT(ncommon, 0.9 * nq * k);
+        }
+    }
+}
@@ -10,6 +10,8 @@
 #include <faiss/Index.h>
 #include <faiss/utils/utils.h>
 
+#include <vector>
+
 TEST(TestUtils, get_version) {
     std::string version = std::to_string(FAISS_VERSION_MAJOR) + "." +
             std::to_string(FAISS_VERSION_MINOR) + "." +
@@ -17,3 +19,16 @@ TEST(TestUtils, get_version) {
 
     EXPECT_EQ(version, faiss::get_version());
 }
+
+TEST(TestUtils, ranklist_intersection_sizes) {
+    // 3 queries, 4 results vs 3 ground-truth neighbors
+    std::vector<int64_t> res = {1, 2, 3, 4, 5, 5, -1, -1, 7, 8, 9, 10};
+    std::vector<int64_t> gt = {4, 1, 9, 5, -1, 6, 11, 12, 13};
+    std::vector<int64_t> inter(3);
+    faiss::ranklist_intersection_sizes(
+            3, 4, res.data(), 3, gt.data(), inter.data());
+    EXPECT_EQ(inter[0], 2);
+    // duplicates and missing results are counted once / not at all
+    EXPECT_EQ(inter[1], 1);
+    EXPECT_EQ(inter[2], 0);
+}